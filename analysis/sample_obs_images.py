@@ -7,13 +7,20 @@
 # script.
 import numpy as np
 import os
+import sys
 import pickle
-import scipy.misc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from image_writer import AsyncImageWriter
 
 # Hardcoded parameter that points to the saved pkl files.
 base_path = 'results/Atari/PongDeterministic-v4/gru_32_hx_(64,100)_bgru/'
+# The mappings are keyed by frame ids: rows of the (memory-mapped) frame store saved along with them.
+frames = np.load(base_path + 'frames.npy', mmap_mode='r')
 # There are three pkl files of interest.
 pkl_files = ['obs_to_encoding', 'obs_to_min_states', 'obs_to_unmin_states']
+# Images are written in the background; the writer blocks once too many are queued.
+image_writer = AsyncImageWriter(workers=4)
 for relevant_pkl_file in pkl_files:
 	# Load in the data from the specified paths.
 	obs_to_encoding = {}
@@ -26,8 +33,8 @@ for relevant_pkl_file in pkl_files:
 	num_entries_to_check = 400
 	num_entries_checked = 0
 	for key, value in obs_to_encoding.items():
-		# Reshape the key to 80x80, the format of the images
-		observation_image = np.reshape(key, (80, 80))
+		# Reshape the frame of the key to 80x80, the format of the images
+		observation_image = np.reshape(frames[key], (80, 80))
 
 		if value in encoding_to_images.keys():
 			# Corresponds to multiple images for the same state
@@ -60,5 +67,8 @@ for relevant_pkl_file in pkl_files:
 		else:
 			for i, image in enumerate(images):
 				print("Saving image number", i)
-				scipy.misc.imsave(encoding_dir + "/" + str(i) + '.jpg', image)
-		encoding_counter += 1
\ No newline at end of file
+				image_writer.write(encoding_dir + "/" + str(i) + '.jpg', image)
+		encoding_counter += 1
+	# All the images of this mapping are on disk past this point.
+	image_writer.flush()
+image_writer.close()
\ No newline at end of file
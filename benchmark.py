@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Rollout throughput benchmark: env-steps/sec and per-step latency percentiles of the policies of the pipeline (GRUNet,
+MMNet, the minimized MooreMachine played by its evaluate method and its compiled FSMRuntime) on the same seeds.
+
+Policies are the MMNet trained by main_control when one exists in the result directory (CartPole-v1 only), and
+randomly initialized (seeded) networks otherwise, whose definitions (atari_nets, mce_nets, control_nets) don't need
+gym; the MooreMachine is extracted from the MMNet on the very same episodes and minimized. Environments are offline
+stand-ins (a vector and an Atari-like image environment) and, if gym is installed, CartPole-v1.
+
+Random networks get their codes spread out (see _spread_codes) so that the extracted machines have a few hundred states
+instead of one: throughput is then that of a synthetic machine of that size rather than of a trained one. The rewards
+of the offline environments are synthetic too. The report lists these caveats along with the networks each result
+was measured with.
+
+Usage::
+
+    python benchmark.py --episodes 5 --out results/benchmark.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import subprocess
+import numpy as np
+import torch
+import torch.nn.functional as F
+import tools as tl
+from moore_machine import MooreMachine
+
+try:
+    import gym
+except ImportError:
+    gym = None
+
+logger = logging.getLogger(__name__)
+
+CAVEATS = ["Results of 'random' nets are measured on seeded random networks whose QBN and actor weights are "
+           "re-initialized with hand-tuned gains (see _spread_codes) so that the machines have a few hundred states: "
+           "they are synthetic machines, not representative of the ones extracted from trained networks.",
+           "Rewards of the offline environments are synthetic: 1 for the target action of the current frame, "
+           "0 otherwise."]
+
+
+class _ActionSpace():
+    def __init__(self, n):
+        self.n = n
+
+    def sample(self):
+        return random.randrange(self.n)
+
+
+class OfflineEnv():
+    """
+    Offline stand-in environment: observations are drawn from a fixed bank of random frames (so that, as in real
+    environments, observations repeat) depending on the action taken; episodes last a fixed number of steps. Every
+    frame has a target action, and the reward of a step is 1 if the action taken is the target of the current frame
+    and 0 otherwise.
+    """
+
+    def __init__(self, obs_shape, total_actions=2, episode_length=200, total_frames=64, seed=0):
+        bank_rs = np.random.RandomState(seed)
+        self.frames = bank_rs.uniform(0, 1, size=(total_frames,) + tuple(obs_shape)).astype(np.float32)
+        self.targets = bank_rs.randint(total_actions, size=total_frames)
+        self.action_space = _ActionSpace(total_actions)
+        self.episode_length = episode_length
+        self._rs = np.random.RandomState(seed)
+        self._t = 0
+        self._frame = 0
+
+    def seed(self, seed):
+        self._rs = np.random.RandomState(seed)
+
+    def reset(self, inspect=False):
+        self._t = 0
+        self._frame = self._rs.randint(len(self.frames))
+        obs = self.frames[self._frame]
+        return (obs, obs) if inspect else obs
+
+    def step(self, action):
+        self._t += 1
+        reward = float(int(action) == self.targets[self._frame])
+        self._frame = (self._rs.randint(len(self.frames)) + int(action)) % len(self.frames)
+        return self.frames[self._frame], reward, self._t >= self.episode_length, {}
+
+    def render(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+class TimedEnv():
+    """
+    Wraps an environment to time every step; the latency of a step is the time between consecutive calls to step (or
+    reset), i.e. the policy's decision plus the environment's step. Episode i is seeded by seeds[i].
+    """
+
+    def __init__(self, env, seeds):
+        self.env = env
+        self.action_space = env.action_space
+        self.seeds = list(seeds)
+        self.latencies = []
+        self._episode = 0
+        self._last = None
+
+    def reset(self, inspect=False):
+        if hasattr(self.env, 'seed'):
+            self.env.seed(self.seeds[self._episode % len(self.seeds)])
+        self._episode += 1
+        obs = self.env.reset()
+        self._last = time.perf_counter()
+        return (obs, obs) if inspect else obs
+
+    def step(self, action):
+        result = self.env.step(action)
+        now = time.perf_counter()
+        self.latencies.append(now - self._last)
+        self._last = time.perf_counter()
+        return result
+
+    def render(self, *args, **kwargs):
+        pass
+
+
+def play_net(net, env, total_episodes):
+    """
+    Plays episodes greedily with a GRUNet or a MMNet.
+
+    :return: average episode reward
+    """
+    net.eval()
+    total_reward = 0
+    with torch.no_grad():
+        for ep in range(total_episodes):
+            obs = env.reset()
+            hx = net.init_hidden()
+            done = False
+            while not done:
+                obs = torch.FloatTensor(obs).unsqueeze(0)
+                _, logit, hx = net((obs, hx))
+                action = int(F.softmax(logit, dim=1).max(1)[1].data.numpy()[0])
+                obs, reward, done, _ = env.step(action)
+                total_reward += reward
+    return total_reward / total_episodes
+
+
+def summarize(latencies, elapsed):
+    """
+    Steps/sec and latency percentiles (in milliseconds) of a run.
+    """
+    latencies = np.asarray(latencies) * 1000
+    if len(latencies) == 0:
+        return {'steps': 0, 'steps_per_sec': 0.0, 'latency_ms': None}
+    return {'steps': len(latencies),
+            'steps_per_sec': round(len(latencies) / elapsed, 2),
+            'latency_ms': {'mean': round(float(latencies.mean()), 4),
+                           'p50': round(float(np.percentile(latencies, 50)), 4),
+                           'p90': round(float(np.percentile(latencies, 90)), 4),
+                           'p99': round(float(np.percentile(latencies, 99)), 4),
+                           'max': round(float(latencies.max()), 4)}}
+
+
+def _spread_codes(mm_net, hx_gain, obs_gain, actor_gain):
+    """
+    Re-initializes the QBN encoders and the actor of a random MMNet so that their pre-activations spread across the
+    ternary levels and the actions: with the default init they all sit around 0, and the extracted machine collapses
+    to a single state and observation.
+    """
+    for qbn, gain in ((mm_net.bhx_net, hx_gain), (mm_net.obx_net, obs_gain)):
+        for module in qbn.encoder:
+            if isinstance(module, torch.nn.Linear):
+                torch.nn.init.normal_(module.weight, 0, gain / np.sqrt(module.in_features))
+                torch.nn.init.zeros_(module.bias)
+    actor = mm_net.gru_net.actor_linear
+    torch.nn.init.normal_(actor.weight, 0, actor_gain / np.sqrt(actor.in_features))
+    torch.nn.init.zeros_(actor.bias)
+
+
+def trained_net_path(result_dir, env_name, gru_size, bhx_size, ox_size):
+    """
+    Path of the MMNet trained by main_control for the environment (see its bgru_dir), or None if there is none.
+    """
+    if result_dir is None or gym is None or env_name.startswith('offline'):
+        return None
+    path = os.path.join(result_dir, 'Control', env_name, 'gru_{}_hx_({},{})_bgru'.format(gru_size, bhx_size, ox_size),
+                        'model.p')
+    return path if os.path.exists(path) else None
+
+
+def build_nets(env_name, obs_shape, total_actions, gru_size, bhx_size, ox_size, seed, net_path=None):
+    """
+    GRUNet and MMNet of the family matching the environment: loaded from net_path if given, and otherwise randomly
+    initialized (seeded) so that the extracted machine has a few hundred states (see _spread_codes).
+
+    :return: GRUNet, MMNet and a description of the networks ('trained' or 'random')
+    """
+    if len(obs_shape) == 3:
+        import atari_nets as nets
+        hx_gain = 2
+    elif env_name == 'CartPole-v1':
+        import control_nets as nets
+        hx_gain = 3
+    else:
+        import mce_nets as nets
+        hx_gain = 3
+    torch.manual_seed(seed)
+    gru_net = nets.GRUNet(obs_shape[0], gru_size, total_actions)
+    bhx_net = nets.HxQBNet(gru_size, bhx_size)
+    ox_net = nets.ObsQBNet(gru_net.input_c_features, ox_size)
+    mm_net = nets.MMNet(gru_net, bhx_net, ox_net)
+    if net_path is not None:
+        mm_net.load_state_dict(torch.load(net_path, map_location='cpu'))
+        return gru_net, mm_net, 'trained'
+    _spread_codes(mm_net, hx_gain, obs_gain=3, actor_gain=2)
+    return gru_net, mm_net, 'random'
+
+
+def benchmark_env(env_name, env, total_episodes, seed, gru_size, bhx_size, ox_size, result_dir=None):
+    """
+    Benchmarks all the policies on the environment.
+
+    :param result_dir: result directory of main_control, searched for a trained MMNet (see trained_net_path)
+    :return: list of results, one per policy
+    """
+    seeds = [seed + ep for ep in range(total_episodes)]
+    obs_shape = np.asarray(env.reset()).shape
+    total_actions = int(env.action_space.n)
+    net_path = trained_net_path(result_dir, env_name, gru_size, bhx_size, ox_size)
+    gru_net, mm_net, nets = build_nets(env_name, obs_shape, total_actions, gru_size, bhx_size, ox_size, seed,
+                                       net_path)
+
+    # extract the machine on the very same episodes
+    _start_time = time.time()
+    moore_machine = MooreMachine(dense=True)
+    moore_machine.extract_from_nn(env, mm_net, total_episodes, seed, log=False, partial=False)
+    moore_machine.minimize()
+    runtime = moore_machine.compile(mm_net)
+    extraction_time = time.time() - _start_time
+
+    policies = [('GRUNet', lambda e: play_net(gru_net, e, total_episodes)),
+                ('MMNet', lambda e: play_net(mm_net, e, total_episodes)),
+                ('MooreMachine', lambda e: moore_machine.evaluate(mm_net, e, total_episodes, log=False)),
+                ('FSMRuntime', lambda e: runtime.evaluate(e, total_episodes=total_episodes, log=False))]
+    results = []
+    for name, play in policies:
+        timed_env = TimedEnv(env, seeds)
+        _start_time = time.perf_counter()
+        error = None
+        try:
+            reward = play(timed_env)
+        except (Exception, SystemExit) as e:
+            # e.g. the machine meeting an observation or transition it never saw during extraction
+            reward, error = None, repr(e)
+        elapsed = time.perf_counter() - _start_time
+        result = {'env': env_name, 'policy': name, 'nets': nets, 'episodes': total_episodes, 'reward': reward,
+                  'error': error}
+        result.update(summarize(timed_env.latencies, elapsed))
+        logger.info(result)
+        results.append(result)
+    results.append({'env': env_name, 'policy': 'extraction', 'nets': nets, 'nets_path': net_path,
+                    'seconds': round(extraction_time, 4), 'states': len(moore_machine.state_desc),
+                    'min_obs': len(moore_machine.minobs_obs_map)})
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Rollout throughput benchmark')
+    parser.add_argument('--episodes', type=int, default=5, help='No. of episodes per policy')
+    parser.add_argument('--episode_length', type=int, default=200, help='Episode length of the offline environments')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the first episode and of the networks')
+    parser.add_argument('--gru_size', type=int, default=32, help='No. of GRU Cells')
+    parser.add_argument('--bhx_size', type=int, default=16, help='binary encoding size of the hidden state')
+    parser.add_argument('--ox_size', type=int, default=16, help='binary encoding size of the observations')
+    parser.add_argument('--envs', nargs='+', default=['offline_vector', 'offline_image', 'CartPole-v1'],
+                        help='Environments to benchmark')
+    parser.add_argument('--result_dir', default=os.path.join(os.getcwd(), 'results'),
+                        help='Result directory of main_control; its trained MMNet (if any) replaces the random nets')
+    parser.add_argument('--out', default=os.path.join(os.getcwd(), 'results', 'benchmark.json'),
+                        help='Path of the JSON results')
+    return parser.parse_args()
+
+
+def make_env(env_name, episode_length, seed):
+    if env_name == 'offline_vector':
+        return OfflineEnv((4,), 2, episode_length, seed=seed)
+    if env_name == 'offline_image':
+        return OfflineEnv((1, 80, 80), 4, episode_length, seed=seed)
+    if gym is None:
+        return None
+    return gym.make(env_name)
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    torch.set_num_threads(1)
+
+    results = []
+    for env_name in args.envs:
+        env = make_env(env_name, args.episode_length, args.seed)
+        if env is None:
+            logger.info('Skipping {}: gym is not installed'.format(env_name))
+            continue
+        results += benchmark_env(env_name, env, args.episodes, args.seed, args.gru_size, args.bhx_size, args.ox_size,
+                                 args.result_dir)
+
+    report = {'revision': git_revision(),
+              'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'python': sys.version.split()[0],
+              'platform': platform.platform(),
+              'torch': torch.__version__,
+              'args': vars(args),
+              'caveats': CAVEATS,
+              'results': results}
+    tl.ensure_directory_exits(os.path.dirname(os.path.abspath(args.out)))
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=1)
+    logger.info('Results written to {}'.format(args.out))
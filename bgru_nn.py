@@ -9,6 +9,7 @@ import logging
 import numpy as np
 import torch.nn as nn
 from tools import plot_data
+from trajectory_data import pad_batch
 import torch.nn.functional as F
 from torch.autograd import Variable
 
@@ -20,7 +21,7 @@ def _train(net, optimizer, batch_data, batch_size, cuda=False, grad_clip=0.5, tr
 
     :param net: Bottleneck GRU network
     :param optimizer: optimizer method(Adam is preferred)
-    :param batch_data: training data in the batch
+    :param batch_data: training data in the batch (unpadded)
     :param batch_size: batch size
     :param cuda: check if cuda is available
     :param grad_clip: max norm of the gradients
@@ -29,12 +30,16 @@ def _train(net, optimizer, batch_data, batch_size, cuda=False, grad_clip=0.5, tr
     mse_loss_fn = nn.MSELoss().cuda() if cuda else nn.MSELoss()
     ce_loss_fn = nn.CrossEntropyLoss().cuda() if cuda else nn.CrossEntropyLoss()
 
-    data_obs, data_actions, data_actions_probs, data_len = batch_data
+    # sequences are padded batch by batch, so that the whole (possibly memory-mapped) data set is never materialized
+    data_obs, data_actions, data_actions_probs, data_len = pad_batch(batch_data, action_pad=0)
+    if data_actions_probs is None:
+        # the network is trained on the mse to the action probabilities of the guide (see tools.generate_trajectories)
+        raise ValueError('Trajectory data without action probabilities: generate it with a guide network')
     _max, _min = max(data_len), min(data_len)
 
-    data_obs = Variable(torch.Tensor(data_obs))
-    data_actions_probs = Variable(torch.FloatTensor(data_actions_probs))
-    data_actions = Variable(torch.LongTensor(data_actions))
+    data_obs = Variable(torch.from_numpy(data_obs))
+    data_actions_probs = Variable(torch.from_numpy(data_actions_probs))
+    data_actions = Variable(torch.from_numpy(data_actions))
     hx = Variable(net.init_hidden(batch_size))
     if cuda:
         data_obs, data_actions_probs, hx = data_obs.cuda(), data_actions_probs.cuda(), hx.cuda()
@@ -77,7 +82,7 @@ def train(net, env, optimizer, model_path, plot_dir, train_data, batch_size, epo
     :param optimizer: optimizer method(Adam is preferred)
     :param model_path: path to where save the model
     :param plot_dir: path to where save the plots
-    :param train_data: given training data
+    :param train_data: given training data: dict of batches or trajectory_data.TrajectoryDataset
     :param batch_size: batch size
     :param epochs: number of training epochs
     :param cuda: check if cuda is available
@@ -92,19 +97,6 @@ def train(net, env, optimizer, model_path, plot_dir, train_data, batch_size, epo
     epoch_losses = {'actor_mse': [], 'actor_ce': []}
     perf_data = []
 
-    logger.info('Padding Sequences ...')
-    for batch_i, batch_seed in enumerate(batch_seeds):
-        data_obs, data_actions, data_action_probs, data_len = train_data[batch_seed]
-        _max, _min = max(data_len), min(data_len)
-        obs_shape = data_obs[0][0].shape
-        act_shape = np.array(data_actions[0][0]).shape
-        act_prob_shape = np.array(data_action_probs[0][0]).shape
-        if _max != _min:
-            for i in range(len(data_obs)):
-                data_obs[i] += [np.zeros(obs_shape)] * (_max - data_len[i])
-                data_actions[i] += [np.zeros(act_shape)] * (_max - data_len[i])
-                data_action_probs[i] += [np.zeros(act_prob_shape)] * (_max - data_len[i])
-
     for epoch in range(epochs):
         # Testing before training as sometimes the combined model doesn't needs to be trained
         test_perf = test(net, env, test_episodes, test_seeds=test_seeds, cuda=cuda, log=False, render=render)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Networks of the classic control environment (CartPole-v1): GRU policy, quantized bottleneck networks (QBN) and the
+Moore Machine Network (MMNet) combining them.
+"""
+
+import torch
+import tools as tl
+import torch.nn as nn
+from functions import TernaryTanh
+
+
+class ObsQBNet(nn.Module):
+    """
+    Quantized Bottleneck Network(QBN) for observation features.
+    """
+
+    def __init__(self, input_size, x_features):
+        super(ObsQBNet, self).__init__()
+        self.bhx_size = x_features
+        f1 = int(8 * x_features)
+        self.encoder = nn.Sequential(nn.Linear(input_size, f1),
+                                     nn.Tanh(),
+                                     nn.Linear(f1, x_features),
+                                     TernaryTanh())
+
+        self.decoder = nn.Sequential(nn.Linear(x_features, f1),
+                                     nn.Tanh(),
+                                     nn.Linear(f1, input_size),
+                                     nn.ReLU6())
+
+    def forward(self, x):
+        encoded = self.encode(x)
+        decoded = self.decode(encoded)
+        return decoded, encoded
+
+    def encode(self, x):
+        return self.encoder(x)
+
+    def decode(self, x):
+        return self.decoder(x)
+
+
+class HxQBNet(nn.Module):
+    """
+    Quantized Bottleneck Network(QBN) for hidden states of GRU
+    """
+
+    def __init__(self, input_size, x_features):
+        super(HxQBNet, self).__init__()
+        self.bhx_size = x_features
+        f1, f2 = int(8 * x_features), int(4 * x_features)
+        self.encoder = nn.Sequential(nn.Linear(input_size, f1),
+                                     nn.Tanh(),
+                                     nn.Linear(f1, f2),
+                                     nn.Tanh(),
+                                     nn.Linear(f2, x_features),
+                                     TernaryTanh())
+
+        self.decoder = nn.Sequential(nn.Linear(x_features, f2),
+                                     nn.Tanh(),
+                                     nn.Linear(f2, f1),
+                                     nn.Tanh(),
+                                     nn.Linear(f1, input_size),
+                                     nn.Tanh())
+
+    def forward(self, x):
+        x = self.encode(x)
+        return self.decode(x), x
+
+    def encode(self, x):
+        return self.encoder(x)
+
+    def decode(self, x):
+        return self.decoder(x)
+
+
+class GRUNet(nn.Module):
+    """
+    Gated Recurrent Unit Network(GRUNet) definition; its layers are sized for CartPole-v1.
+    """
+
+    def __init__(self, input_size, gru_cells, total_actions):
+        super(GRUNet, self).__init__()
+        self.gru_units = gru_cells
+        self.noise = False
+        self.layer1 = nn.Linear(in_features=4, out_features=4, bias=True)
+        self.layer2 = nn.Linear(in_features=4, out_features=4, bias=True)
+        self.input_c_features = 4
+        self.relu6 = nn.ReLU6()
+        self.relu = nn.ReLU()
+        self.gru = nn.GRUCell(4, gru_cells)
+        self.critic_linear = nn.Linear(in_features=32, out_features=1, bias=True)
+        self.actor_linear = nn.Linear(in_features=32, out_features=2, bias=True)
+
+        self.apply(tl.weights_init)
+        self.actor_linear.weight.data = tl.normalized_columns_initializer(self.actor_linear.weight.data, 0.01)
+        self.actor_linear.bias.data.fill_(0)
+        self.critic_linear.weight.data = tl.normalized_columns_initializer(self.critic_linear.weight.data, 1.0)
+        self.critic_linear.bias.data.fill_(0)
+
+        self.gru.bias_ih.data.fill_(0)
+        self.gru.bias_hh.data.fill_(0)
+
+    def forward(self, input, input_fn=None, hx_fn=None, inspect=False):
+        input, hx = input
+        c_input = self.encode_input(input)
+        input, input_x = input_fn(c_input) if input_fn is not None else (c_input, c_input)
+        ghx = self.gru(input, hx)
+
+        # Keep the noise during both training as well as evaluation
+        # c_input = gaussian(c_input, self.training, mean=0, std=0.05, one_sided=True)
+        # c_input = tl.uniform(c_input, self.noise, low=-0.01, high=0.01, enforce_pos=True)
+        # ghx = tl.uniform(ghx, self.noise, low=-0.01, high=0.01)
+
+        hx, bhx = hx_fn(ghx) if hx_fn is not None else (ghx, ghx)
+
+        if inspect:
+            return self.critic_linear(hx), self.actor_linear(hx), hx, (ghx, bhx, c_input, input_x)
+        else:
+            return self.critic_linear(hx), self.actor_linear(hx), hx
+
+    def encode_input(self, input):
+        c_input = self.relu6(self.layer2(self.relu(self.layer1(input))))
+        return c_input.view(-1, self.input_c_features)
+
+    def encoder_layers(self):
+        """
+        Modules applied by encode_input, in order ('flatten' stands for the final view).
+        """
+        return [self.layer1, self.relu, self.layer2, self.relu6, 'flatten']
+
+    def init_hidden(self, batch_size=1):
+        return torch.zeros(batch_size, self.gru_units)
+
+    def get_action_linear(self, state):
+        return self.actor_linear(state)
+
+    def transact(self, o_x, hx):
+        hx = self.gru(o_x, hx)
+        return hx
+
+
+class MMNet(nn.Module):
+    """
+    Moore Machine Network(MMNet) definition.
+    """
+    def __init__(self, net, hx_qbn=None, obs_qbn=None):
+        super(MMNet, self).__init__()
+        self.bhx_units = hx_qbn.bhx_size if hx_qbn is not None else None
+        self.gru_units = net.gru_units
+        self.obx_net = obs_qbn
+        self.gru_net = net
+        self.bhx_net = hx_qbn
+        self.actor_linear = self.gru_net.get_action_linear
+
+    def init_hidden(self, batch_size=1):
+        return self.gru_net.init_hidden(batch_size)
+
+    def forward(self, x, inspect=False):
+        x, hx = x
+        critic, actor, hx, (ghx, bhx, input_c, input_x) = self.gru_net((x, hx), input_fn=self.obx_net,
+                                                                       hx_fn=self.bhx_net, inspect=True)
+        if inspect:
+            return critic, actor, hx, (ghx, bhx), (input_c, input_x)
+        else:
+            return critic, actor, hx
+
+    def get_action_linear(self, state, decode=False):
+        if decode:
+            hx = self.bhx_net.decode(state)
+        else:
+            hx = state
+        return self.actor_linear(hx)
+
+    def transact(self, o_x, hx_x):
+        hx_x = self.gru_net.transact(self.obx_net.decode(o_x), self.bhx_net.decode(hx_x))
+        _, hx_x = self.bhx_net(hx_x)
+        return hx_x
+
+    def state_encode(self, state):
+        return self.bhx_net.encode(state)
+
+    def obs_encode(self, obs):
+        """
+        Encodes a batch of observations without running the recurrent part of the network.
+        """
+        c_input = self.gru_net.encode_input(obs)
+        return self.obx_net.encode(c_input) if self.obx_net is not None else c_input
+
+    def obs_encoder_layers(self):
+        """
+        Modules applied by obs_encode, in order; see MooreMachine.export.
+        """
+        layers = self.gru_net.encoder_layers()
+        return layers + list(self.obx_net.encoder) if self.obx_net is not None else layers
+
+    def obs_transact(self, o_x, hx):
+        """
+        Steps the network from an already encoded observation; same as forward, minus encoding the observation.
+        """
+        input = self.obx_net.decode(o_x) if self.obx_net is not None else o_x
+        ghx = self.gru_net.transact(input, hx)
+        hx, bhx = self.bhx_net(ghx)
+        return self.actor_linear(hx), hx, bhx
@@ -13,16 +13,34 @@ import bgru_nn
 import logging
 import tools as tl
 from torch import optim
+from fsm_runtime import FSMRuntime
+from fsm_tables import ObsCodeCache
+from profiling import PhaseProfiler
 from moore_machine import MooreMachine
 
 
 class ProcessFSM():
-    def __init__(self, env):
+    def __init__(self, env, num_envs=1, make_env=None, workers=1, columnar=False, env_seed=None):
+        """
+        :param env: environment
+        :param num_envs: number of copies of the environment played in lockstep while generating data
+        :param make_env: function creating a fresh copy of the environment (see tools.env_copies)
+        :param workers: no. of processes generating data
+        :param columnar: check to keep trajectories as memory-mapped columnar datasets (see tools.generate_trajectories)
+        :param env_seed: base seed of the episodes played while generating data (see tools.seed_episode)
+        """
         self.env = env
+        self.num_envs = num_envs
+        self.make_env = make_env
+        self.workers = workers
+        self.columnar = columnar
+        self.env_seed = env_seed
 
     def generate_train_data(self, no_batches, batch_size, trajectories_data_path, generate_train_data, gru_dir):
         tl.set_log(gru_dir, 'generate_train_data')
-        train_data = tl.generate_trajectories(self.env, no_batches, batch_size, trajectories_data_path)
+        train_data = tl.generate_trajectories(self.env, no_batches, batch_size, trajectories_data_path,
+                                              num_envs=self.num_envs, make_env=self.make_env, workers=self.workers,
+                                              env_seed=self.env_seed, columnar=self.columnar)
         return train_data
 
     def train_gru(self, gru_net, gru_net_path, gru_plot_dir, train_data, batch_size, train_epochs, cuda, bn_episodes, bottleneck_data_path, generate_max_steps, gru_prob_data_path, gru_dir):
@@ -34,8 +52,12 @@ class ProcessFSM():
                                train_epochs, cuda, trunc_k=50)
         logging.info('Generating Data-Set for Later Bottle Neck Training')
         gru_net.eval()
-        tl.generate_bottleneck_data(gru_net, self.env, bn_episodes, bottleneck_data_path, cuda=cuda, max_steps=generate_max_steps)
-        tl.generate_trajectories(self.env, 500, batch_size, gru_prob_data_path, gru_net.cpu())
+        tl.generate_bottleneck_data(gru_net, self.env, bn_episodes, bottleneck_data_path, cuda=cuda, max_steps=generate_max_steps,
+                                    num_envs=self.num_envs, make_env=self.make_env, workers=self.workers,
+                                    env_seed=self.env_seed)
+        tl.generate_trajectories(self.env, 500, batch_size, gru_prob_data_path, gru_net.cpu(), num_envs=self.num_envs,
+                                 make_env=self.make_env, workers=self.workers, env_seed=self.env_seed,
+                                 columnar=self.columnar)
         tl.write_net_readme(gru_net, gru_dir, info={'time_taken': time.time() - start_time})
 
         return gru_net
@@ -93,12 +115,17 @@ class ProcessFSM():
         _start_time = time.time()
         if gru_scratch:
             optimizer = optim.Adam(bgru_net.parameters(), lr=1e-3)
-            train_data = tl.generate_trajectories(self.env, 3, 5, trajectories_data_path)
+            train_data = tl.generate_trajectories(self.env, 3, 5, trajectories_data_path, num_envs=self.num_envs,
+                                                  make_env=self.make_env, workers=self.workers,
+                                                  env_seed=self.env_seed, columnar=self.columnar)
             bgru_net = gru_nn.train(bgru_net, self.env, optimizer, bgru_net_path, bgru_plot_dir, train_data, batch_size,
                                     train_epochs, cuda)
         else:
             optimizer = optim.Adam(bgru_net.parameters(), lr=1e-4)
-            train_data = tl.generate_trajectories(self.env, 3, 5, gru_prob_data_path, copy.deepcopy(bgru_net.gru_net).cpu())
+            train_data = tl.generate_trajectories(self.env, 3, 5, gru_prob_data_path, copy.deepcopy(bgru_net.gru_net).cpu(),
+                                                  num_envs=self.num_envs, make_env=self.make_env,
+                                                  workers=self.workers, env_seed=self.env_seed,
+                                                  columnar=self.columnar)
             bgru_net = bgru_nn.train(bgru_net, self.env, optimizer, bgru_net_path, bgru_plot_dir, train_data, 5,
                                      train_epochs, cuda, test_episodes=1, trunc_k=100, render=render)
         tl.write_net_readme(bgru_net, bgru_dir, info={'time_taken': round(time.time() - _start_time, 4)})
@@ -109,22 +136,44 @@ class ProcessFSM():
         bgru_perf = bgru_nn.test(bgru_net, self.env, 1, log=True, cuda=cuda, render=render)
         logging.info('Average Performance: {}'.format(bgru_perf))
 
-    def generate_fsm(self, bgru_net, bgru_net_path, cuda, unmin_moore_machine_path, bgru_dir, min_moore_machine_path):
+    def generate_fsm(self, bgru_net, bgru_net_path, cuda, unmin_moore_machine_path, bgru_dir, min_moore_machine_path,
+                     workers=1, profile=False, frames_per_code=None):
         bgru_net.load_state_dict(torch.load(bgru_net_path))
         bgru_net.eval()
-        moore_machine = MooreMachine()
-        moore_machine.extract_from_nn(self.env, bgru_net, 10, 0, log=True, partial=True, cuda=cuda)
+        profiler = PhaseProfiler(enabled=profile)
+        moore_machine = MooreMachine(dense=True)
+        moore_machine.extract_from_nn(self.env, bgru_net, 10, 0, log=True, partial=True, cuda=cuda,
+                                      obs_cache=ObsCodeCache(), workers=workers, profiler=profiler,
+                                      frames_per_code=frames_per_code)
+        profiler.write(bgru_dir, 'generate_fsm')
         pickle.dump(moore_machine, open(unmin_moore_machine_path, 'wb'))
         moore_machine.save(open(os.path.join(bgru_dir, 'fsm.txt'), 'w'))
 
         moore_machine.minimize_partial_fsm(bgru_net)
         moore_machine.save(open(os.path.join(bgru_dir, 'minimized_moore_machine.txt'), 'w'))
         pickle.dump(moore_machine, open(min_moore_machine_path, 'wb'))
+        moore_machine.export(os.path.splitext(min_moore_machine_path)[0], net=bgru_net)
 
-    def evaluate_fsm(self, bgru_net, bgru_net_path, min_moore_machine_path):
+    def evaluate_fsm(self, bgru_net, bgru_net_path, min_moore_machine_path, profile=False):
         bgru_net.load_state_dict(torch.load(bgru_net_path))
-        moore_machine = pickle.load(open(min_moore_machine_path, 'rb'))
         bgru_net.cpu()
         bgru_net.eval()
-        perf = moore_machine.evaluate(bgru_net, self.env, total_episodes=3, render=True, inspect=False)
+        runtime_path = os.path.splitext(min_moore_machine_path)[0]
+        if os.path.exists(os.path.join(runtime_path, FSMRuntime.MANIFEST)):
+            runtime = FSMRuntime.load(runtime_path)
+        else:
+            # machines generated before the compact format was introduced
+            runtime = pickle.load(open(min_moore_machine_path, 'rb')).compile()
+
+        # the numpy encoder bundled with the machine is used when present
+        encode = None
+        if runtime.encoder is None:
+            def encode(obs):
+                with torch.no_grad():
+                    return bgru_net.obs_encode(torch.FloatTensor(obs).unsqueeze(0)).numpy()[0]
+
+        profiler = PhaseProfiler(enabled=profile)
+        perf = runtime.evaluate(self.env, encode, total_episodes=3, render=True, obs_cache=ObsCodeCache(),
+                                profiler=profiler)
+        profiler.write(os.path.dirname(min_moore_machine_path), 'evaluate_fsm')
         logging.info('Moore Machine Performance: {}'.format(perf))
@@ -0,0 +1,392 @@
+"""
+Compiled runtime of a minimized Moore Machine, stepping many independent sessions at once with numpy.
+
+Only numpy is needed here: along with an ObsEncoder (numpy copy of the observation encoder of the network), a saved
+runtime plays the extracted policy without torch.
+"""
+
+import os
+import sys
+import json
+import pickle
+import logging
+import numpy as np
+from profiling import PhaseProfiler
+from ternary_codec import TernaryCodec
+
+logger = logging.getLogger(__name__)
+
+
+class FSMRuntime():
+    """
+    Minimized Moore Machine compiled into integer arrays:
+
+    - transitions: (states, min-observations) int32 matrix of next states; -1 for unknown transitions
+    - actions: int32 vector of the action of each state; -1 if unknown
+    - observation lookup: packed observation codes (sorted) along with the min-observation each of them belongs to
+
+    Usage::
+
+        runtime = moore_machine.compile()
+        states = runtime.start_states(total_sessions)
+        obs_codes = runtime.pack(obs_x)  # obs_x: (total_sessions, ox_size) ternary encodings of the observations
+        states, actions = runtime.step(states, obs_codes)
+
+    A runtime is saved as a directory of .npy arrays along with a JSON manifest (see save); loading memory-maps the
+    arrays, so that processes loading the same machine share a single copy of it.
+    """
+
+    FORMAT_VERSION = 1
+    MANIFEST = 'manifest.json'
+    ARRAYS = ('transitions', 'actions', 'obs_codes', 'obs_minobs')
+
+    def __init__(self, transitions, actions, obs_codes, obs_minobs, start_state, codec=None, state_labels=None,
+                 minobs_labels=None, presorted=False, encoder=None):
+        self.transitions = np.asarray(transitions, dtype=np.int32)
+        self.actions = np.asarray(actions, dtype=np.int32)
+        self.start_state = int(start_state)
+        self.codec = codec
+        self.state_labels = state_labels
+        self.minobs_labels = minobs_labels
+        self.encoder = encoder
+
+        obs_codes = np.asarray(obs_codes)
+        obs_minobs = np.asarray(obs_minobs, dtype=np.int32)
+        obs_keys = self._as_keys(obs_codes)
+        if not presorted:
+            order = np.argsort(obs_keys, kind='mergesort')
+            obs_codes, obs_keys, obs_minobs = obs_codes[order], obs_keys[order], obs_minobs[order]
+        self.obs_codes = obs_codes
+        self._obs_keys = obs_keys
+        self.obs_minobs = obs_minobs
+
+    @classmethod
+    def from_machine(cls, moore_machine):
+        """
+        Compiles a minimized Moore Machine.
+
+        :param moore_machine: minimized MooreMachine
+        :return: FSMRuntime
+        """
+        if not moore_machine.minimized:
+            raise ValueError('Only minimized Moore Machines can be compiled')
+        state_labels = list(moore_machine.transaction.keys())
+        state_ids = {s: i for i, s in enumerate(state_labels)}
+        minobs_labels = sorted(moore_machine.minobs_obs_map.keys(), key=lambda o: int(o.split('_')[-1]))
+        minobs_ids = {o: i for i, o in enumerate(minobs_labels)}
+
+        transitions = np.full((len(state_labels), len(minobs_labels)), -1, dtype=np.int32)
+        for s, s_trans in moore_machine.transaction.items():
+            for o, next_s in s_trans.items():
+                if next_s is not None:
+                    transitions[state_ids[s], minobs_ids[o]] = state_ids[next_s]
+        actions = np.array([int(moore_machine.state_desc[s]['action'])
+                            if moore_machine.state_desc[s]['action'] not in (None, 'None') else -1
+                            for s in state_labels], dtype=np.int32)
+
+        obs_registry = moore_machine.obs_registry
+        obs_minobs = [minobs_ids[moore_machine.obs_minobs_map[i]] for i in range(len(obs_registry))]
+        return cls(transitions, actions, obs_registry.packed_codes, obs_minobs, state_ids[moore_machine.start_state],
+                   codec=obs_registry.codec, state_labels=state_labels, minobs_labels=minobs_labels)
+
+    def save(self, path, sidecars=None):
+        """
+        Saves the runtime into a directory holding one .npy file per array and a JSON manifest.
+
+        :param path: directory to write into (created if needed)
+        :param sidecars: optional dict of bulky analysis data (such as frame mappings); each of them is pickled into
+                         its own file (arrays into .npy files), so that loading the runtime never touches them
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(getattr(self, name)))
+        manifest = {'format_version': self.FORMAT_VERSION,
+                    'start_state': self.start_state,
+                    'codec_size': self.codec.size if self.codec is not None else None,
+                    'state_labels': [str(s) for s in self.state_labels] if self.state_labels is not None else None,
+                    'minobs_labels': self.minobs_labels,
+                    'arrays': {name: name + '.npy' for name in self.ARRAYS},
+                    'encoder': self.encoder.save(path) if self.encoder is not None else None,
+                    'sidecars': {}}
+        for name, data in (sidecars or {}).items():
+            if isinstance(data, np.ndarray):
+                manifest['sidecars'][name] = name + '.npy'
+                np.save(os.path.join(path, name + '.npy'), data)
+                continue
+            manifest['sidecars'][name] = name + '.pkl'
+            with open(os.path.join(path, name + '.pkl'), 'wb') as f:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(path, self.MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads a runtime saved by save.
+
+        :param path: directory of the saved runtime
+        :param mmap: check to memory-map the arrays (read-only) instead of reading them into memory
+        :return: FSMRuntime
+        """
+        with open(os.path.join(path, cls.MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest.get('format_version') != cls.FORMAT_VERSION:
+            raise ValueError('Unsupported FSM runtime format version: {}'.format(manifest.get('format_version')))
+        arrays = {name: np.load(os.path.join(path, file_name), mmap_mode='r' if mmap else None)
+                  for name, file_name in manifest['arrays'].items()}
+        codec = TernaryCodec(manifest['codec_size']) if manifest['codec_size'] is not None else None
+        encoder = ObsEncoder.load(path, manifest['encoder'], mmap) if manifest.get('encoder') is not None else None
+        return cls(arrays['transitions'], arrays['actions'], arrays['obs_codes'], arrays['obs_minobs'],
+                   manifest['start_state'], codec=codec, state_labels=manifest['state_labels'],
+                   minobs_labels=manifest['minobs_labels'], presorted=True, encoder=encoder)
+
+    @classmethod
+    def load_sidecar(cls, path, name, mmap=True):
+        """
+        Loads a sidecar saved along with the runtime (see save); array sidecars are memory-mapped unless mmap is off.
+        """
+        with open(os.path.join(path, cls.MANIFEST)) as f:
+            file_name = json.load(f)['sidecars'][name]
+        if file_name.endswith('.npy'):
+            return np.load(os.path.join(path, file_name), mmap_mode='r' if mmap else None)
+        with open(os.path.join(path, file_name), 'rb') as f:
+            return pickle.load(f)
+
+    @staticmethod
+    def _as_keys(codes):
+        # codes packed into uint64 are compared as they are; any other rows are compared by their bytes
+        codes = np.asarray(codes)
+        if codes.dtype == np.uint64 and codes.ndim == 1:
+            return codes
+        codes = np.ascontiguousarray(codes.reshape(len(codes), -1))
+        return codes.view(np.dtype((np.void, codes.dtype.itemsize * codes.shape[1]))).ravel()
+
+    @property
+    def total_states(self):
+        return self.transitions.shape[0]
+
+    @property
+    def total_minobs(self):
+        return self.transitions.shape[1]
+
+    def start_states(self, total_sessions):
+        return np.full(total_sessions, self.start_state, dtype=np.int32)
+
+    def pack(self, obs_x):
+        """
+        Packs a batch of observation encodings (as given by the observation QBN) into observation codes.
+
+        :param obs_x: array of shape (N, ox_size)
+        :return: observation codes of the batch
+        """
+        obs_x = np.asarray(obs_x).reshape(len(obs_x), -1)
+        if self.codec is None:
+            return obs_x.astype(np.float64) + 0.0
+        return self.codec.pack_batch(obs_x)
+
+    def lookup(self, obs_codes):
+        """
+        Maps observation codes to min-observation ids.
+
+        :param obs_codes: observation codes (see pack)
+        :return: int32 array of min-observation ids; -1 for unknown observations
+        """
+        keys = self._as_keys(obs_codes)
+        if len(self._obs_keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int32)
+        pos = np.minimum(np.searchsorted(self._obs_keys, keys), len(self._obs_keys) - 1)
+        return np.where(self._obs_keys[pos] == keys, self.obs_minobs[pos], -1).astype(np.int32)
+
+    def step(self, states, obs_codes):
+        """
+        Advances independent sessions by one step.
+
+        :param states: int array of the current state of each session
+        :param obs_codes: observation codes (see pack) seen by each session
+        :return: next state and its action for each session; -1 where the state, observation or transition is unknown
+        """
+        states = np.asarray(states, dtype=np.int32)
+        minobs = self.lookup(obs_codes)
+        valid = (states >= 0) & (minobs >= 0)
+        next_states = np.full(len(states), -1, dtype=np.int32)
+        next_states[valid] = self.transitions[states[valid], minobs[valid]]
+        actions = np.where(next_states >= 0, self.actions[next_states], -1).astype(np.int32)
+        return next_states, actions
+
+    def act(self, states, obs):
+        """
+        Advances independent sessions by one step from raw observations, using the bundled encoder. The encoder
+        dominates the cost of a step: well under a millisecond for the MLP encoders of the control and Tomita nets,
+        about a millisecond per observation for the convolutional Atari encoder.
+
+        :param states: int array of the current state of each session
+        :param obs: batch of preprocessed observations, one per session
+        :return: next state and its action for each session (see step)
+        """
+        return self.step(states, self.pack(self.encoder(obs)))
+
+    def evaluate(self, env, encode=None, total_episodes=1, log=True, render=False, obs_cache=None, profiler=None):
+        """
+        Plays episodes with the machine.
+
+        :param env: environment
+        :param encode: callable mapping an observation to its encoding by the observation QBN (array of ox_size);
+                       defaults to the bundled encoder
+        :param total_episodes: number of episodes to play
+        :param log: check to print out evaluation log
+        :param render: check to render environment
+        :param obs_cache: ObsCodeCache used to skip encoding repeated frames
+        :param profiler: PhaseProfiler timing the phases (env, encode, registry, transact) of the evaluation
+        :return: average episode reward
+        """
+        profiler = profiler if profiler is not None else PhaseProfiler(enabled=False)
+        if encode is None:
+            encode = lambda obs: self.encoder(np.asarray(obs)[None])[0]
+        total_reward = 0
+        for ep in range(total_episodes):
+            with profiler.phase('env'):
+                obs = env.reset()
+            done = False
+            ep_reward = 0
+            ep_actions = []
+            state = self.start_states(1)
+            while not done:
+                with profiler.phase('registry'):
+                    frame_key = obs_cache.digest(obs) if obs_cache is not None else None
+                    obs_code = obs_cache.get(frame_key) if obs_cache is not None else None
+                if obs_code is None:
+                    with profiler.phase('encode'):
+                        obs_x = np.asarray(encode(obs)).reshape(1, -1)
+                    with profiler.phase('registry'):
+                        obs_code = self.pack(obs_x)
+                        if obs_cache is not None:
+                            obs_cache.put(frame_key, obs_code)
+                with profiler.phase('transact'):
+                    state, action = self.step(state, obs_code)
+                if state[0] == -1:
+                    logger.info('None state encountered!')
+                    logger.info('Exiting the script!')
+                    sys.exit(0)
+                if render:
+                    env.render()
+                with profiler.phase('env'):
+                    obs, reward, done, info = env.step(int(action[0]))
+                profiler.count('steps')
+                ep_actions.append(int(action[0]))
+                ep_reward += reward
+
+                # a quick hack to prevent the agent from stucking
+                max_same_action = 5000
+                if len(ep_actions) > max_same_action:
+                    actions_to_consider = ep_actions[-max_same_action:]
+                    if actions_to_consider.count(actions_to_consider[0]) == max_same_action:
+                        done = True
+
+            total_reward += ep_reward
+            profiler.end_episode(episode=ep, reward=ep_reward, steps=len(ep_actions))
+            if log:
+                logger.info("Episode => {} Score=> {}".format(ep, ep_reward))
+        if log and profiler.enabled:
+            logger.info(profiler)
+        return total_reward / total_episodes
+
+
+class ObsEncoder():
+    """
+    Numpy forward pass of the observation encoder of a MMNet (its input feature extractor followed by the encoder of
+    the observation QBN), made of a list of layers. Each layer is a dict with a 'type' and its parameters:
+
+    - conv2d: 'weight' (out, in, kh, kw), 'bias' (out,), 'stride' and 'padding'
+    - linear: 'weight' (out, in) and 'bias' (out,)
+    - relu, relu6, tanh, ternary_tanh and flatten (which keeps the batch dimension)
+    """
+
+    ACTIVATIONS = {'relu': lambda x: np.maximum(x, 0),
+                   'relu6': lambda x: np.clip(x, 0, 6),
+                   'tanh': np.tanh,
+                   'ternary_tanh': lambda x: np.round(1.5 * np.tanh(x) + 0.5 * np.tanh(-3 * x)),
+                   'flatten': lambda x: x.reshape(len(x), -1)}
+    PARAMETERS = ('weight', 'bias')
+
+    def __init__(self, layers):
+        self.layers = layers
+        # conv weights as (kh * kw * in, out) matrices matching the im2col rows of channels-last inputs
+        self._conv_matrices = {i: np.ascontiguousarray(np.transpose(layer['weight'], (2, 3, 1, 0)).reshape(
+                                   -1, layer['weight'].shape[0]), dtype=np.float32)
+                               for i, layer in enumerate(layers) if layer['type'] == 'conv2d'}
+
+    def __call__(self, obs):
+        """
+        Encodes a batch of observations.
+
+        :param obs: array of shape (N, ...) of preprocessed observations
+        :return: float32 array of shape (N, ox_size)
+        """
+        x = np.asarray(obs, dtype=np.float32)
+        # convolutions run channels-last (N, H, W, C), so that every im2col row is a contiguous copy; the layout goes
+        # back to channels-first before anything that depends on it (flatten, linear)
+        channels_last = False
+        for i, layer in enumerate(self.layers):
+            if layer['type'] == 'conv2d':
+                if not channels_last:
+                    x, channels_last = x.transpose(0, 2, 3, 1), True
+                x = self._conv2d(x, self._conv_matrices[i], layer['bias'], layer['weight'].shape[2:],
+                                 layer['stride'], layer['padding'])
+                continue
+            if channels_last and layer['type'] in ('flatten', 'linear'):
+                x, channels_last = x.transpose(0, 3, 1, 2), False
+            if layer['type'] == 'linear':
+                x = x.dot(layer['weight'].T) + layer['bias']
+            else:
+                x = self.ACTIVATIONS[layer['type']](x)
+        return x.transpose(0, 3, 1, 2) if channels_last else x
+
+    @staticmethod
+    def _conv2d(x, matrix, bias, kernel, stride, padding):
+        # channels-last im2col: one (N * out_h * out_w, kh * kw * C) copy of the windows and a single matmul
+        n, h, w, c = x.shape
+        if padding[0] > 0 or padding[1] > 0:
+            padded = np.zeros((n, h + 2 * padding[0], w + 2 * padding[1], c), dtype=np.float32)
+            padded[:, padding[0]:padding[0] + h, padding[1]:padding[1] + w] = x
+            x, h, w = padded, h + 2 * padding[0], w + 2 * padding[1]
+        else:
+            x = np.ascontiguousarray(x)
+        kh, kw = kernel
+        out_h, out_w = (h - kh) // stride[0] + 1, (w - kw) // stride[1] + 1
+        s_n, s_h, s_w, s_c = x.strides
+        windows = np.lib.stride_tricks.as_strided(x, shape=(n, out_h, out_w, kh, kw, c),
+                                                  strides=(s_n, s_h * stride[0], s_w * stride[1], s_h, s_w, s_c),
+                                                  writeable=False)
+        out = windows.reshape(n * out_h * out_w, kh * kw * c).dot(matrix) + bias
+        return out.reshape(n, out_h, out_w, -1)
+
+    def save(self, path):
+        """
+        Saves the layers into a directory: parameters as .npy files and the layer list as JSON (returned, so that it
+        can be embedded in a manifest).
+        """
+        layers = []
+        for i, layer in enumerate(self.layers):
+            layer = dict(layer)
+            for name in self.PARAMETERS:
+                if name in layer:
+                    file_name = 'encoder_{}_{}.npy'.format(i, name)
+                    np.save(os.path.join(path, file_name), np.asarray(layer[name], dtype=np.float32))
+                    layer[name] = file_name
+            layers.append(layer)
+        return layers
+
+    @classmethod
+    def load(cls, path, layers, mmap=True):
+        """
+        Inverse of save.
+        """
+        _layers = []
+        for layer in layers:
+            layer = dict(layer)
+            for name in cls.PARAMETERS:
+                if name in layer:
+                    layer[name] = np.load(os.path.join(path, layer[name]), mmap_mode='r' if mmap else None)
+            _layers.append(layer)
+        return cls(_layers)
@@ -0,0 +1,588 @@
+"""
+Array-backed containers used while enumerating the quantized state and observation spaces of a Moore Machine.
+"""
+
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from ternary_codec import TernaryCodec
+
+
+class CodeRegistry():
+    """
+    Append-only registry of unique codes.
+
+    Codes are kept in a growable array and indexed by a hash map from their packed form to an integer id, which makes
+    lookups and insertions O(1) irrespective of the number of registered codes. A packed registry stores ternary codes
+    (as produced by the QBNs) packed by a TernaryCodec and rejects any other code; otherwise codes are stored as
+    float64 rows.
+
+    :param codes: codes to register
+    :param capacity: initial no. of rows of the storage
+    :param packed: True to pack ternary codes, False to store float rows; if None, the registry is packed when the
+                   given codes are all ternary (and not empty)
+    """
+
+    def __init__(self, codes=None, capacity=64, packed=None):
+        if packed is None:
+            packed = codes is not None and len(codes) > 0 and \
+                     all(TernaryCodec.is_ternary(self._prepare(code)) for code in codes)
+        self.packed = packed
+        self.codec = None
+        self._shape = None
+        self._codes = None
+        self._size = 0
+        self._capacity = capacity
+        self._index = {}
+        if codes is not None:
+            for code in codes:
+                self.add(code)
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if not -self._size <= index < self._size:
+            raise IndexError(index)
+        return self._decode(self._codes[index % self._size: index % self._size + 1])[0]
+
+    def __iter__(self):
+        return iter(self.codes)
+
+    @staticmethod
+    def _prepare(code):
+        # adding 0.0 turns -0.0 (produced by rounding small negative activations) into 0.0, so that both share a key
+        return np.atleast_1d(np.asarray(code, dtype=np.float64)) + 0.0
+
+    def _setup(self, code):
+        # the shape of the codes is fixed by the first one (unless inherited, see key_codec); their storage by the
+        # packed flag
+        if self._shape is None:
+            self._shape = code.shape
+            self.codec = TernaryCodec(code.size) if self.packed else None
+        if self.codec is not None:
+            self._codes = np.empty((self._capacity,) + self.codec.shape, dtype=self.codec.dtype)
+        else:
+            self._codes = np.empty((self._capacity,) + self._shape)
+
+    def _encode(self, code):
+        if self._codes is None:
+            self._setup(code)
+        if code.shape != self._shape:
+            raise ValueError('Code of shape {} does not match registered shape {}'.format(code.shape, self._shape))
+        if self.codec is None:
+            return code, code.tobytes()
+        if not TernaryCodec.is_ternary(code):
+            raise ValueError('Non-ternary code given to a registry of packed ternary codes')
+        packed = self.codec.pack_batch(code)[0]
+        return packed, (int(packed) if self.codec.base3 else packed.tobytes())
+
+    def _decode(self, codes):
+        if self.codec is None:
+            return codes
+        return self.codec.unpack_batch(codes).reshape((len(codes),) + self._shape)
+
+    def _grow(self):
+        if self._size == len(self._codes):
+            _codes = np.empty((2 * len(self._codes),) + self._codes.shape[1:], dtype=self._codes.dtype)
+            _codes[:self._size] = self._codes[:self._size]
+            self._codes = _codes
+
+    @property
+    def codes(self):
+        """
+        Registered codes as an array (indexed by their ids).
+        """
+        if self._codes is None:
+            return np.array([])
+        return self._decode(self._codes[:self._size])
+
+    @property
+    def packed_codes(self):
+        """
+        Registered codes in their stored (packed) form.
+        """
+        if self._codes is None:
+            return np.array([])
+        return self._codes[:self._size]
+
+    def take(self, indices):
+        """
+        Returns the codes with the given ids as an array.
+        """
+        return self._decode(self._codes[:self._size][np.asarray(indices, dtype=np.int64)])
+
+    def key(self, code):
+        """
+        Returns the hashable packed form of the code: an int or bytes.
+        """
+        return self._encode(self._prepare(code))[1]
+
+    def key_codec(self):
+        """
+        Empty registry with the storage (codec and shape) of this one: it computes and decodes the same keys (see key
+        and decode_key) without carrying the registered codes.
+        """
+        registry = CodeRegistry(capacity=self._capacity, packed=self.packed)
+        registry.codec, registry._shape = self.codec, self._shape
+        return registry
+
+    def decode_key(self, key):
+        """
+        Inverse of key: returns the code (array) of the given packed form.
+        """
+        if self._shape is None:
+            raise ValueError('Cannot decode a key before the registry has seen a code')
+        if self.codec is None:
+            return np.frombuffer(key, dtype=np.float64).reshape(self._shape)
+        return self.codec.unpack(key).reshape(self._shape)
+
+    def get(self, code):
+        """
+        Returns id of the code.
+
+        :param code: target code (array)
+        :return: id of the code or None if it is not registered
+        """
+        code = self._prepare(code)
+        if self._shape is None or code.shape != self._shape or \
+                (self.codec is not None and not TernaryCodec.is_ternary(code)):
+            return None
+        return self._index.get(self._encode(code)[1])
+
+    def get_key(self, key):
+        """
+        Returns id of the code with the given packed form (see key) or None if it is not registered.
+        """
+        return self._index.get(key)
+
+    def add(self, code):
+        """
+        Returns id of the code; registers the code first if it is not present.
+
+        :param code: target code (array)
+        :return: id of the code
+        """
+        stored, key = self._encode(self._prepare(code))
+        index = self._index.get(key)
+        if index is None:
+            self._grow()
+            index = self._size
+            self._codes[index] = stored
+            self._index[key] = index
+            self._size += 1
+        return index
+
+
+class TransitionTable():
+    """
+    Dense transition store backed by an int32 matrix of shape (states, observations) in which -1 marks an unknown
+    transition, along with a vector of per-state actions (-1 for unknown). Both grow geometrically.
+
+    Existing code reading ``transaction[s][o]`` keeps working through a thin row view returning None for unknowns.
+    """
+
+    UNKNOWN = -1
+
+    def __init__(self, capacity=(64, 64)):
+        self._matrix = np.full(capacity, self.UNKNOWN, dtype=np.int32)
+        self._actions = np.full(capacity[0], self.UNKNOWN, dtype=np.int32)
+        self.total_states = 0
+        self.total_obs = 0
+
+    def __len__(self):
+        return self.total_states
+
+    def __contains__(self, state):
+        return 0 <= state < self.total_states
+
+    def __getitem__(self, state):
+        if state not in self:
+            raise KeyError(state)
+        return _TransitionRow(self, state)
+
+    def __iter__(self):
+        return iter(range(self.total_states))
+
+    def keys(self):
+        return range(self.total_states)
+
+    def items(self):
+        return ((s, self[s]) for s in self.keys())
+
+    def __str__(self):
+        return {s: dict(row.items()) for s, row in self.items()}.__str__()
+
+    @property
+    def matrix(self):
+        """
+        Transitions of the registered states and observations (view).
+        """
+        return self._matrix[:self.total_states, :self.total_obs]
+
+    @property
+    def actions(self):
+        """
+        Actions of the registered states (view).
+        """
+        return self._actions[:self.total_states]
+
+    def resize(self, total_states, total_obs):
+        """
+        Makes room for the given number of states and observations; new entries are unknown.
+
+        :param total_states: number of states to hold
+        :param total_obs: number of observations to hold
+        :return: ids of the newly added states
+        """
+        rows, cols = self._matrix.shape
+        if total_states > rows or total_obs > cols:
+            while rows < total_states:
+                rows *= 2
+            while cols < total_obs:
+                cols *= 2
+            _matrix = np.full((rows, cols), self.UNKNOWN, dtype=np.int32)
+            _matrix[:self.total_states, :self.total_obs] = self.matrix
+            self._matrix = _matrix
+            _actions = np.full(rows, self.UNKNOWN, dtype=np.int32)
+            _actions[:self.total_states] = self.actions
+            self._actions = _actions
+
+        new_states = range(self.total_states, max(self.total_states, total_states))
+        self.total_states = max(self.total_states, total_states)
+        self.total_obs = max(self.total_obs, total_obs)
+        return new_states
+
+    def get(self, state, obs):
+        next_state = self._matrix[state, obs]
+        return None if next_state == self.UNKNOWN else int(next_state)
+
+    def set(self, state, obs, next_state):
+        self._matrix[state, obs] = self.UNKNOWN if next_state is None else next_state
+
+    def unknowns(self):
+        """
+        Returns (state, obs) pairs of all unknown transitions.
+        """
+        return [(int(s), int(o)) for s, o in np.argwhere(self.matrix == self.UNKNOWN)]
+
+
+class _TransitionRow():
+    """
+    Dict-like view on the transitions of a single state of a TransitionTable.
+    """
+
+    def __init__(self, table, state):
+        self._table = table
+        self._state = state
+
+    def __len__(self):
+        return self._table.total_obs
+
+    def __contains__(self, obs):
+        return 0 <= obs < self._table.total_obs
+
+    def __getitem__(self, obs):
+        if obs not in self:
+            raise KeyError(obs)
+        return self._table.get(self._state, obs)
+
+    def __setitem__(self, obs, next_state):
+        self._table.set(self._state, obs, next_state)
+
+    def get(self, obs, default=None):
+        next_state = self[obs] if obs in self else None
+        return default if next_state is None else next_state
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return range(self._table.total_obs)
+
+    def values(self):
+        return [self[o] for o in self.keys()]
+
+    def items(self):
+        return [(o, self[o]) for o in self.keys()]
+
+    def __str__(self):
+        return dict(self.items()).__str__()
+
+
+class ObsCodeCache():
+    """
+    Bounded LRU cache mapping preprocessed observations to their packed observation codes.
+
+    Observations are keyed by a digest of their bytes; identical frames always yield identical codes, so repeated
+    frames can skip the observation encoder.
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __str__(self):
+        return 'Obs Cache => size: {} capacity: {} hits: {} misses: {} hit rate: {}'.format(
+            len(self), self.capacity, self.hits, self.misses, round(self.hit_rate, 4))
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    @staticmethod
+    def digest(obs):
+        """
+        Returns the cache key of an observation.
+        """
+        return hashlib.blake2b(np.ascontiguousarray(obs).tobytes(), digest_size=16).digest()
+
+    def get(self, key):
+        """
+        Returns the packed code cached for the key (see digest) or None; updates hit/miss counters.
+        """
+        code = self._cache.get(key)
+        if code is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._cache.move_to_end(key)
+        return code
+
+    def put(self, key, code):
+        self._cache[key] = code
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.capacity:
+            self._cache.popitem(last=False)
+
+
+class FrameStore():
+    """
+    Deduplicated store of observation frames, each tagged with its observation code.
+
+    Frames are keyed by a digest of their bytes and kept in a growable array, so mappings over frames can hold integer
+    frame ids instead of the frames themselves. 8-bit images (integer frames in [0, 255], or float frames in [0, 1]
+    that are multiples of 1/255 as produced by the Atari wrappers) are stored as uint8; any other frames keep their
+    dtype. The storage is decided by the first frame.
+
+    With per_code set, only a uniform sample (reservoir) of at most per_code frames is kept per code; the slots of
+    dropped frames are reused, which bounds the memory by the number of codes instead of the number of frames. The
+    digests of the last dropped_capacity dropped frames are remembered (LRU), so that a dropped frame seen again is
+    neither sampled again nor given a different code; one forgotten since counts as a new frame.
+    """
+
+    def __init__(self, per_code=None, seed=0, capacity=64, dropped_capacity=10000):
+        self.per_code = per_code
+        self.scale = None
+        self._dtype = None
+        self._shape = None
+        self._frames = None
+        self._size = 0
+        self._capacity = capacity
+        self._index = {}  # digest -> frame id
+        self._codes = []  # frame id -> code (None for a free slot)
+        self._digests = []  # frame id -> digest
+        self._free = []
+        self._reservoirs = {}  # code -> frame ids
+        self._seen = {}  # code -> no. of distinct frames seen
+        self._dropped = ObsCodeCache(dropped_capacity)  # digest -> code of frames left out of a reservoir
+        self._rs = np.random.RandomState(seed)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, frame_id):
+        """
+        Returns the stored frame (uint8 for 8-bit images; see restore).
+        """
+        if self._codes[frame_id] is None:
+            raise KeyError(frame_id)
+        return self._frames[frame_id]
+
+    digest = staticmethod(ObsCodeCache.digest)
+
+    @staticmethod
+    def _is_8bit(frame):
+        if np.issubdtype(frame.dtype, np.integer):
+            return frame.min() >= 0 and frame.max() <= 255
+        if np.issubdtype(frame.dtype, np.floating) and frame.min() >= 0 and frame.max() <= 1:
+            return np.array_equal(np.round(frame * 255) / np.asarray(255, dtype=frame.dtype), frame)
+        return False
+
+    def _setup(self, frame):
+        self._shape = frame.shape
+        self._dtype = frame.dtype
+        if frame.ndim >= 2 and self._is_8bit(frame):
+            self.scale = 1 if np.issubdtype(frame.dtype, np.integer) else 255
+            self._frames = np.empty((self._capacity,) + frame.shape, dtype=np.uint8)
+        else:
+            self.scale = None
+            self._frames = np.empty((self._capacity,) + frame.shape, dtype=frame.dtype)
+
+    def _store(self, frame):
+        if self.scale is None:
+            return frame
+        if not self._is_8bit(frame):
+            raise ValueError('Frame is not an 8-bit image like the previous frames of the store')
+        return np.round(frame * self.scale).astype(np.uint8)
+
+    def restore(self, frame_id):
+        """
+        Returns the frame as originally given (e.g. float32 in [0, 1]).
+        """
+        frame = self[frame_id]
+        if self.scale is None:
+            return frame
+        return (frame / np.asarray(self.scale, dtype=self._dtype)).astype(self._dtype)
+
+    def code(self, frame_id):
+        return self._codes[frame_id]
+
+    def _slot(self):
+        if len(self._free) > 0:
+            return self._free.pop()
+        if self._size == len(self._frames):
+            _frames = np.empty((2 * len(self._frames),) + self._frames.shape[1:], dtype=self._frames.dtype)
+            _frames[:self._size] = self._frames[:self._size]
+            self._frames = _frames
+        self._codes.append(None)
+        self._digests.append(None)
+        self._size += 1
+        return self._size - 1
+
+    def _release(self, frame_id):
+        digest = self._digests[frame_id]
+        self._dropped.put(digest, self._codes[frame_id])
+        del self._index[digest]
+        self._codes[frame_id] = None
+        self._digests[frame_id] = None
+        self._free.append(frame_id)
+
+    def add(self, frame, code, digest=None):
+        """
+        Adds the frame with its code, unless it is already stored.
+
+        :param frame: frame (array)
+        :param code: hashable observation code of the frame
+        :param digest: digest of the frame (see digest), if already computed
+        :return: id of the frame; None if it was left out of the reservoir of its code
+        """
+        frame = np.asarray(frame)
+        digest = self.digest(frame) if digest is None else digest
+        if digest in self._index:
+            frame_id = self._index[digest]
+            assert self._codes[frame_id] == code, 'Same frame with different codes'
+            return frame_id
+        dropped_code = self._dropped.get(digest)
+        if dropped_code is not None:
+            assert dropped_code == code, 'Same frame with different codes'
+            return None
+        if self._shape is None:
+            self._setup(frame)
+        if frame.shape != self._shape:
+            raise ValueError('Frame of shape {} does not match stored shape {}'.format(frame.shape, self._shape))
+
+        self._seen[code] = self._seen.get(code, 0) + 1
+        reservoir = self._reservoirs.setdefault(code, [])
+        if self.per_code is not None and len(reservoir) >= self.per_code:
+            # reservoir sampling: the i-th frame of a code replaces a random sample with probability per_code / i
+            replace = self._rs.randint(self._seen[code])
+            if replace >= self.per_code:
+                self._dropped.put(digest, code)
+                return None
+            old_id = reservoir[replace]
+            self._release(old_id)
+            frame_id = self._slot()
+            reservoir[replace] = frame_id
+        else:
+            frame_id = self._slot()
+            reservoir.append(frame_id)
+        self._frames[frame_id] = self._store(frame)
+        self._codes[frame_id] = code
+        self._digests[frame_id] = digest
+        self._index[digest] = frame_id
+        return frame_id
+
+    def frame_ids(self, code=None):
+        """
+        Ids of the stored frames (of the given code, if any) in increasing order.
+        """
+        if code is not None:
+            return sorted(self._reservoirs.get(code, []))
+        return [i for i, c in enumerate(self._codes) if c is not None]
+
+    def items(self):
+        """
+        (frame id, code) of the stored frames.
+        """
+        return [(i, c) for i, c in enumerate(self._codes) if c is not None]
+
+    @property
+    def frames(self):
+        """
+        Stored frames as an array indexed by frame id (rows of free slots are left as they were).
+        """
+        if self._frames is None:
+            return np.array([], dtype=np.uint8)
+        return self._frames[:self._size]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_frames'] = self.frames if self._frames is not None else None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._frames is not None:
+            self._frames = np.array(self._frames)
+
+    def save(self, path):
+        """
+        Saves the frames (see frames) as <path>.npy.
+        """
+        np.save(path + '.npy', self.frames)
+        return path + '.npy'
+
+    @staticmethod
+    def load_frames(path, mmap=True):
+        """
+        Loads frames saved by save as an array (memory-mapped by default) indexed by frame id.
+        """
+        return np.load(path + '.npy', mmap_mode='r' if mmap else None)
+
+
+class TrajectoryLog():
+    """
+    Append-only log of fixed-layout records (e.g. the steps of evaluated episodes) in a structured array that grows
+    in chunks (doubling its capacity), so appending a record never allocates Python objects.
+    """
+
+    def __init__(self, dtype, chunk_size=4096):
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self._records = np.empty(chunk_size, dtype=self.dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, *values):
+        if self._size == len(self._records):
+            _records = np.empty(2 * len(self._records), dtype=self.dtype)
+            _records[:self._size] = self._records[:self._size]
+            self._records = _records
+        self._records[self._size] = values
+        self._size += 1
+
+    @property
+    def records(self):
+        """
+        Logged records as a structured array.
+        """
+        return self._records[:self._size]
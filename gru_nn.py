@@ -7,6 +7,7 @@ import torch
 import numpy as np
 import torch.nn as nn
 from tools import plot_data
+from trajectory_data import pad_batch
 import logging, copy, random
 import torch.nn.functional as F
 from torch.autograd import Variable
@@ -19,18 +20,19 @@ def _train(net, optimizer, batch_data, batch_size, cuda=False, grad_clip=5, trun
 
     :param net: Bottleneck GRU network
     :param optimizer: optimizer method(Adam is preferred)
-    :param batch_data: training data in the batch
+    :param batch_data: training data in the batch (unpadded)
     :param batch_size: batch size
     :param cuda: check if cuda is available
     :param grad_clip: max norm of the gradients
     :return: returns trained network on the batch data and loss
     """
     cross_entropy_loss = nn.CrossEntropyLoss().cuda() if cuda else nn.CrossEntropyLoss()
-    data_obs, data_actions, _, data_len = batch_data
+    # sequences are padded batch by batch, so that the whole (possibly memory-mapped) data set is never materialized
+    data_obs, data_actions, _, data_len = pad_batch(batch_data, action_pad=-1)
     _max, _min = max(data_len), min(data_len)
 
-    data_obs = Variable(torch.Tensor(data_obs))
-    data_actions = Variable(torch.LongTensor(data_actions))
+    data_obs = Variable(torch.from_numpy(data_obs))
+    data_actions = Variable(torch.from_numpy(data_actions))
     hx = Variable(net.init_hidden(batch_size))
     if cuda:
         data_obs, data_actions, hx = data_obs.cuda(), data_actions.cuda(), hx.cuda()
@@ -68,7 +70,7 @@ def train(net, env, optimizer, model_path, plot_dir, train_data, batch_size, epo
     :param optimizer: optimizer method(Adam is preferred)
     :param model_path: path to where save the model
     :param plot_dir: path to where save the plots
-    :param train_data: given training data
+    :param train_data: given training data: dict of batches or trajectory_data.TrajectoryDataset
     :param batch_size: batch size
     :param epochs: number of training epochs
     :param cuda: check if cuda is available
@@ -87,15 +89,6 @@ def train(net, env, optimizer, model_path, plot_dir, train_data, batch_size, epo
     epoch_losses = {'actor': []}
     perf_data = []
 
-    logger.info('Padding Sequences ...')
-    for batch_i, batch_seed in enumerate(batch_seeds):
-        data_obs, data_actions, _, data_len = train_data[batch_seed]
-        _max, _min = max(data_len), min(data_len)
-        _shape = data_obs[0][0].shape
-        for i in range(len(data_obs)):
-            data_obs[i] += [np.zeros(_shape)] * (_max - data_len[i])
-            data_actions[i] += [-1] * (_max - data_len[i])
-
     for epoch in range(epochs):
         net.train()
         batch_losses = {'actor': []}
@@ -0,0 +1,104 @@
+"""
+Background writing of image dumps, keeping disk I/O out of the policy loop.
+"""
+
+import os
+import logging
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def _imsave(path, image):
+    import scipy.misc
+    scipy.misc.imsave(path, image)
+
+
+class AsyncImageWriter():
+    """
+    Writes images on a pool of threads. At most max_pending images are queued: beyond that, write() blocks until a
+    slot frees up (backpressure), bounding the memory held by the queue. flush() waits for every queued image and
+    re-raises the first failure, so callers get a deterministic point (e.g. an episode end) after which all the images
+    are on disk.
+
+    Usage::
+
+        with AsyncImageWriter(workers=4) as writer:
+            for i, image in enumerate(images):
+                writer.write(os.path.join(image_dir, str(i) + '.jpg'), image)
+    """
+
+    def __init__(self, workers=4, max_pending=256, imsave=None):
+        """
+        :param workers: no. of writing threads
+        :param max_pending: max. no. of queued images
+        :param imsave: function(path, image) writing an image; defaults to scipy.misc.imsave
+        """
+        self.imsave = imsave if imsave is not None else _imsave
+        self.total_written = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._error = None
+        self._dirs = set()
+
+    def _write(self, path, image):
+        try:
+            self.imsave(path, image)
+            with self._lock:
+                self.total_written += 1
+        except Exception as e:
+            with self._lock:
+                if self._error is None:
+                    self._error = e
+        finally:
+            self._slots.release()
+
+    def write(self, path, image):
+        """
+        Queues the image to be written at the path (creating its directory); the image is copied, so the caller is
+        free to reuse it.
+        """
+        directory = os.path.dirname(path)
+        if directory and directory not in self._dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._dirs.add(directory)
+        image = np.array(image, copy=True)
+        self._slots.acquire()
+        future = self._executor.submit(self._write, path, image)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def flush(self):
+        """
+        Waits until all the queued images are written.
+        """
+        with self._lock:
+            pending = list(self._pending)
+        for future in pending:
+            future.result()
+        with self._lock:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
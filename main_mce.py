@@ -17,157 +17,10 @@ import traceback
 import gym, gym_x
 import fsm_process
 import tools as tl
-import torch.nn as nn
 from torch import optim
-from functions import TernaryTanh
 from torch.autograd import Variable
 from moore_machine import MooreMachine
-
-
-class ObsQBNet(nn.Module):
-    """
-    Quantized Bottleneck Network(QBN) for observation features
-    """
-    def __init__(self, input_size, x_features):
-        super(ObsQBNet, self).__init__()
-        self.bhx_size = x_features
-
-        f1 = int(8 * x_features)
-        self.encoder = nn.Sequential(nn.Linear(input_size, f1),
-                                     nn.Tanh(),
-                                     nn.Linear(f1, x_features),
-                                     TernaryTanh())
-
-        self.decoder = nn.Sequential(nn.Linear(x_features, f1),
-                                     nn.Tanh(),
-                                     nn.Linear(f1, input_size),
-                                     nn.ReLU6())
-
-
-    def forward(self, x):
-        encoded = self.encode(x)
-        decoded = self.decode(encoded)
-        return decoded, encoded
-
-    def encode(self, x):
-        return self.encoder(x)
-
-    def decode(self, x):
-        return self.decoder(x)
-
-
-class HxQBNet(nn.Module):
-    """
-    Quantized Bottleneck Network(QBN) for hidden states of GRU
-    """
-
-    def __init__(self, input_size, x_features):
-        super(HxQBNet, self).__init__()
-        self.bhx_size = x_features
-        f1 = int(8 * x_features)
-        self.encoder = nn.Sequential(nn.Linear(input_size, f1),
-                                     nn.Tanh(),
-                                     nn.Linear(f1, x_features),
-                                     TernaryTanh())
-
-        self.decoder = nn.Sequential(nn.Linear(x_features, f1),
-                                     nn.Tanh(),
-                                     nn.Linear(f1, input_size),
-                                     nn.Tanh())
-
-    def forward(self, x):
-        x = self.encode(x)
-        return self.decode(x), x
-
-    def encode(self, x):
-        return self.encoder(x)
-
-    def decode(self, x):
-        return self.decoder(x)
-
-
-class GRUNet(nn.Module):
-    """
-    Gated Recurrent Unit Network(GRUNet)  definition
-    """
-    def __init__(self, input_size, gru_cells, total_actions):
-        super(GRUNet, self).__init__()
-        self.gru_units = gru_cells
-        self.input_c_features = 4 * input_size
-        self.input_ff = nn.Sequential(nn.Linear(input_size, self.input_c_features), nn.ReLU())
-        self.gru = nn.GRUCell(self.input_c_features, gru_cells)
-        self.actor_linear = nn.Linear(gru_cells, total_actions)
-
-    def forward(self, input, input_fn=None, hx_fn=None, inspect=False):
-        input, hx = input
-        c_input = self.input_ff(input)
-        input, input_x = input_fn(c_input) if input_fn is not None else (c_input, c_input)
-        ghx = self.gru(input, hx)
-        hx, bhx = hx_fn(ghx) if hx_fn is not None else (ghx, ghx)
-
-        if inspect:
-            return None, self.actor_linear(hx), hx, (ghx, bhx, c_input, input_x)
-        else:
-            return None, self.actor_linear(hx), hx
-
-    def init_hidden(self, batch_size=1):
-        return torch.zeros(batch_size, self.gru_units)
-
-    def get_action_linear(self, state):
-        return self.actor_linear(state)
-
-    def transact(self, o_x, hx):
-        hx = self.gru(o_x, hx)
-        return hx
-
-
-class MMNet(nn.Module):
-    """
-    Moore Machine Network(MMNet) definition
-    """
-    def __init__(self, net, hx_qbn=None, obs_qbn=None):
-        super(MMNet, self).__init__()
-        self.bhx_units = hx_qbn.bhx_size if hx_qbn is not None else None
-        self.gru_units = net.gru_units
-        self.obx_net = obs_qbn
-        self.gru_net = net
-        self.bhx_net = hx_qbn
-        self.actor_linear = self.gru_net.get_action_linear
-
-    def init_hidden(self, batch_size=1):
-        return self.gru_net.init_hidden(batch_size)
-
-    def forward(self, x, inspect=False):
-        x, hx = x
-        critic, actor, hx, (ghx, bhx, input_c, input_x) = self.gru_net((x, hx), input_fn=self.obx_net,
-                                                                       hx_fn=self.bhx_net, inspect=True)
-        if inspect:
-            return critic, actor, hx, (ghx, bhx), (input_c, input_x)
-        else:
-            return critic, actor, hx
-
-    def get_action_linear(self, state, decode=False):
-        if decode:
-            hx = self.bhx_net.decode(state)
-        else:
-            hx = state
-        return self.actor_linear(hx)
-
-    def transact(self, o_x, hx_x):
-        hx_x = self.gru_net.transact(self.obx_net.decode(o_x), self.bhx_net.decode(hx_x))
-        _, hx_x = self.bhx_net(hx_x)
-        return hx_x
-
-    def state_encode(self, state):
-        return self.bhx_net.encode(state)
-
-    def obs_encode(self, obs, hx=None):
-        if hx is None:
-            hx = Variable(torch.zeros(1, self.gru_units))
-            if next(self.parameters()).is_cuda:
-                hx = hx.cuda()
-        _, _, _, (_, _, _, input_x) = self.gru_net((obs, hx), input_fn=self.obx_net, hx_fn=self.bhx_net, inspect=True)
-        return input_x
+from mce_nets import ObsQBNet, HxQBNet, GRUNet, MMNet
 
 
 if __name__ == '__main__':
@@ -200,7 +53,10 @@ if __name__ == '__main__':
     gru_prob_data_path = os.path.join(data_dir, 'gru_prob_data.p')
 
     try:
-        fsm_object = fsm_process.ProcessFSM(env)
+        make_env = tl.seeded_env_maker(lambda: gym.make(args.env), args.env_seed)
+        fsm_object = fsm_process.ProcessFSM(env, num_envs=args.rollout_envs, make_env=make_env,
+                                            workers=args.data_workers, env_seed=args.env_seed,
+                                            columnar=args.columnar_data)
         # ***********************************************************************************
         # Generating training data                                                          *
         # ***********************************************************************************
@@ -233,8 +89,12 @@ if __name__ == '__main__':
             if args.cuda:
                 gru_net = gru_net.cuda()
             gru_net.eval()
-            tl.generate_bottleneck_data(gru_net, env, args.bn_episodes, bottleneck_data_path, cuda=args.cuda, eps=(0, 0.3), max_steps=args.generate_max_steps)
-            tl.generate_trajectories(env, 3, 5, gru_prob_data_path, gru_net, cuda=args.cuda, render=True)
+            tl.generate_bottleneck_data(gru_net, env, args.bn_episodes, bottleneck_data_path, cuda=args.cuda,
+                                        eps=(0, 0.3), max_steps=args.generate_max_steps, num_envs=args.rollout_envs,
+                                        make_env=make_env, workers=args.data_workers, env_seed=args.env_seed)
+            tl.generate_trajectories(env, 3, 5, gru_prob_data_path, gru_net, cuda=args.cuda, render=True,
+                                     num_envs=args.rollout_envs, make_env=make_env, workers=args.data_workers,
+                                     env_seed=args.env_seed, columnar=args.columnar_data)
 
         # ***********************************************************************************
         # HX-QBN                                                                            *
@@ -259,7 +119,13 @@ if __name__ == '__main__':
             target_net = lambda bottle_net: MMNet(gru_net, hx_qbn=bottle_net)
 
             logging.info('Loading Data-Set')
-            hx_train_data, hx_test_data, _, _ = tl.generate_bottleneck_data(gru_net, env, args.bn_episodes, bottleneck_data_path, cuda=args.cuda, max_steps=args.generate_max_steps)
+            hx_train_data, hx_test_data, _, _ = tl.generate_bottleneck_data(gru_net, env, args.bn_episodes,
+                                                                            bottleneck_data_path, cuda=args.cuda,
+                                                                            max_steps=args.generate_max_steps,
+                                                                            num_envs=args.rollout_envs,
+                                                                            make_env=make_env,
+                                                                            workers=args.data_workers,
+                                                                            env_seed=args.env_seed)
             if args.bhx_train:
                 fsm_object.bhx_train(bhx_net, hx_train_data, hx_test_data, bhx_net_path, bhx_plot_dir, args.batch_size, args.train_epochs, args.cuda, target_net, bhx_dir)
             if args.bhx_test:
@@ -286,7 +152,12 @@ if __name__ == '__main__':
             logging.info('Reward Threshold:' + str(env.spec.reward_threshold))
             target_net = lambda bottle_net: MMNet(gru_net, obs_qbn=bottle_net)
             logging.info('Loading Data-Set ...')
-            _, _, obs_train_data, obs_test_data = tl.generate_bottleneck_data(gru_net, env, args.bn_episodes, bottleneck_data_path, cuda=args.cuda)
+            _, _, obs_train_data, obs_test_data = tl.generate_bottleneck_data(gru_net, env, args.bn_episodes,
+                                                                              bottleneck_data_path, cuda=args.cuda,
+                                                                              num_envs=args.rollout_envs,
+                                                                              make_env=make_env,
+                                                                              workers=args.data_workers,
+                                                                              env_seed=args.env_seed)
             if args.ox_train:
                 fsm_object.ox_train(ox_net, obs_train_data, obs_test_data, ox_net_path, ox_plot_dir, args.batch_size, args.train_epochs, args.cuda, target_net, ox_dir)
             if args.ox_test:
@@ -334,9 +205,11 @@ if __name__ == '__main__':
             if args.bgru_test:
                 fsm_object.bgru_test(bgru_net, bgru_net_path, args.cuda)
             if args.generate_fsm:
-                fsm_object.generate_fsm(bgru_net, bgru_net_path, args.cuda, unmin_moore_machine_path, bgru_dir, min_moore_machine_path)
+                fsm_object.generate_fsm(bgru_net, bgru_net_path, args.cuda, unmin_moore_machine_path, bgru_dir, min_moore_machine_path,
+                                        workers=args.fsm_workers, profile=args.profile,
+                                        frames_per_code=args.frames_per_code)
             if args.evaluate_fsm:
-                fsm_object.evaluate_fsm(bgru_net, bgru_net_path, min_moore_machine_path)
+                fsm_object.evaluate_fsm(bgru_net, bgru_net_path, min_moore_machine_path, profile=args.profile)
         env.close()
     except Exception as ex:
         logging.error(''.join(traceback.format_exception(etype=type(ex), value=ex, tb=ex.__traceback__)))
\ No newline at end of file
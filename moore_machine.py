@@ -1,39 +1,269 @@
 import os
+import csv
+import copy
 import torch
 import random
 import scipy.misc
+import scipy.sparse
 import numpy as np
 import logging, sys
+import multiprocessing
 from collections import deque
 import torch.nn.functional as F
 from prettytable import PrettyTable
 from torch.autograd import Variable
+from fsm_runtime import FSMRuntime, ObsEncoder
+from functions import TernaryTanh
+from fsm_tables import CodeRegistry, FrameStore, ObsCodeCache, TrajectoryLog, TransitionTable
+from image_writer import AsyncImageWriter
+from profiling import PhaseProfiler
+from video import Montage, VideoWriter, text_image
 from tools import ensure_directory_exits
-from PIL import Image, ImageFont, ImageDraw
 
 import pickle
 
 logger = logging.getLogger(__name__)
+_NO_PROFILER = PhaseProfiler(enabled=False)
+
+# environment and network of a rollout worker process (see MooreMachine._rollouts)
+_worker = {}
+
+
+def _init_rollout_worker(env, net, cache_capacity):
+    torch.set_num_threads(1)
+    _worker['env'] = env
+    _worker['net'] = net
+    _worker['obs_cache'] = ObsCodeCache(cache_capacity) if cache_capacity is not None else None
+    _worker['code_keys'] = MooreMachine._code_registries(net)
+
+
+def _rollout_worker(seed):
+    ep_log = MooreMachine._rollout(_worker['env'], _worker['net'], seed, _worker['code_keys'],
+                                   obs_cache=_worker['obs_cache'])
+    # only the codecs of the worker's registries (not their storage) are sent back along with the keys
+    ep_log['obs_keys'], ep_log['state_keys'] = [code_keys.key_codec() for code_keys in _worker['code_keys']]
+    return ep_log
+
+
+def _refine_partition(matrix, blocks):
+    """
+    Coarsest refinement of a partition of states that is stable under the transition function (Hopcroft's algorithm
+    on a refinable partition, as described by Valmari & Lehtinen); runs in O(m log n) for m transitions.
+
+    :param matrix: int array of shape (states, observations) holding the next state of every transition
+    :param blocks: int array of the initial block of every state (block ids 0..k-1)
+    :return: int array of the final block of every state; blocks of the initial partition keep their id
+    """
+    total_states, total_obs = matrix.shape
+    blocks = np.asarray(blocks, dtype=np.int64)
+    total_blocks = int(blocks.max()) + 1 if total_states > 0 else 0
+
+    # predecessors of every state under each observation
+    predecessors = []
+    for o in range(total_obs):
+        order = np.argsort(matrix[:, o], kind='mergesort')
+        starts = np.searchsorted(matrix[order, o], np.arange(total_states + 1))
+        predecessors.append((order.tolist(), starts.tolist()))
+
+    # states are kept in an array where each block is contiguous; the marked states of a block precede its unmarked
+    elems = np.argsort(blocks, kind='mergesort').tolist()
+    loc = [0] * total_states
+    for i, s in enumerate(elems):
+        loc[s] = i
+    block_of = blocks.tolist()
+    sizes = np.bincount(blocks, minlength=total_blocks).tolist()
+    first = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(np.int64).tolist()
+    end = np.cumsum(sizes).astype(np.int64).tolist()
+    mid = list(first)
+
+    # every initial block but the largest one is a splitter
+    largest = int(np.argmax(sizes)) if total_blocks > 0 else None
+    waiting = deque((b, o) for b in range(total_blocks) if b != largest for o in range(total_obs))
+    in_waiting = set(waiting)
+
+    while waiting:
+        splitter = waiting.popleft()
+        in_waiting.discard(splitter)
+        b, o = splitter
+        order, starts = predecessors[o]
+
+        # mark the predecessors of the splitter
+        touched = []
+        for t in elems[first[b]:end[b]]:
+            for s in order[starts[t]:starts[t + 1]]:
+                bs = block_of[s]
+                i, j = loc[s], mid[bs]
+                if i >= j:
+                    if j == first[bs]:
+                        touched.append(bs)
+                    elems[i], elems[j] = elems[j], s
+                    loc[elems[i]], loc[s] = i, j
+                    mid[bs] = j + 1
+
+        # split the touched blocks into their marked and unmarked states
+        for bs in touched:
+            if mid[bs] == end[bs]:
+                mid[bs] = first[bs]
+                continue
+            nb = len(first)
+            first.append(first[bs])
+            end.append(mid[bs])
+            mid.append(first[bs])
+            first[bs] = mid[bs]
+            for s in elems[first[nb]:end[nb]]:
+                block_of[s] = nb
+            smaller = nb if end[nb] - first[nb] <= end[bs] - first[bs] else bs
+            for _o in range(total_obs):
+                if (bs, _o) in in_waiting:
+                    added = (nb, _o)
+                else:
+                    added = (smaller, _o)
+                waiting.append(added)
+                in_waiting.add(added)
+
+    return np.array(block_of, dtype=np.int64)
+
+
+def _compatible_pairs(matrix, actions, chunk_size=1 << 20):
+    """
+    Pairwise compatibility of the states of a partially specified machine: two states are compatible if they have the
+    same action and, for every observation known for both of them, they move to the same or to compatible states.
+
+    Incompatibility is propagated to a fixed point along the reversed transitions: every newly incompatible pair
+    (a, b) makes the pairs of its predecessors (s, k) under a common observation incompatible. The work is thus
+    proportional to the number of (pair, observation) edges reaching incompatible pairs; all pairs that are never
+    reached are compatible.
+
+    :param matrix: int array of shape (states, observations) holding the next state of every transition (-1: unknown)
+    :param actions: array of the action of every state
+    :param chunk_size: max. number of incompatible pairs expanded at once
+    :return: symmetric boolean matrix of shape (states, states)
+    """
+    total_states, total_obs = matrix.shape
+    actions = np.asarray(actions)
+    compatible = actions[:, None] == actions[None, :]
+
+    # predecessors of every state under each observation, as (states sorted by next state, offsets, counts)
+    predecessors = []
+    for o in range(total_obs):
+        col = matrix[:, o]
+        known = np.nonzero(col >= 0)[0]
+        order = known[np.argsort(col[known], kind='mergesort')]
+        counts = np.bincount(col[known], minlength=total_states)
+        offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        predecessors.append((order, offsets, counts))
+
+    # worklist of the incompatible pairs (a, b), a < b, whose predecessors are still to be visited
+    frontier_a, frontier_b = np.nonzero(np.triu(~compatible, k=1))
+    while len(frontier_a) > 0:
+        next_a, next_b = [], []
+        for r in range(0, len(frontier_a), chunk_size):
+            a, b = frontier_a[r:r + chunk_size], frontier_b[r:r + chunk_size]
+            for order, offsets, counts in predecessors:
+                # all pairs (s, k) of predecessors of (a, b) under the observation
+                pairs = counts[a] * counts[b]
+                known = np.nonzero(pairs)[0]
+                if len(known) == 0:
+                    continue
+                pairs = pairs[known]
+                pair_i = np.repeat(known, pairs)
+                offset = np.arange(pairs.sum()) - np.repeat(np.cumsum(pairs) - pairs, pairs)
+                k_counts = counts[b[pair_i]]
+                s = order[offsets[a[pair_i]] + offset // k_counts]
+                k = order[offsets[b[pair_i]] + offset % k_counts]
+
+                s, k = np.minimum(s, k), np.maximum(s, k)
+                new = (s != k) & compatible[s, k]
+                # a pair may be reached from several pairs at once; it is queued only once
+                new_pairs = np.unique(s[new] * total_states + k[new])
+                s, k = new_pairs // total_states, new_pairs % total_states
+                compatible[s, k] = False
+                compatible[k, s] = False
+                next_a.append(s)
+                next_b.append(k)
+        if len(next_a) == 0:
+            break
+        frontier_a, frontier_b = np.concatenate(next_a), np.concatenate(next_b)
+    return compatible
+
+
+def _group_compatible_states(compatibility_mat):
+    """
+    Greedy clique cover of the compatibility graph: states are visited in order and every unassigned state starts a
+    group, which is then extended by each later unassigned state compatible with all the members so far. The
+    candidates of a group are tracked by a boolean mask (AND of the compatibility rows of its members), so no
+    recursion is involved and memory stays O(states).
+
+    :param compatibility_mat: symmetric boolean matrix of pairwise state compatibility
+    :return: list of groups (lists of state indices); every state belongs to exactly one group
+    """
+    total_states = len(compatibility_mat)
+    assigned = np.zeros(total_states, dtype=bool)
+    groups = []
+    for s in range(total_states):
+        if assigned[s]:
+            continue
+        group = [s]
+        candidates = compatibility_mat[s] & ~assigned
+        candidates[:s + 1] = False
+        for x in np.nonzero(candidates)[0].tolist():
+            if candidates[x]:
+                group.append(x)
+                candidates &= compatibility_mat[x]
+        assigned[group] = True
+        groups.append(group)
+    return groups
+
+
+def _numpy_layers(modules):
+    """
+    Converts the modules of an observation encoder (see MMNet.obs_encoder_layers) into ObsEncoder layers.
+    """
+    activations = [(torch.nn.ReLU6, 'relu6'), (torch.nn.ReLU, 'relu'), (torch.nn.Tanh, 'tanh'),
+                   (TernaryTanh, 'ternary_tanh')]
+    layers = []
+    for module in modules:
+        if module == 'flatten':
+            layers.append({'type': 'flatten'})
+        elif isinstance(module, torch.nn.Linear):
+            layers.append({'type': 'linear', 'weight': module.weight.detach().cpu().numpy(),
+                           'bias': module.bias.detach().cpu().numpy()})
+        elif isinstance(module, torch.nn.Conv2d):
+            if module.dilation != (1, 1) or module.groups != 1:
+                raise ValueError('Only plain convolutions can be exported: {}'.format(module))
+            layers.append({'type': 'conv2d', 'weight': module.weight.detach().cpu().numpy(),
+                           'bias': module.bias.detach().cpu().numpy(), 'stride': list(module.stride),
+                           'padding': list(module.padding)})
+        else:
+            for module_type, name in activations:
+                if isinstance(module, module_type):
+                    layers.append({'type': name})
+                    break
+            else:
+                raise ValueError('Cannot export module of the observation encoder: {}'.format(module))
+    return layers
 
-sys.setrecursionlimit(3000)
 
 class MooreMachine:
     """
     Moore Machine Network definition
     """
 
-    def __init__(self, t={}, sd={}, ss=np.array([]), os=np.array([]), start_state=0, total_actions=None):
-        self.transaction = t
-        self.state_desc = sd
-        self.state_space = ss
-        self.obs_space = os
+    def __init__(self, t=None, sd=None, ss=np.array([]), os=np.array([]), start_state=0, total_actions=None, dense=False):
+        # fresh containers per machine: shared defaults would leak the tables of one machine into the next
+        self.transaction = TransitionTable() if dense else (t if t is not None else {})
+        self.state_desc = sd if sd is not None else {}
+        self.state_registry = CodeRegistry(ss)
+        self.obs_registry = CodeRegistry(os)
         self.start_state = start_state
         self.minimized = False
         self.obs_minobs_map = None
         self.minobs_obs_map = None
         self.frequency = None
         self.trajectory = None
+        self.inspect_labels = None
         self.total_actions = total_actions
+        self.frame_store = None
 
     def __str__(self):
 
@@ -48,26 +278,29 @@ class MooreMachine:
         msg += '***********************************************'
         return msg
 
-    @staticmethod
-    def _get_index(source, item, force=True):
-        """
-        Returns index of the item in the source.
-
-        :param source: np-array comprising of unique elements (set)
-        :param item: target item(array)
-        :param force: if True: In case item not found; it will add the item and return the corresponding index
-        """
-        _index = np.where(np.all(source == item, axis=1))[0] if len(source) != 0 else []
-        if len(_index) != 0:
-            _index = _index[0]
-        elif force:
-            source = source.tolist()
-            source.append(item)
-            source = np.array(source)
-            _index = len(source) - 1
-        else:
-            _index = None
-        return source, _index
+    def __setstate__(self, state):
+        # machines pickled before the registries were introduced carry plain state/obs arrays
+        for space, registry in [('state_space', 'state_registry'), ('obs_space', 'obs_registry')]:
+            if registry not in state:
+                codes = np.asarray(state.pop(space, []))
+                state[registry] = CodeRegistry(codes if codes.dtype.kind in 'biuf' else None)
+        self.__dict__.update(state)
+
+    @property
+    def state_space(self):
+        return self.state_registry.codes
+
+    @state_space.setter
+    def state_space(self, codes):
+        self.state_registry = CodeRegistry(codes)
+
+    @property
+    def obs_space(self):
+        return self.obs_registry.codes
+
+    @obs_space.setter
+    def obs_space(self, codes):
+        self.obs_registry = CodeRegistry(codes)
 
     def _update_info(self, obs, curr_state, next_state, curr_action, next_action):
         """
@@ -80,23 +313,33 @@ class MooreMachine:
         :param next_action: next action of the environment
         :return: each state's index and a set of states and observations
         """
-        self.obs_space, obs_index = self._get_index(self.obs_space, obs)
+        obs_index = self.obs_registry.add(obs)
         state_indices = []
         new_entries = []
         for state_info in [(curr_state, curr_action), (next_state, next_action)]:
             state, _action = state_info
-            self.state_space, state_index = self._get_index(self.state_space, state)
+            state_index = self.state_registry.add(state)
             if state_index not in self.state_desc:
                 self.state_desc[state_index] = {'action': str(_action), 'description': state}
             if self.state_desc[state_index]['action'] == str(None) and _action is not None:
                 self.state_desc[state_index]['action'] = str(_action)
             state_indices.append(state_index)
+
+        if isinstance(self.transaction, TransitionTable):
+            new_states = self.transaction.resize(len(self.state_registry), len(self.obs_registry))
+            new_entries += [(s_i, o_i) for s_i in new_states for o_i in range(len(self.obs_registry))]
+            for s_i, _action in zip(state_indices, [curr_action, next_action]):
+                if _action is not None:
+                    self.transaction.actions[s_i] = _action
+            self.transaction.set(state_indices[0], obs_index, state_indices[1])
+            return state_indices, new_entries
+
         for s_i in state_indices:
             if s_i not in self.transaction:
-                self.transaction[s_i] = {_: None for _ in range(len(self.obs_space))}
-                new_entries += [(s_i, _) for _ in range(len(self.obs_space))]
+                self.transaction[s_i] = {_: None for _ in range(len(self.obs_registry))}
+                new_entries += [(s_i, _) for _ in range(len(self.obs_registry))]
             elif obs_index not in self.transaction[s_i]:
-                for o_i in range(len(self.obs_space)):
+                for o_i in range(len(self.obs_registry)):
                     if o_i not in self.transaction[s_i]:
                         self.transaction[s_i][o_i] = None
                         if s_i != state_indices[0] and o_i != obs_index:
@@ -105,140 +348,273 @@ class MooreMachine:
 
         return state_indices, new_entries
 
-    def extract_from_nn(self, env, net, episodes, seed=0, log=True, render=False, partial=False, cuda=False):
+    @staticmethod
+    def _code_registries(net):
         """
-        Extract Finite State Moore Machine Network(MMNet) from a BottleNeck Gated Recurrent Unit Network(BGRUNet).
+        Empty registries of the observation and the state codes of the network: codes are packed only when a QBN
+        quantizes them, as without one (e.g. an MMNet with no observation QBN) they are the real valued features.
+
+        :return: pair of CodeRegistry (observations, states)
+        """
+        return (CodeRegistry(packed=getattr(net, 'obx_net', None) is not None),
+                CodeRegistry(packed=getattr(net, 'bhx_net', None) is not None))
+
+    @staticmethod
+    def _rollout(env, net, seed, code_keys, render=False, cuda=False, obs_cache=None, max_actions=10000,
+                 profiler=None):
+        """
+        Plays an episode with the network and logs its transactions in terms of packed codes.
 
         :param env: the environment where agent is in
         :param net: BottleNeck GRUNet
-        :param episodes: number of episodes
-        :param log: check to print out logs
+        :param seed: seed of the episode
+        :param code_keys: pair of CodeRegistry used to pack (and unpack) the observation and the state codes
         :param render: check to render environment
         :param cuda: check if cuda is available
+        :param obs_cache: ObsCodeCache used to skip encoding repeated frames
+        :param max_actions: maximum length of the episode
+        :param profiler: PhaseProfiler timing the phases of the episode
+        :return: episode log; a dict of the transactions (obs, curr_state, next_state, curr_action, next_action), every
+                 distinct frame (keyed by its digest) along with its packed code and the episode reward
         """
-        self.obs2encoding = {}
-        net.eval()
-        max_actions = 10000
-        random.seed(seed)
-        self.total_actions = int(env.action_space.n)
-        x = set([])
+        obs_keys, state_keys = code_keys
+        profiler = profiler if profiler is not None else _NO_PROFILER
+        steps, frames = [], {}
         with torch.no_grad():
-
-            # collect all unique transactions
-            all_ep_rewards = []
-            for ep in range(episodes):
-                done = False
+            done = False
+            with profiler.phase('env'):
+                if hasattr(env, 'seed'):
+                    env.seed(seed)
                 obs = env.reset()
+            with profiler.phase('encode'):
                 curr_state = Variable(net.init_hidden())
                 if cuda:
                     curr_state = curr_state.cuda()
                 curr_state_x = net.state_encode(curr_state)
-                ep_reward = 0
-                ep_actions = []
-                while not done:
-                    if render:
+            ep_reward = 0
+            ep_actions = []
+            while not done:
+                if render:
+                    with profiler.phase('render'):
                         env.render()
+                with profiler.phase('transact'):
                     curr_action = net.get_action_linear(curr_state_x, decode=True)
                     prob = F.softmax(curr_action, dim=1)
+                with profiler.phase('copy'):
                     curr_action = int(prob.max(1)[1].cpu().data.numpy()[0])
+                with profiler.phase('registry'):
+                    frame_key = FrameStore.digest(obs)
+                    obs_x_key = obs_cache.get(frame_key) if obs_cache is not None else None
+                with profiler.phase('copy'):
+                    frame = obs
                     obs = Variable(torch.Tensor(obs)).unsqueeze(0)
                     if cuda:
                         obs = obs.cuda()
-                    critic, logit, next_state, (next_state_c, next_state_x), (_, obs_x) = net((obs, curr_state),
-                                                                                              inspect=True)
-                    obs_tp = tuple(obs.detach().cpu().numpy().flat)
-                    obs_x_tp = tuple(obs_x.detach().cpu().numpy().flat)
-                    if obs_tp in self.obs2encoding:
-                        assert self.obs2encoding[obs_tp] == obs_x_tp
-                    self.obs2encoding[obs_tp] = obs_x_tp
+                if obs_x_key is None:
+                    with profiler.phase('encode'):
+                        critic, logit, next_state, (next_state_c, next_state_x), (_, obs_x) = net((obs, curr_state),
+                                                                                                  inspect=True)
+                    with profiler.phase('copy'):
+                        obs_x = obs_x.detach().cpu().numpy()[0]
+                    with profiler.phase('registry'):
+                        obs_x_key = obs_keys.key(obs_x)
+                else:
+                    # repeated frame: step the network from the cached observation code
+                    with profiler.phase('copy'):
+                        obs_x = torch.FloatTensor(obs_keys.decode_key(obs_x_key)).unsqueeze(0)
+                        if cuda:
+                            obs_x = obs_x.cuda()
+                    with profiler.phase('transact'):
+                        logit, next_state, next_state_x = net.obs_transact(obs_x, curr_state)
+                    profiler.count('cached_frames')
+                with profiler.phase('copy'):
                     prob = F.softmax(logit, dim=1)
                     next_action = int(prob.max(1)[1].cpu().data.numpy())
-
-                    self._update_info(obs_x.cpu().data.numpy()[0], curr_state_x.cpu().data.numpy()[0],
-                                      next_state_x.cpu().data.numpy()[0], curr_action, next_action)
+                    curr_state_x_np = curr_state_x.cpu().data.numpy()[0]
+                    next_state_x_np = next_state_x.cpu().data.numpy()[0]
+                with profiler.phase('bookkeeping'):
+                    if frame_key in frames:
+                        assert frames[frame_key][1] == obs_x_key
+                    else:
+                        frames[frame_key] = (np.array(frame), obs_x_key)
+                with profiler.phase('registry'):
+                    steps.append((obs_x_key, state_keys.key(curr_state_x_np), state_keys.key(next_state_x_np),
+                                  curr_action, next_action))
+                    if obs_cache is not None:
+                        obs_cache.put(frame_key, obs_x_key)
+                with profiler.phase('env'):
                     obs, reward, done, _ = env.step(next_action)
+                profiler.count('steps')
 
-                    done = done if len(ep_actions) <= max_actions else True
-                    ep_actions.append(next_action)
-                    # a quick hack to prevent the agent from stucking
-                    max_same_action = 5000
-                    if len(ep_actions) > max_same_action:
-                        actions_to_consider = ep_actions[-max_same_action:]
-                        if actions_to_consider.count(actions_to_consider[0]) == max_same_action:
-                            done = True
-                    curr_state = next_state
-                    curr_state_x = next_state_x
-                    ep_reward += reward
-                    x.add(''.join([str(int(i)) for i in next_state.cpu().data.numpy()[0]]))
-                if log:
-                    logger.info('Episode:{} Reward: {} '.format(ep, ep_reward))
-                all_ep_rewards.append(ep_reward)
+                done = done if len(ep_actions) <= max_actions else True
+                ep_actions.append(next_action)
+                # a quick hack to prevent the agent from stucking
+                max_same_action = 5000
+                if len(ep_actions) > max_same_action:
+                    actions_to_consider = ep_actions[-max_same_action:]
+                    if actions_to_consider.count(actions_to_consider[0]) == max_same_action:
+                        done = True
+                curr_state = next_state
+                curr_state_x = next_state_x
+                ep_reward += reward
+
+        return {'steps': steps, 'frames': frames, 'reward': ep_reward, 'obs_keys': obs_keys,
+                'state_keys': state_keys}
+
+    @staticmethod
+    def _rollouts(env, net, episodes, seed, render=False, cuda=False, obs_cache=None, workers=1, profiler=None):
+        """
+        Yields the logs (see _rollout) of the episodes in order; episode i is seeded by seed + i. Episodes played by
+        worker processes are not profiled.
+        """
+        seeds = [seed + ep for ep in range(episodes)]
+        if workers <= 1 or episodes <= 1:
+            code_keys = MooreMachine._code_registries(net)
+            for ep_seed in seeds:
+                yield MooreMachine._rollout(env, net, ep_seed, code_keys, render, cuda, obs_cache, profiler=profiler)
+            return
+
+        # workers are forked, so they inherit the env and the network copy without pickling them
+        worker_net = copy.deepcopy(net).cpu()
+        cache_capacity = obs_cache.capacity if obs_cache is not None else None
+        context = multiprocessing.get_context('fork')
+        with context.Pool(min(workers, episodes), initializer=_init_rollout_worker,
+                          initargs=(env, worker_net, cache_capacity)) as pool:
+            for ep_log in pool.imap(_rollout_worker, seeds):
+                yield ep_log
+
+    def _merge_rollout(self, ep_log, profiler=_NO_PROFILER):
+        """
+        Records the transactions of an episode log (see _rollout) in the order they were taken.
+        """
+        obs_keys, state_keys = ep_log['obs_keys'], ep_log['state_keys']
+        with profiler.phase('registry'):
+            for obs_x_key, curr_state_key, next_state_key, curr_action, next_action in ep_log['steps']:
+                self._update_info(obs_keys.decode_key(obs_x_key), state_keys.decode_key(curr_state_key),
+                                  state_keys.decode_key(next_state_key), curr_action, next_action)
+        with profiler.phase('bookkeeping'):
+            for frame_key, (frame, obs_x_key) in ep_log['frames'].items():
+                self.frame_store.add(frame, obs_x_key, digest=frame_key)
+
+    def extract_from_nn(self, env, net, episodes, seed=0, log=True, render=False, partial=False, cuda=False,
+                        obs_cache=None, workers=1, profiler=None, frames_per_code=None):
+        """
+        Extract Finite State Moore Machine Network(MMNet) from a BottleNeck Gated Recurrent Unit Network(BGRUNet).
 
+        :param env: the environment where agent is in
+        :param net: BottleNeck GRUNet
+        :param episodes: number of episodes
+        :param seed: seed of the first episode; episode i is played with env seeded by seed + i, in serial runs as
+                     well as in parallel ones
+        :param log: check to print out logs
+        :param render: check to render environment
+        :param cuda: check if cuda is available
+        :param obs_cache: ObsCodeCache used to skip encoding repeated frames
+        :param workers: number of processes playing the episodes; each of them steps its own copy of the env and a
+                        CPU copy of the network. The extracted machine is identical to the one of a serial run.
+        :param profiler: PhaseProfiler timing the phases (env, encode, transact, registry, copy, bookkeeping,
+                         render) of the extraction
+        :param frames_per_code: max. no. of sample frames kept per observation code (in frame_store, for analysis);
+                                all of them if None
+        """
+        profiler = profiler if profiler is not None else _NO_PROFILER
+        self.frame_store = FrameStore(per_code=frames_per_code, seed=seed)
+        net.eval()
+        random.seed(seed)
+        self.total_actions = int(env.action_space.n)
+        obs_registry, state_registry = self._code_registries(net)
+        if len(self.obs_registry) == 0:
+            self.obs_registry = obs_registry
+        if len(self.state_registry) == 0:
+            self.state_registry = state_registry
+
+        # collect all unique transactions
+        all_ep_rewards = []
+        for ep, ep_log in enumerate(self._rollouts(env, net, episodes, seed, render, cuda, obs_cache, workers,
+                                                   profiler)):
+            self._merge_rollout(ep_log, profiler)
+            profiler.end_episode(episode=ep, reward=ep_log['reward'], steps=len(ep_log['steps']))
             if log:
-                logger.info('Average Reward:{}'.format(np.average(all_ep_rewards)))
+                logger.info('Episode:{} Reward: {} '.format(ep, ep_log['reward']))
+            all_ep_rewards.append(ep_log['reward'])
+
+        if log:
+            logger.info('Average Reward:{}'.format(np.average(all_ep_rewards)))
+            if obs_cache is not None and workers <= 1:
+                logger.info(obs_cache)
 
         if not partial:
             # find missing entries in the transaction table
             unknowns = []
-            for curr_state_i in self.state_desc.keys():
-                if curr_state_i in self.transaction:
-                    for obs_i in range(len(self.obs_space)):
-                        if (obs_i not in self.transaction[curr_state_i]) or (
-                                self.transaction[curr_state_i][obs_i] is None):
-                            unknowns.append((curr_state_i, obs_i))
-                else:
-                    unknowns += [(curr_state_i, i) for i in range(len(self.obs_space))]
-
-            # fill information for the missing transactions
-            done = False
-            while not done:
-                done = True
-                for i, (state_i, obs_i) in enumerate(unknowns):
-                    state_x = self.state_desc[state_i]['description']
-                    state_x = Variable(torch.FloatTensor(state_x).unsqueeze(0))
-
-                    obs_x = self.obs_space[obs_i]
-                    obs_x = torch.FloatTensor(obs_x).unsqueeze(0)
-                    obs_x = Variable(obs_x)
-
-                    if cuda:
-                        state_x, obs_x = state_x.cuda(), obs_x.cuda()
-
-                    curr_action = net.get_action_linear(state_x, decode=True)
-                    prob = F.softmax(curr_action, dim=1)
-                    curr_action = int(prob.max(1)[1].cpu().data.numpy()[0])
-
-                    next_state_x = net.transact(obs_x, state_x)
-                    next_action = net.get_action_linear(next_state_x, decode=True)
-                    prob = F.softmax(next_action, dim=1)
-                    next_action = int(prob.max(1)[1].cpu().data.numpy()[0])
-
-                    next_state_x = next_state_x.cpu().data.numpy()[0]
-                    state_x = state_x.cpu().data.numpy()[0]
-                    obs_x = obs_x.cpu().data.numpy()[0]
-                    state_indices, new_entries = self._update_info(obs_x, state_x, next_state_x, curr_action,
-                                                                   next_action)
-                    unknowns.pop(i)
-
-                    if len(new_entries) > 0:
-                        unknowns += new_entries
-                        logger.info('New Unknown State-Trasactions: {}'.format(new_entries))
-                    x.add(''.join([str(int(i)) for i in next_state_x]))
-                    done = False
-                    break
+            if isinstance(self.transaction, TransitionTable):
+                unknowns = self.transaction.unknowns()
+            else:
+                for curr_state_i in self.state_desc.keys():
+                    if curr_state_i in self.transaction:
+                        for obs_i in range(len(self.obs_registry)):
+                            if (obs_i not in self.transaction[curr_state_i]) or (
+                                    self.transaction[curr_state_i][obs_i] is None):
+                                unknowns.append((curr_state_i, obs_i))
+                    else:
+                        unknowns += [(curr_state_i, i) for i in range(len(self.obs_registry))]
+
+            # fill information for the missing transactions; the pending ones form a frontier which is expanded
+            # with a single forward pass per batch and the transactions it reveals form the next frontier
+            frontier_batch = 4096
+            while len(unknowns) > 0:
+                _unknowns = []
+                for b_i in range(0, len(unknowns), frontier_batch):
+                    batch = [(s_i, o_i) for s_i, o_i in unknowns[b_i:b_i + frontier_batch]
+                             if s_i not in self.transaction or self.transaction[s_i].get(o_i) is None]
+                    if len(batch) == 0:
+                        continue
+                    states_i, obs_i = zip(*batch)
+                    with profiler.phase('copy'):
+                        state_x = np.array([self.state_desc[s_i]['description'] for s_i in states_i])
+                        state_x = Variable(torch.FloatTensor(state_x))
+                        obs_x = Variable(torch.FloatTensor(self.obs_registry.take(obs_i)))
+                        if cuda:
+                            state_x, obs_x = state_x.cuda(), obs_x.cuda()
+
+                    with torch.no_grad(), profiler.phase('transact'):
+                        curr_action = net.get_action_linear(state_x, decode=True)
+                        curr_action = F.softmax(curr_action, dim=1).max(1)[1].cpu().data.numpy()
+
+                        next_state_x = net.transact(obs_x, state_x)
+                        next_action = net.get_action_linear(next_state_x, decode=True)
+                        next_action = F.softmax(next_action, dim=1).max(1)[1].cpu().data.numpy()
+
+                    with profiler.phase('copy'):
+                        next_state_x = next_state_x.cpu().data.numpy()
+                        state_x = state_x.cpu().data.numpy()
+                        obs_x = obs_x.cpu().data.numpy()
+                    with profiler.phase('registry'):
+                        for i in range(len(batch)):
+                            _, new_entries = self._update_info(obs_x[i], state_x[i], next_state_x[i],
+                                                               int(curr_action[i]), int(next_action[i]))
+                            _unknowns += new_entries
+                    profiler.count('filled_transitions', len(batch))
+                unknowns = _unknowns
+                if len(unknowns) > 0:
+                    logger.info('New Unknown State-Trasactions: {}'.format(len(unknowns)))
 
         # find index of the start_state
         start_state = Variable(net.init_hidden())
         if cuda:
             start_state = start_state.cuda()
         start_state_x = net.state_encode(start_state).data.cpu().numpy()[0]
-        _, self.start_state = self._get_index(self.state_space, start_state_x, force=False)
+        self.start_state = self.state_registry.get(start_state_x)
 
+        # mappings from the ids of the frames in frame_store
+        self.obs2encoding = dict(self.frame_store.items())
         self.obs2unmin = {}
-        for obs, obs_x in self.obs2encoding.items():
-            _, idx = self._get_index(self.obs_space, obs_x, force=False)
+        for frame_id, obs_x_key in self.obs2encoding.items():
+            idx = self.obs_registry.get_key(obs_x_key)
             assert idx is not None
-            self.obs2unmin[obs] = idx
+            self.obs2unmin[frame_id] = idx
+
+        if log and profiler.enabled:
+            logger.info(profiler)
 
     def map_action(self, net, s_i, obs_i):
         """
@@ -252,7 +628,7 @@ class MooreMachine:
         state_x = self.state_desc[s_i]['description']
         state_x = Variable(torch.FloatTensor(state_x).unsqueeze(0))
 
-        obs_x = self.obs_space[obs_i]
+        obs_x = self.obs_registry[obs_i]
         obs_x = torch.FloatTensor(obs_x).unsqueeze(0)
         obs_x = Variable(obs_x)
         next_state_x = net.transact(obs_x, state_x)
@@ -267,88 +643,25 @@ class MooreMachine:
 
         :param net: given network
         """
-        _states = sorted(self.transaction.keys())
-        compatibility_mat = {s: {p: False if self.state_desc[s]['action'] != self.state_desc[p]['action'] else None
-                                 for p in _states[:i + 1]}
-                             for i, s in enumerate(_states[1:])}
-        unknowns = []
-        for s in compatibility_mat.keys():
-            for k in compatibility_mat[s].keys():
-                if compatibility_mat[s][k] is None:
-                    unknowns.append((s, k))
-
-        unknown_lengths = deque(maxlen=1000)
-        while len(unknowns) != 0:
-            # next 3 lines are experimental
-            if len(unknown_lengths) > 0 and unknown_lengths.count(unknown_lengths[0]) == unknown_lengths.maxlen:
-                s, k = unknowns[-1]
-                compatibility_mat[s][k] = True
-
-            s, k = unknowns.pop(0)
-            if compatibility_mat[s][k] is None:
-                compatibility_mat[s][k] = []
-                for obs_i in range(len(self.obs_space)):
-                    if (obs_i not in self.transaction[s]) or (self.transaction[s][obs_i] is None) or \
-                            (obs_i not in self.transaction[k]) or (self.transaction[k][obs_i] is None):
-                        pass
-                    else:
-                        next_s, next_k = self.transaction[s][obs_i], self.transaction[k][obs_i]
-                        action_next_s = self.state_desc[next_s]['action']
-                        action_next_k = self.state_desc[next_k]['action']
-                        # if next_s != next_k and next_k != k and next_s != s:
-                        if next_s != next_k and not (next_k == k and next_s == s):
-                            if action_next_s != action_next_k:
-                                compatibility_mat[s][k] = False
-                                break
-                            first, sec = sorted([next_k, next_s])[::-1]
-                            if type(compatibility_mat[first][sec]).__name__ == 'bool' and not \
-                                    compatibility_mat[first][sec]:
-                                compatibility_mat[s][k] = False
-                                break
-                            elif compatibility_mat[first][sec] is None or \
-                                    type(compatibility_mat[first][sec]).__name__ != 'bool':
-                                compatibility_mat[s][k].append((first, sec))
-
-            elif type(compatibility_mat[s][k]).__name__ != 'bool':
-                for i, (m, n) in enumerate(compatibility_mat[s][k]):
-                    if type(compatibility_mat[m][n]).__name__ == 'bool' and not compatibility_mat[m][n]:
-                        compatibility_mat[s][k] = False
-                        break
-                    elif type(compatibility_mat[m][n]).__name__ == 'bool' and compatibility_mat[m][n]:
-                        compatibility_mat[s][k].pop(i)
-
-            if type(compatibility_mat[s][k]).__name__ != 'bool':
-                if len(compatibility_mat[s][k]) == 0:
-                    compatibility_mat[s][k] = True
-                else:
-                    unknowns.append((s, k))
-
-            unknown_lengths.append(len(unknowns))
+        _states, matrix = self._transition_matrix()
+        actions = [self.state_desc[s]['action'] for s in _states]
+        compatibility_mat = _compatible_pairs(matrix, actions)
 
         new_states = []
         new_state_info = {}
-        processed = {x: False for x in _states}
         belongs_to = {_: None for _ in _states}
-        for s in sorted(_states):
-            if not processed[s]:
-                comp_pair = [sorted((s, x))[::-1] for x in _states if
-                             (x != s and compatibility_mat[max(s, x)][min(s, x)])]
-                if len(comp_pair) != 0:
-                    _new_state = self.traverse_compatible_states(comp_pair, compatibility_mat)
-                    _new_state.sort(key=len, reverse=True)
-                else:
-                    _new_state = [[s]]
-                for d in _new_state[0]:
-                    processed[d] = True
-                    belongs_to[d] = len(new_states)
-                new_state_info[len(new_states)] = {'action': self.state_desc[_new_state[0][0]]['action'],
-                                                   'sub_states': _new_state[0]}
-                new_states.append(_new_state[0])
+        for group in _group_compatible_states(compatibility_mat):
+            _new_state = [_states[d] for d in group]
+            for d in _new_state:
+                belongs_to[d] = len(new_states)
+            new_state_info[len(new_states)] = {'action': self.state_desc[_new_state[0]]['action'],
+                                               'sub_states': _new_state}
+            new_states.append(_new_state)
 
         new_trans = {}
         for i, s in enumerate(new_states):
             new_trans[i] = {}
-            for o in range(len(self.obs_space)):
+            for o in range(len(self.obs_registry)):
                 new_trans[i][o] = None
                 for sub_s in s:
                     if o in self.transaction[sub_s] and self.transaction[sub_s][o] is not None:
@@ -376,28 +689,11 @@ class MooreMachine:
                     break
 
         # Minimize Observation Space (Combine observations which show the same transaction behaviour for all states)
-        _obs_minobs_map = {}
-        _minobs_obs_map = {}
-        _trans_minobs_map = {}
-        min_trans = {s: {} for s in new_trans.keys()}
-        obs_i = 0
-        for i in range(len(self.obs_space)):
-            _trans_key = [new_trans[s][i] for s in sorted(new_trans.keys())].__str__()
-            if _trans_key not in _trans_minobs_map:
-                obs_i += 1
-                o = 'o_' + str(obs_i)
-                _trans_minobs_map[_trans_key] = o
-                _minobs_obs_map[o] = [i]
-                for s in new_trans.keys():
-                    min_trans[s][o] = new_trans[s][i]
-            else:
-                _minobs_obs_map[_trans_minobs_map[_trans_key]].append(i)
-            _obs_minobs_map[i] = _trans_minobs_map[_trans_key]
+        min_trans, _obs_minobs_map, _minobs_obs_map = self._merge_observations(new_trans)
 
         # Update information
         self.transaction = min_trans
         self.state_desc = new_state_info
-        self.state_space = list(self.transaction.keys())
         self.start_state = start_state_p
         self.obs_minobs_map = _obs_minobs_map
         self.minobs_obs_map = _minobs_obs_map
@@ -410,69 +706,61 @@ class MooreMachine:
                 assert ev not in rev_mapping
                 rev_mapping[ev] = k
         self.obs2min = {}
-        for obs, idx in self.obs2unmin.items():
-            self.obs2min[obs] = rev_mapping[idx]
+        for frame_id, idx in self.obs2unmin.items():
+            self.obs2min[frame_id] = rev_mapping[idx]
         print('obs mappings built!')
 
-    @staticmethod
-    def traverse_compatible_states(states, compatibility_mat):
-        for i, s in enumerate(states):
-            for j, s_next in enumerate(states[i + 1:]):
-                compatible = True
-                for m in s:
-                    for n in s_next:
-                        if m != n and not compatibility_mat[max(m, n)][min(m, n)]:
-                            compatible = False
-                            break
-                    if not compatible:
-                        break
-                if compatible:
-                    _states = states[:i] + [sorted(list(set(s + s_next)))] + states[i + j + 2:]
-                    return MooreMachine.traverse_compatible_states(_states, compatibility_mat)
-        return states
+    def _transition_matrix(self):
+        """
+        Returns the states (in the order of state_desc) along with an int matrix of shape (states, observations) of
+        the index of their next states; -1 for unknown transitions.
+        """
+        states = list(self.state_desc.keys())
+        if isinstance(self.transaction, TransitionTable) and states == list(range(len(self.transaction))):
+            return states, self.transaction.matrix.astype(np.int64)
+        state_ids = {s: i for i, s in enumerate(states)}
+        matrix = np.full((len(states), len(self.obs_registry)), -1, dtype=np.int64)
+        for s, s_trans in self.transaction.items():
+            for o, next_s in s_trans.items():
+                if next_s is not None:
+                    matrix[state_ids[s], o] = state_ids[next_s]
+        return states, matrix
 
     def minimize(self):
         """
         Minimize observation space.
         """
-        # create initial partitions (states) based on the action space
-        partitions = {'s_' + str(i): [] for i in range(self.total_actions)}
-        state_dict = {}
+        states, matrix = self._transition_matrix()
+        if np.any(matrix < 0):
+            raise ValueError('Transaction table has unknown entries; use minimize_partial_fsm instead')
+
+        # create initial partitions (states) based on the action space and refine them until they are stable
+        actions = ['s_' + str(self.state_desc[x]['action']) for x in states]
+        action_keys, initial_blocks = np.unique(actions, return_inverse=True)
+        blocks = _refine_partition(matrix, initial_blocks)
+
+        # name the partitions after their action if no refinement was needed, otherwise in order of their first state
+        if blocks.max() + 1 == len(action_keys):
+            labels = {b: str(action_keys[b]) for b in range(len(action_keys))}
+        else:
+            _, first_states = np.unique(blocks, return_index=True)
+            labels = {int(blocks[i]): 'ns_' + str(p) for p, i in enumerate(sorted(first_states))}
 
         # mapping from new partition states to original state space (un-minified) /vice-versa (for efficiency)
-        for x in self.state_desc.keys():
-            _key = 's_' + str(self.state_desc[x]['action'])
+        partitions = {label: [] for label in labels.values()}
+        state_dict = {}
+        for i, x in enumerate(states):
+            _key = labels[int(blocks[i])]
             partitions[_key].append(x)
             state_dict[x] = _key
 
-        while True:
-            _new_states = {}
-            for i, p in enumerate(sorted(partitions.keys())):
-                for s in partitions[p]:
-                    _key = str(i) + '_' + "_".join([state_dict[self.transaction[s][o]]
-                                                    for o in range(len(self.obs_space))])
-                    if _key in _new_states:
-                        _new_states[_key].append(s)
-                    else:
-                        _new_states[_key] = [s]
-            if len(_new_states.keys()) > len(partitions.keys()):
-                _partitions = {}
-                for i, p in enumerate(sorted(_new_states.keys())):
-                    i = 'ns_' + str(i)
-                    _partitions[i] = _new_states[p]
-                    for s in _new_states[p]:
-                        state_dict[s] = i
-                partitions = _partitions
-            else:
-                break
-
         # create new transaction table:
         new_trans = {}
         new_state_info = {}
         for p in partitions:
             if len(partitions[p]) > 0:
                 new_trans[p] = {o: state_dict[self.transaction[partitions[p][0]][o]] for o in
-                                range(len(self.obs_space))}
+                                range(len(self.obs_registry))}
                 new_state_info[p] = {'action': self.state_desc[partitions[p][0]]['action'],
                                      'sub_states': partitions[p]}
 
@@ -497,34 +785,85 @@ class MooreMachine:
                     break
 
         # Combine observations which show the same transaction behaviour for all states
-        _obs_minobs_map = {}
-        _minobs_obs_map = {}
-        _trans_minobs_map = {}
-        min_trans = {s: {} for s in new_trans.keys()}
-        obs_i = 0
-        for i in range(len(self.obs_space)):
-            _trans_key = [new_trans[s][i] for s in new_trans.keys()].__str__()
-            if _trans_key not in _trans_minobs_map:
-                obs_i += 1
-                o = 'o_' + str(obs_i)
-                _trans_minobs_map[_trans_key] = o
-                _minobs_obs_map[o] = [i]
-                for s in new_trans.keys():
-                    min_trans[s][o] = new_trans[s][i]
-            else:
-                _minobs_obs_map[_trans_minobs_map[_trans_key]].append(i)
-            _obs_minobs_map[i] = _trans_minobs_map[_trans_key]
+        min_trans, _obs_minobs_map, _minobs_obs_map = self._merge_observations(new_trans)
 
         # Update information
         self.transaction = min_trans
         self.state_desc = new_state_info
-        self.state_space = self.transaction.keys()
         self.start_state = start_state_p
         self.obs_minobs_map = _obs_minobs_map
         self.minobs_obs_map = _minobs_obs_map
         self.minimized = True
 
-    def evaluate(self, net, env, total_episodes, log=True, render=False, inspect=False, store_obs=False, path=None, cuda=False):
+    def _merge_observations(self, new_trans):
+        """
+        Combines observations which show the same transaction behaviour for all states. Observations are grouped by
+        their column in the transition matrix; groups are named o_1, o_2, .. in order of their first observation.
+
+        :param new_trans: transaction table of the minimized states; a dict of {observation: next state or None}
+                          for each state
+        :return: transaction table on the grouped observations, observation to group map and group to observations map
+        """
+        states = list(new_trans.keys())
+        state_ids = {s: i for i, s in enumerate(states)}
+        state_ids[None] = -1
+        total_obs = len(self.obs_registry)
+        matrix = np.full((max(len(states), 1), total_obs), -1, dtype=np.int64)
+        for i, s in enumerate(states):
+            matrix[i] = list(map(state_ids.__getitem__, map(new_trans[s].__getitem__, range(total_obs))))
+
+        # group identical columns by refining the groups with one state (row) at a time, then name the groups in order
+        # of their first observation
+        obs_class = np.zeros(total_obs, dtype=np.int64)
+        for row in matrix:
+            obs_class = np.unique(obs_class * (len(states) + 1) + row + 1, return_inverse=True)[1].reshape(-1)
+        _, first_obs = np.unique(obs_class, return_index=True)
+        order = np.argsort(first_obs, kind='mergesort')
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        obs_class = rank[np.asarray(obs_class).reshape(-1)]
+
+        _obs_minobs_map = {i: 'o_' + str(c + 1) for i, c in enumerate(obs_class.tolist())}
+        _minobs_obs_map = {'o_' + str(c + 1): [] for c in range(len(order))}
+        for i, o in _obs_minobs_map.items():
+            _minobs_obs_map[o].append(i)
+        min_trans = {s: {o: new_trans[s][obs[0]] for o, obs in _minobs_obs_map.items()} for s in states}
+        return min_trans, _obs_minobs_map, _minobs_obs_map
+
+    def compile(self, net=None):
+        """
+        Compiles the minimized machine into an FSMRuntime for stepping many sessions at once.
+
+        :param net: MMNet the machine has been extracted from; if given, numpy weights of its observation encoder are
+                    bundled with the runtime, which can then be played from raw observations (see FSMRuntime.act)
+        """
+        runtime = FSMRuntime.from_machine(self)
+        if net is not None:
+            runtime.encoder = ObsEncoder(_numpy_layers(net.obs_encoder_layers()))
+        return runtime
+
+    def export(self, path, net=None):
+        """
+        Saves the compiled minimized machine in the compact on-disk format of FSMRuntime (see FSMRuntime.save); the
+        frame mappings gathered during extraction and minimization (from frame ids) and the frames themselves (an
+        array indexed by frame id) go into separate sidecar files.
+
+        If the network is given, numpy weights of its observation encoder are bundled with the machine, which can then
+        be played from raw observations without torch (see FSMRuntime.act).
+
+        :param path: directory to write into
+        :param net: MMNet the machine has been extracted from
+        """
+        sidecars = {name: getattr(self, attr) for name, attr in [('obs_to_encoding', 'obs2encoding'),
+                                                                  ('obs_to_unmin_states', 'obs2unmin'),
+                                                                  ('obs_to_min_states', 'obs2min')]
+                    if hasattr(self, attr)}
+        if getattr(self, 'frame_store', None) is not None:
+            sidecars['frames'] = self.frame_store.frames
+        self.compile(net).save(path, sidecars=sidecars)
+
+    def evaluate(self, net, env, total_episodes, log=True, render=False, inspect=False, store_obs=False, path=None, cuda=False,
+                 obs_cache=None, profiler=None, image_workers=4):
         """
         Evaluate the trained network.
 
@@ -537,26 +876,38 @@ class MooreMachine:
         :param store_obs: check to store observations again
         :param path: where to check for inspection
         :param cuda: check if cuda is available
+        :param obs_cache: ObsCodeCache used to skip encoding repeated frames
+        :param profiler: PhaseProfiler timing the phases (env, encode, transact, registry, copy, bookkeeping,
+                         render) of the evaluation
+        :param image_workers: no. of threads writing the stored observations in the background
         :return: evaluation performance on given model
         """
+        profiler = profiler if profiler is not None else _NO_PROFILER
         net.eval()
         if inspect:
             obs_path = ensure_directory_exits(os.path.join(path, 'obs'))
             video_dir_path = ensure_directory_exits(os.path.join(path, 'eps_videos'))
             if len(os.listdir(video_dir_path)) > 0:
                 sys.exit('Previous Video Files present: ' + video_dir_path)
-            self.frequency = {s: {t: 0 for t in sorted((self.state_desc.keys()))} for s in
-                              sorted(self.state_desc.keys())}
-            self.trajectory = []
+            # steps are logged by the indices of their states and observations (-1 for none) in inspect_labels
+            inspect_states = sorted(self.state_desc.keys())
+            inspect_obs = sorted(self.minobs_obs_map.keys()) if self.minimized else list(range(len(self.obs_registry)))
+            state_ids = {s: i for i, s in enumerate(inspect_states)}
+            obs_ids = {o: i for i, o in enumerate(inspect_obs)}
+            steps_log = TrajectoryLog([('episode', np.int32), ('step', np.int32), ('state', np.int32),
+                                       ('obs', np.int32), ('pre_obs', np.int32), ('next_state', np.int32)])
+        obs_writer = AsyncImageWriter(workers=image_workers) if store_obs else None
 
         total_reward = 0
         for ep in range(total_episodes):
-            if inspect:
-                ep_video_path = ensure_directory_exits(os.path.join(video_dir_path, str(ep)))
-                obs, org_obs = env.reset(inspect=True)
-                _shape = (org_obs.shape[1], org_obs.shape[0])
-            else:
-                obs = env.reset()
+            with profiler.phase('env'):
+                if inspect:
+                    ep_video_path = ensure_directory_exits(os.path.join(video_dir_path, str(ep)))
+                    ep_video = VideoWriter(os.path.join(ep_video_path, 'video_{}.mp4'.format(ep)), framerate=1)
+                    obs, org_obs = env.reset(inspect=True)
+                    _shape = (org_obs.shape[1], org_obs.shape[0])
+                else:
+                    obs = env.reset()
             done = False
             ep_reward = 0
             ep_actions = []
@@ -564,51 +915,72 @@ class MooreMachine:
             curr_state = self.start_state
             while not done:
                 ep_obs.append(obs)
-                obs = torch.FloatTensor(obs).unsqueeze(0)
-                obs = Variable(obs)
-                if cuda:
-                    obs = obs.cuda()
-                obs_x = list(net.obs_encode(obs).data.cpu().numpy()[0])
-                _, obs_index = self._get_index(self.obs_space, obs_x, force=False)
-                if store_obs:
-                    obs_dir = ensure_directory_exits(os.path.join(obs_path, str(obs_index)))
-                    scipy.misc.imsave(
-                        os.path.join(obs_dir, str(obs_index) + '_' + str(random.randint(0, 100000)) + '.jpg'),
-                        org_obs)
-
-                if not self.minimized:
-                    (obs_index, pre_index) = (obs_index, None)
-                else:
-                    try:
-                        (obs_index, pre_index) = (self.obs_minobs_map[obs_index], obs_index)
-                    except Exception as e:
-                        logger.error(e)
+                with profiler.phase('registry'):
+                    frame_key = obs_cache.digest(obs) if obs_cache is not None else None
+                    obs_x_key = obs_cache.get(frame_key) if obs_cache is not None else None
+                if obs_x_key is None:
+                    with profiler.phase('copy'):
+                        obs = torch.FloatTensor(obs).unsqueeze(0)
+                        obs = Variable(obs)
+                        if cuda:
+                            obs = obs.cuda()
+                    with profiler.phase('encode'):
+                        obs_x = net.obs_encode(obs)
+                    with profiler.phase('copy'):
+                        obs_x = obs_x.data.cpu().numpy()[0]
+                    with profiler.phase('registry'):
+                        obs_x_key = self.obs_registry.key(obs_x)
+                        if obs_cache is not None:
+                            obs_cache.put(frame_key, obs_x_key)
+                with profiler.phase('registry'):
+                    obs_index = self.obs_registry.get_key(obs_x_key)
+                with profiler.phase('bookkeeping'):
+                    if store_obs:
+                        obs_writer.write(os.path.join(obs_path, str(obs_index), '{}_{}_{}.jpg'.format(
+                            obs_index, ep, len(ep_obs))), org_obs)
+
+                with profiler.phase('registry'):
+                    if not self.minimized:
+                        (obs_index, pre_index) = (obs_index, None)
+                    else:
+                        try:
+                            (obs_index, pre_index) = (self.obs_minobs_map[obs_index], obs_index)
+                        except Exception as e:
+                            logger.error(e)
 
-                next_state = self.transaction[curr_state][obs_index]
+                with profiler.phase('transact'):
+                    next_state = self.transaction[curr_state][obs_index]
                 if next_state is None:
+                    if inspect:
+                        ep_video.close()
+                    if store_obs:
+                        obs_writer.close()
                     logger.info('None state encountered!')
                     logger.info('Exiting the script!')
                     sys.exit(0)
                 if render and inspect:
-                    _text = 'Current State:{} \n Obs: {} \n Next State: {} \n\n\n Total States:{} \n Total Obs: {}'
-                    _text = _text.format(str(curr_state), (obs_index, pre_index).__str__(), str(next_state),
-                                         len(self.state_desc.keys()), len(self.minobs_obs_map.keys()))
-                    _label_img = self.text_image(_shape, _text)
-                    _img = np.hstack((org_obs, _label_img))
-                    env.render(inspect=inspect, img=_img)
-                    if inspect:
-                        frame_id = str(len(ep_obs))
-                        frame_id = '0' * (10 - len(frame_id)) + frame_id
-                        scipy.misc.imsave(os.path.join(ep_video_path, 'frame_' + frame_id + '.jpg'), _img)
-                        self.frequency[curr_state][next_state] += 1
-                        if ep == total_episodes - 1:
-                            self.trajectory.append([len(ep_obs), curr_state, (obs_index, pre_index), next_state])
+                    with profiler.phase('bookkeeping'):
+                        _text = 'Current State:{} \n Obs: {} \n Next State: {} \n\n\n Total States:{} \n Total Obs: {}'
+                        _text = _text.format(str(curr_state), (obs_index, pre_index).__str__(), str(next_state),
+                                             len(self.state_desc.keys()), len(self.minobs_obs_map.keys()))
+                        _label_img = self.text_image(_shape, _text)
+                        _img = np.hstack((org_obs, _label_img))
+                    with profiler.phase('render'):
+                        env.render(inspect=inspect, img=_img)
+                    with profiler.phase('bookkeeping'):
+                        if inspect:
+                            ep_video.write(_img)
+                            steps_log.append(ep, len(ep_obs), state_ids[curr_state], obs_ids.get(obs_index, -1),
+                                             -1 if pre_index is None else pre_index, state_ids[next_state])
                 elif render:
-                    env.render()
+                    with profiler.phase('render'):
+                        env.render()
 
                 curr_state = next_state
                 action = int(self.state_desc[curr_state]['action'])
-                obs, reward, done, info = env.step(action)
+                with profiler.phase('env'):
+                    obs, reward, done, info = env.step(action)
+                profiler.count('steps')
                 org_obs = info['org_obs'] if 'org_obs' in info else obs
                 ep_actions.append(action)
                 ep_reward += reward
@@ -621,45 +993,58 @@ class MooreMachine:
                         done = True
 
             total_reward += ep_reward
+            profiler.end_episode(episode=ep, reward=ep_reward, steps=len(ep_actions))
             if log:
                 logger.info("Episode => {} Score=> {}".format(ep, ep_reward))
             if inspect:
-                _parseable_path = ep_video_path.replace('(', '\(')
-                _parseable_path = _parseable_path.replace(')', '\)')
-                os.system("ffmpeg -f image2 -pattern_type glob -framerate 1 -i '{}*.jpg' {}{}.mp4".
-                          format(os.path.join(_parseable_path, 'frame_'), os.path.join(_parseable_path, 'video_'),
-                                 ep))
-                os.system("rm -rf {}/*.jpg".format(_parseable_path))
+                ep_video.close()
+            if store_obs:
+                with profiler.phase('bookkeeping'):
+                    obs_writer.flush()
+
+        if inspect:
+            # visit counts of the state transitions (from x to) and the steps of the last episode
+            records = steps_log.records
+            self.inspect_labels = (inspect_states, inspect_obs)
+            self.frequency = scipy.sparse.coo_matrix(
+                (np.ones(len(records), dtype=np.int64), (records['state'], records['next_state'])),
+                shape=(len(inspect_states),) * 2).tocsr()
+            self.trajectory = records[records['episode'] == total_episodes - 1]
+
+        if log and obs_cache is not None:
+            logger.info(obs_cache)
+        if store_obs:
+            obs_writer.close()
+        if log and profiler.enabled:
+            logger.info(profiler)
 
         if self.minimized and store_obs:
             logger.info('Combining Sub-Observations')
             combined_obs_path = ensure_directory_exits(os.path.join(path, 'combined_obs'))
+            samples_per_obs = 10
             for k in sorted(self.minobs_obs_map.keys()):
                 logger.info('Observation Class:' + str(k))
-                max_images_per_comb = 250  # beyond this images cannot be combined due to library/memory issues
-                suffix = len(self.minobs_obs_map[k]) > max_images_per_comb
-                total_parts = int(len(self.minobs_obs_map[k]) / max_images_per_comb)
-                if len(self.minobs_obs_map[k]) % max_images_per_comb != 0:
-                    total_parts += 1
-                for p_i in range(total_parts):
-                    k_image = None
-                    for o_i in self.minobs_obs_map[k][p_i:p_i + max_images_per_comb]:
-                        o_path = os.path.join(obs_path, str(o_i))
-                        o_files = [os.path.join(o_path, f) for f in os.listdir(o_path) if
-                                   os.path.isfile(os.path.join(o_path, f))]
-                        o_i_image = scipy.misc.imread(random.choice(o_files))
-
-                        o_i_image = np.hstack((self.text_image(_shape, str(o_i),
-                                                               position=(_shape[0] // 2, _shape[1] // 2)),
-                                               o_i_image))
-                        for i in range(9):
-                            o_i_image = np.hstack((o_i_image, scipy.misc.imread(random.choice(o_files))))
-                        k_image = o_i_image if k_image is None else np.vstack((k_image, o_i_image))
-                    k_shape = (_shape[0], len(self.minobs_obs_map[k][p_i:p_i + max_images_per_comb]) * _shape[1])
-                    k_name_image = self.text_image(k_shape, str(k), position=(k_shape[0] // 2, 10), font_size=20)
-                    k_image = np.hstack((k_name_image, k_image))
-                    k_file_name = str(k) + (('_part_' + str(p_i + 1)) if suffix else '')
-                    scipy.misc.imsave(os.path.join(combined_obs_path, k_file_name + '.jpg'), k_image)
+                # observations of the class met (and stored) during the evaluation
+                obs_files = []
+                for o_i in self.minobs_obs_map[k]:
+                    o_path = os.path.join(obs_path, str(o_i))
+                    if os.path.isdir(o_path):
+                        obs_files.append((o_i, [os.path.join(o_path, f) for f in os.listdir(o_path) if
+                                                os.path.isfile(os.path.join(o_path, f))]))
+                if len(obs_files) == 0:
+                    continue
+
+                # columns: class name | observation index | samples of the observation
+                k_image = Montage(len(obs_files), samples_per_obs + 2, _shape)
+                k_shape = (_shape[0], len(obs_files) * _shape[1])
+                k_image.put(0, 0, text_image(k_shape, str(k), position=(k_shape[0] // 2, 10), font_size=20))
+                for row, (o_i, o_files) in enumerate(obs_files):
+                    k_image.put(row, 1, text_image(_shape, str(o_i), position=(_shape[0] // 2, _shape[1] // 2)))
+                    for col in range(samples_per_obs):
+                        k_image.put(row, col + 2, scipy.misc.imread(random.choice(o_files)))
+                # JPEG cannot go beyond 65535 pixels a side
+                extension = '.jpg' if max(k_image.image.shape[:2]) <= 65535 else '.png'
+                scipy.misc.imsave(os.path.join(combined_obs_path, str(k) + extension), k_image.image)
 
             if inspect:
                 obs_path = obs_path.replace('(', '\(').replace(')', '\)')
@@ -669,25 +1054,99 @@ class MooreMachine:
 
     @staticmethod
     def text_image(shape, text, position=(0, 0), font_size=25):
-        font = ImageFont.truetype("arial.ttf", font_size)
-        img = Image.new("RGB", shape, (255, 255, 255))
-        draw = ImageDraw.Draw(img)
-        draw.text(position, text, (0, 0, 0), font=font)
-        return np.array(img)
+        return text_image(shape, text, position=position, font_size=font_size)
 
-    def save(self, info_file):
+    def _table_columns(self):
         """
-        Save data into given file.
+        Rows (states) and columns (observations) of the transaction table, in the order they are saved.
+        """
+        states = sorted(self.state_desc.keys())
+        if not self.minimized:
+            return states, list(range(len(self.obs_registry)))
+        return states, sorted(self.transaction[list(self.transaction.keys())[0]].keys())
 
-        :param info_file: an opened file to write data in
+    def _stream_tables(self, path, table_format):
         """
-        info_file.write('Total Unique States:{}\n'.format(len(self.state_desc.keys())))
+        Writes the tables row by row into <path>_<table>.tsv/csv files, or all of them as arrays into <path>.npz.
+
+        :return: paths of the written files
+        """
+        states, columns = self._table_columns()
+        if table_format == 'npz':
+            state_ids = {s: i for i, s in enumerate(states)}
+            if isinstance(self.transaction, TransitionTable) and states == list(range(len(self.transaction))):
+                transitions = self.transaction.matrix.astype(np.int32)
+            else:
+                transitions = np.full((len(states), len(columns)), -1, dtype=np.int32)
+                for i, s in enumerate(states):
+                    s_trans = self.transaction[s]
+                    for j, o in enumerate(columns):
+                        next_s = s_trans.get(o)
+                        if next_s is not None:
+                            transitions[i, j] = state_ids[next_s]
+            arrays = {'states': np.array([str(s) for s in states]),
+                      'observations': np.array([str(o) for o in columns]),
+                      'actions': np.array([self.state_desc[s]['action'] for s in states]),
+                      'start_state': np.array(state_ids[self.start_state]),
+                      'transitions': transitions}
+            if not self.minimized:
+                arrays['state_codes'] = np.array([self.state_desc[s]['description'] for s in states])
+                arrays['obs_codes'] = self.obs_space
+            else:
+                # sub states / sub observations of row i are members[indptr[i]:indptr[i + 1]]
+                for name, members in [('sub_states', [self.state_desc[s]['sub_states'] for s in states]),
+                                      ('sub_obs', [self.minobs_obs_map[o] for o in columns])]:
+                    arrays[name + '_indptr'] = np.cumsum([0] + [len(m) for m in members])
+                    arrays[name] = np.array([x for m in members for x in m])
+            if self.inspect_labels is not None:
+                # frequency is kept in CSR form; states/observations of the inspection are indexed by inspect_labels
+                arrays['inspect_states'] = np.array([str(s) for s in self.inspect_labels[0]])
+                arrays['inspect_obs'] = np.array([str(o) for o in self.inspect_labels[1]])
+                arrays['frequency_indptr'] = self.frequency.indptr
+                arrays['frequency_indices'] = self.frequency.indices
+                arrays['frequency_data'] = self.frequency.data
+                arrays['trajectory'] = self.trajectory
+            np.savez_compressed(path + '.npz', **arrays)
+            return [path + '.npz']
+
+        def as_text(x):
+            return ' '.join(str(_) for _ in np.ravel(x)) if isinstance(x, (np.ndarray, list, tuple)) else str(x)
+
+        tables = [('states', ['Name', 'Action', 'Description' if not self.minimized else 'Sub States'],
+                   ([s, self.state_desc[s]['action'],
+                     as_text(self.state_desc[s]['description' if not self.minimized else 'sub_states'])]
+                    for s in states))]
         if not self.minimized:
-            info_file.write('Total Unique Observations:{}\n'.format(len(self.obs_space)))
+            tables.append(('observations', ['Index', 'Features'],
+                           ([i, as_text(self.obs_registry[i])] for i in columns)))
         else:
-            info_file.write('Total Unique Observations:{}\n'.format(len(self.minobs_obs_map.keys())))
-        info_file.write('\n\nStart State: {}\n'.format(self.start_state))
-
+            tables.append(('observations', ['obs-tag', 'Sub-Observation Space'],
+                           ([o, as_text(self.minobs_obs_map[o])] for o in columns)))
+        tables.append(('transitions', [''] + columns,
+                       ([s] + [self.transaction[s].get(o) for o in columns] for s in states)))
+        if self.inspect_labels is not None:
+            freq_states = self.inspect_labels[0]
+            frequency = self.frequency.tocoo()
+            tables.append(('frequency', ['From', 'To', 'Count'],
+                           ([freq_states[f], freq_states[t], c] for f, t, c in
+                            zip(frequency.row, frequency.col, frequency.data))))
+            tables.append(('trajectory', ['Step', 'State', 'Obs', 'Next State'], self._trajectory_rows()))
+
+        paths = []
+        for name, header, rows in tables:
+            table_path = '{}_{}.{}'.format(path, name, table_format)
+            with open(table_path, 'w', newline='') as f:
+                writer = csv.writer(f, delimiter='\t' if table_format == 'tsv' else ',')
+                writer.writerow(header)
+                for row in rows:
+                    writer.writerow(row)
+            paths.append(table_path)
+        return paths
+
+    def _pretty_tables(self, info_file):
+        """
+        Renders the tables into the opened file with PrettyTable.
+        """
         if not self.minimized:
             info_file.write('\n\nObservation Description:\n')
             t1 = PrettyTable(["Index", "Features"])
@@ -708,7 +1167,7 @@ class MooreMachine:
             t1.add_row([k, self.state_desc[k]['action'], _state_info])
         info_file.write(t1.__str__() + '\n')
         if not self.minimized:
-            column_names = [""] + [str(_) for _ in range(len(self.obs_space))]
+            column_names = [""] + [str(_) for _ in range(len(self.obs_registry))]
             t = PrettyTable(column_names)
             for key in sorted(self.transaction.keys()):
                 t.add_row([key] +
@@ -723,17 +1182,61 @@ class MooreMachine:
         info_file.write('\n\nTransaction Matrix:    (StateIndex_ObservationIndex x StateIndex)' + '\n')
         info_file.write(t.__str__())
 
-        if self.frequency is not None:
-            column_names = [""] + [str(_) for _ in sorted(self.frequency.keys())]
+        if self.inspect_labels is not None:
+            freq_states = self.inspect_labels[0]
+            frequency = self.frequency.toarray()
+            column_names = [""] + [str(_) for _ in freq_states]
             t = PrettyTable(column_names)
-            for key in sorted(self.frequency.keys()):
-                t.add_row([key] + [self.frequency[key][c] for c in sorted(self.frequency.keys())])
+            for i, key in enumerate(freq_states):
+                t.add_row([key] + frequency[i].tolist())
             info_file.write('\n\nState Transaction Frequency Matrix:    (From  x To)' + '\n')
             info_file.write(t.__str__())
 
-        if self.trajectory is not None:
             info_file.write('\n\nTrajectory info:' + '\n')
-            info_file.write(self.trajectory.__str__())
+            info_file.write(list(self._trajectory_rows()).__str__())
+
+    def _trajectory_rows(self):
+        """
+        Yields the steps of the recorded trajectory as [step, state, (obs, pre-minimization obs), next state].
+        """
+        states, observations = self.inspect_labels
+        for record in self.trajectory:
+            obs = observations[record['obs']] if record['obs'] >= 0 else None
+            pre_obs = int(record['pre_obs']) if record['pre_obs'] >= 0 else None
+            yield [int(record['step']), states[record['state']], (obs, pre_obs), states[record['next_state']]]
+
+    def save(self, info_file, tables='auto', table_format='tsv', max_pretty_cells=100000):
+        """
+        Save data into given file.
+
+        :param info_file: an opened file to write data in
+        :param tables: 'pretty' renders the tables into the file with PrettyTable; 'stream' writes them row by row into
+                       files next to it (<name>_<table>.tsv/csv, or <name>.npz); 'auto' renders them only for machines
+                       of at most max_pretty_cells transitions
+        :param table_format: format of streamed tables: 'tsv', 'csv' or 'npz'
+        :param max_pretty_cells: largest table (states x observations, or states x states for the frequencies of an
+                                 inspection) rendered with PrettyTable by 'auto'
+        """
+        assert tables in ('auto', 'pretty', 'stream'), 'unknown tables mode: {}'.format(tables)
+        assert table_format in ('tsv', 'csv', 'npz'), 'unknown table format: {}'.format(table_format)
+        info_file.write('Total Unique States:{}\n'.format(len(self.state_desc.keys())))
+        if not self.minimized:
+            info_file.write('Total Unique Observations:{}\n'.format(len(self.obs_registry)))
+        else:
+            info_file.write('Total Unique Observations:{}\n'.format(len(self.minobs_obs_map.keys())))
+        info_file.write('\n\nStart State: {}\n'.format(self.start_state))
+
+        if tables == 'auto':
+            states, columns = self._table_columns()
+            cells = len(states) * max(len(columns), len(states) if self.inspect_labels is not None else 0)
+            tables = 'pretty' if cells <= max_pretty_cells else 'stream'
+        if tables == 'stream':
+            table_paths = self._stream_tables(os.path.splitext(info_file.name)[0], table_format)
+            info_file.write('\n\nTables:\n')
+            for table_path in table_paths:
+                info_file.write(os.path.basename(table_path) + '\n')
+        else:
+            self._pretty_tables(info_file)
         info_file.close()
 
         if self.minimized: # have all obs mapping information at this time
@@ -741,6 +1244,8 @@ class MooreMachine:
             pickle.dump(self.obs2encoding, open(path+'obs_to_encoding.pkl', 'wb'), pickle.HIGHEST_PROTOCOL)
             pickle.dump(self.obs2unmin, open(path+'obs_to_unmin_states.pkl', 'wb'), pickle.HIGHEST_PROTOCOL)
             pickle.dump(self.obs2min, open(path+'obs_to_min_states.pkl', 'wb'), pickle.HIGHEST_PROTOCOL)
+            if getattr(self, 'frame_store', None) is not None:
+                self.frame_store.save(path+'frames')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,126 @@
+"""
+Opt-in phase-level profiling of the extraction and evaluation loops.
+"""
+
+import os
+import json
+import time
+
+
+class _Phase():
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullPhase():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class PhaseProfiler():
+    """
+    Cumulative timers and counters per phase (e.g. env, encode, transact, registry, copy, bookkeeping, render),
+    overall and per episode.
+
+    Usage::
+
+        profiler = PhaseProfiler(enabled=True)
+        with profiler.phase('env'):
+            obs, reward, done, _ = env.step(action)
+        profiler.end_episode(reward=ep_reward)
+        profiler.write(log_dir, 'extract_from_nn')
+
+    A disabled profiler hands out a shared no-op context and ignores every call, so instrumented code costs next to
+    nothing when profiling is off.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+        self.episodes = []
+        self._episode_seconds = {}
+        self._episode_counters = {}
+        self._start = time.perf_counter()
+
+    def phase(self, name):
+        """
+        Context timing the enclosed code as part of the phase.
+        """
+        return _Phase(self, name) if self.enabled else _NULL_PHASE
+
+    def add(self, name, seconds, calls=1):
+        if not self.enabled:
+            return
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + calls
+        self._episode_seconds[name] = self._episode_seconds.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+        self._episode_counters[name] = self._episode_counters.get(name, 0) + n
+
+    def end_episode(self, **info):
+        """
+        Closes the current episode; its phase timings and counters are kept along with the given info.
+        """
+        if not self.enabled:
+            return
+        episode = dict(info)
+        episode['seconds'] = {k: round(v, 6) for k, v in self._episode_seconds.items()}
+        episode['counters'] = dict(self._episode_counters)
+        self.episodes.append(episode)
+        self._episode_seconds = {}
+        self._episode_counters = {}
+
+    def summary(self):
+        wall_seconds = time.perf_counter() - self._start
+        total = sum(self.seconds.values())
+        phases = {name: {'seconds': round(seconds, 6),
+                         'calls': self.calls[name],
+                         'mean_ms': round(1000 * seconds / self.calls[name], 6),
+                         'share': round(seconds / total, 4) if total > 0 else 0.0}
+                  for name, seconds in sorted(self.seconds.items(), key=lambda x: -x[1])}
+        return {'wall_seconds': round(wall_seconds, 6), 'phases': phases, 'counters': dict(self.counters),
+                'episodes': self.episodes}
+
+    def __str__(self):
+        summary = self.summary()
+        phases = ', '.join('{}: {}s ({}%)'.format(name, p['seconds'], round(100 * p['share'], 1))
+                           for name, p in summary['phases'].items())
+        return 'Profile => wall: {}s {}'.format(summary['wall_seconds'], phases)
+
+    def write(self, log_dir, name):
+        """
+        Writes the summary as JSON into the log directory (as profile-<name>.json).
+
+        :return: path of the written file; None if profiling is disabled
+        """
+        if not self.enabled:
+            return None
+        path = os.path.join(log_dir, 'profile-{}.json'.format(name))
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+        return path
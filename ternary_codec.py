@@ -0,0 +1,88 @@
+"""
+Packed encoding of the ternary (-1/0/1) codes produced by the quantized bottleneck networks(QBN).
+"""
+
+import numpy as np
+
+
+class TernaryCodec():
+    """
+    Packs ternary vectors of a fixed size into base-3 integers when they fit in 64 bits, or at 2 bits per trit into
+    byte strings otherwise. Packing round-trips exactly and packed codes can be compared, hashed and stored as is.
+    """
+
+    MAX_BASE3_TRITS = 40  # 3^40 < 2^64
+
+    def __init__(self, size):
+        self.size = size
+        self.base3 = size <= self.MAX_BASE3_TRITS
+        if self.base3:
+            self.dtype = np.dtype(np.uint64)
+            self.shape = ()
+            self._powers = np.power(3, np.arange(size, dtype=np.uint64), dtype=np.uint64)
+        else:
+            self.dtype = np.dtype(np.uint8)
+            self.shape = ((size + 3) // 4,)
+            self._shifts = np.arange(0, 8, 2, dtype=np.uint8)
+
+    def __eq__(self, other):
+        return isinstance(other, TernaryCodec) and self.size == other.size
+
+    def __hash__(self):
+        return hash(self.size)
+
+    @staticmethod
+    def is_ternary(codes):
+        """
+        Checks that all the values are one of -1, 0 and 1.
+        """
+        codes = np.asarray(codes)
+        return bool(np.all((codes == -1) | (codes == 0) | (codes == 1)))
+
+    def pack_batch(self, codes):
+        """
+        Packs a batch of ternary codes.
+
+        :param codes: array of shape (N, size)
+        :return: uint64 array of shape (N,) if base-3 packing is used; uint8 array of shape (N, ceil(size / 4)) otherwise
+        """
+        digits = np.asarray(codes).reshape(-1, self.size).astype(np.int64) + 1
+        if self.base3:
+            return digits.astype(np.uint64).dot(self._powers)
+        digits = digits.astype(np.uint8)
+        padding = 4 * self.shape[0] - self.size
+        if padding > 0:
+            digits = np.hstack((digits, np.zeros((len(digits), padding), dtype=np.uint8)))
+        digits = digits.reshape(len(digits), self.shape[0], 4) << self._shifts
+        return np.bitwise_or.reduce(digits, axis=2)
+
+    def unpack_batch(self, packed):
+        """
+        Inverse of pack_batch.
+
+        :param packed: packed codes as returned by pack_batch
+        :return: float array of shape (N, size) with values in {-1, 0, 1}
+        """
+        packed = np.asarray(packed, dtype=self.dtype)
+        if self.base3:
+            digits = (packed.reshape(-1, 1) // self._powers) % 3
+        else:
+            packed = packed.reshape(-1, self.shape[0])
+            digits = (packed[:, :, None] >> self._shifts) & 3
+            digits = digits.reshape(len(packed), -1)[:, :self.size]
+        return digits.astype(np.float64) - 1
+
+    def pack(self, code):
+        """
+        Packs a single ternary code into a hashable value: an int (base-3) or bytes (2 bits per trit).
+        """
+        packed = self.pack_batch(code)[0]
+        return int(packed) if self.base3 else packed.tobytes()
+
+    def unpack(self, packed):
+        """
+        Inverse of pack.
+        """
+        if not self.base3:
+            packed = np.frombuffer(packed, dtype=np.uint8)
+        return self.unpack_batch(packed)[0]
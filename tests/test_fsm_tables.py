@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from fsm_tables import CodeRegistry
+from moore_machine import MooreMachine
+
+
+def test_registry_mixes_ternary_and_non_ternary_codes():
+    # raw features (no QBN) whose first code happens to be ternary
+    codes = [np.zeros(4), np.array([0.25, 0., 1.5, 0.]), np.array([1., -1., 0., 1.]), np.array([0.25, 0., 1.5, 0.])]
+    registry = CodeRegistry(packed=False)
+    ids = [registry.add(code) for code in codes]
+    assert ids == [0, 1, 2, 1]
+    assert len(registry) == 3
+    assert registry.codec is None
+    for code, i in zip(codes, ids):
+        assert registry.get(code) == i
+        np.testing.assert_array_equal(registry[i], code)
+        np.testing.assert_array_equal(registry.decode_key(registry.key(code)), code)
+    assert registry.get(np.array([0.5, 0., 0., 0.])) is None
+
+
+def test_packed_registry_rejects_non_ternary_codes():
+    registry = CodeRegistry(packed=True)
+    assert registry.add(np.array([1., 0., -1.])) == 0
+    assert registry.codec is not None
+    with pytest.raises(ValueError):
+        registry.add(np.array([0.5, 0., -1.]))
+    assert registry.get(np.array([0.5, 0., -1.])) is None
+    assert len(registry) == 1
+
+
+def test_registry_storage_from_given_codes():
+    assert CodeRegistry(np.array([[1., 0.], [0., -1.]])).packed
+    assert not CodeRegistry(np.array([[0., 0.], [0.3, -1.]])).packed
+    assert not CodeRegistry().packed
+
+
+def test_code_registries_follow_the_qbns():
+    class _Net():
+        obx_net = None
+        bhx_net = object()
+
+    obs_registry, state_registry = MooreMachine._code_registries(_Net())
+    assert not obs_registry.packed
+    assert state_registry.packed
+
+
+@pytest.mark.parametrize('packed, codes', [(True, [[1., 0., -1.], [0., 0., 1.]]), (False, [[0.5, 0., 2.], [0., 0., 0.]])])
+def test_key_codec_decodes_keys_without_the_codes(packed, codes):
+    registry = CodeRegistry(packed=packed)
+    keys = [registry.key(code) for code in codes]
+    for code in codes:
+        registry.add(code)
+    key_codec = registry.key_codec()
+    assert len(key_codec) == 0
+    for code, key in zip(codes, keys):
+        assert key_codec.key(code) == key
+        np.testing.assert_array_equal(key_codec.decode_key(key), code)
+    assert key_codec.add(codes[1]) == 0
@@ -0,0 +1,62 @@
+import pickle
+import random
+import numpy as np
+import pytest
+import torch
+import tools as tl
+from control_nets import GRUNet
+
+
+class _ActionSpace():
+    def __init__(self, n):
+        self.n = n
+        self._random = random.Random(0)
+
+    def seed(self, seed):
+        self._random = random.Random(seed)
+
+    def sample(self):
+        return self._random.randrange(self.n)
+
+
+class _Env():
+    """
+    Environment whose observations are drawn by a seeded random generator depending on the action taken.
+    """
+
+    def __init__(self, length=20):
+        self.action_space = _ActionSpace(2)
+        self.length = length
+        self._rs = np.random.RandomState(0)
+
+    def seed(self, seed):
+        self._rs = np.random.RandomState(seed)
+
+    def reset(self):
+        self._t = 0
+        return self._rs.uniform(-1, 1, size=4).astype(np.float32)
+
+    def step(self, action):
+        self._t += 1
+        obs = self._rs.uniform(-1, 1, size=4).astype(np.float32) + action
+        return obs, float(action), self._t >= self.length, {}
+
+
+@pytest.fixture
+def guide():
+    torch.manual_seed(0)
+    return GRUNet(4, 32, 2).eval()
+
+
+def test_sharded_trajectories_match_serial(tmp_path, guide):
+    data = [tl.generate_trajectories(_Env(), 4, 3, str(tmp_path / 'data_{}.p'.format(workers)), guide,
+                                     workers=workers, env_seed=7)
+            for workers in (1, 3)]
+    assert pickle.dumps(data[0]) == pickle.dumps(data[1])
+
+
+def test_sharded_bottleneck_data_matches_serial(tmp_path, guide):
+    data = [tl.generate_bottleneck_data(guide, _Env(), 6, str(tmp_path / 'bn_{}.p'.format(workers)), eps=(0, 0.3),
+                                        max_steps=50, render=False, workers=workers, env_seed=7)
+            for workers in (1, 3)]
+    assert pickle.dumps(data[0]) == pickle.dumps(data[1])
@@ -3,16 +3,19 @@ Useful functions that have been used through out the whole code base.
 """
 
 import os
+import copy
 import torch
 import pickle
 import random
 import logging
 import argparse
+import multiprocessing
 import numpy as np
 import matplotlib as mpl
 import torch.nn.functional as F
 import matplotlib.pyplot as plt
 from torch.autograd import Variable
+from trajectory_data import TrajectoryDataset, convert_pickle, dataset_path
 
 # To plot graphs over a server shell since the default display is not available on server.
 mpl.use('Agg')
@@ -159,7 +162,260 @@ def set_log(logPath, suffix=''):
         level=logging.DEBUG)
 
 
-def generate_bottleneck_data(net, env, episodes, save_path, cuda=False, eps=(0, 0), max_steps=None, render=True):
+def env_copies(env, total, make_env=None):
+    """
+    Copies of the environment for batched rollouts; the given env is the first of them.
+
+    :param env: given environment
+    :param total: number of copies
+    :param make_env: function creating a fresh copy of the environment; deep copies of env by default (which is not
+                     safe for environments wrapping native emulators, e.g. Atari)
+    :return: list of environments
+    """
+    return [env] + [make_env() if make_env is not None else copy.deepcopy(env) for _ in range(total - 1)]
+
+
+def seeded_env_maker(make_env, seed):
+    """
+    Function creating fresh environments with make_env (e.g. lambda: gym.make(name)) seeded by seed + 1, seed + 2, ...
+    in turn, so that copies of an environment seeded by seed are reproducible.
+    """
+    copies = [0]
+
+    def make():
+        copies[0] += 1
+        env = make_env()
+        env.seed(seed + copies[0])
+        return env
+
+    return make
+
+
+def lockstep_episodes(envs, total_episodes, reset_fn, act_fn, step_fn, render=False, seed_fn=None):
+    """
+    Plays episodes on copies of an environment in lockstep: at every step, the actions of all the running episodes are
+    decided together (e.g. by one batched forward pass), then each copy is stepped. Episodes are started in order on
+    whichever copy frees up, until total_episodes have been played.
+
+    :param envs: copies of the environment (see env_copies)
+    :param total_episodes: number of episodes
+    :param reset_fn: reset_fn(slot, episode) called as an episode starts on envs[slot]
+    :param act_fn: act_fn(slots, obs) returning the actions of the episodes running on the given slots, whose
+                   observations are given stacked in the same order
+    :param step_fn: step_fn(slot, episode, obs, action, reward, done, info) called after each step with the observation
+                    the action was taken on; returns whether the episode is over
+    :param render: check to render the first copy
+    :param seed_fn: seed_fn(slot, episode) called before envs[slot] is reset for an episode
+    """
+    episodes = [None] * len(envs)
+    obs = [None] * len(envs)
+    next_episode = 0
+
+    def start(slot):
+        nonlocal next_episode
+        if next_episode < total_episodes:
+            episodes[slot], next_episode = next_episode, next_episode + 1
+            if seed_fn is not None:
+                seed_fn(slot, episodes[slot])
+            obs[slot] = envs[slot].reset()
+            reset_fn(slot, episodes[slot])
+        else:
+            episodes[slot] = None
+
+    for slot in range(len(envs)):
+        start(slot)
+    while any(ep is not None for ep in episodes):
+        if render and episodes[0] is not None:
+            envs[0].render()
+        slots = [slot for slot, ep in enumerate(episodes) if ep is not None]
+        actions = act_fn(slots, np.stack([obs[slot] for slot in slots]))
+        for slot, action in zip(slots, actions):
+            next_obs, reward, done, info = envs[slot].step(action)
+            done = step_fn(slot, episodes[slot], obs[slot], action, reward, done, info)
+            obs[slot] = next_obs
+            if done:
+                start(slot)
+
+
+def seed_episode(env, env_seed, ep):
+    """
+    Seeds the environment (and its action space) for an episode, so that the episode can be replayed on its own.
+
+    :param env: given environment
+    :param env_seed: base seed; episode ep is seeded by env_seed + ep. Nothing is seeded if None.
+    :param ep: index of the episode
+    :return: random generator of the episode (the random module if env_seed is None)
+    """
+    if env_seed is None:
+        return random
+    env.seed(env_seed + ep)
+    if hasattr(env.action_space, 'seed'):
+        env.action_space.seed(env_seed + ep)
+    return random.Random(env_seed + ep)
+
+
+_data_worker = {}
+
+
+def _init_data_worker(play, kwargs):
+    torch.set_num_threads(1)
+    _data_worker['play'] = play
+    _data_worker['kwargs'] = kwargs
+
+
+def _data_worker_shard(episode_ids):
+    return _data_worker['play'](episode_ids=episode_ids, **_data_worker['kwargs'])
+
+
+def _play_shards(play, episodes, workers, shard_size, net_arg, **kwargs):
+    """
+    Yields play(episode_ids=shard, **kwargs) for consecutive shards of shard_size episodes, in episode order.
+
+    With workers > 1 the shards are played by forked processes, each limited to one torch thread so that the workers
+    don't oversubscribe the cores. They share a cpu copy of the network (kwargs[net_arg]) in shared memory and don't
+    render. Results are yielded in order regardless of which worker finishes first.
+    """
+    episode_ids = list(range(episodes))
+    if workers <= 1 or episodes <= shard_size:
+        yield play(episode_ids=episode_ids, **kwargs)
+        return
+
+    net = kwargs[net_arg]
+    if net is not None:
+        net = copy.deepcopy(net).cpu()
+        net.share_memory()
+    kwargs.update({net_arg: net, 'cuda': False, 'render': False})
+    shards = [episode_ids[i:i + shard_size] for i in range(0, episodes, shard_size)]
+    # workers are forked, so they inherit the env and the network without pickling them
+    context = multiprocessing.get_context('fork')
+    with context.Pool(min(workers, len(shards)), initializer=_init_data_worker, initargs=(play, kwargs)) as pool:
+        for result in pool.imap(_data_worker_shard, shards):
+            yield result
+
+
+def _shard_size(episodes, workers, unit=1):
+    """
+    Size of the shards of the episodes for a pool of workers: a few shards per worker to balance their load, each a
+    multiple of unit episodes.
+    """
+    units = -(-episodes // unit)
+    return unit * max(1, -(-units // (4 * workers)))
+
+
+def _batched_bottleneck_data(net, envs, episode_ids, bottleneck_data, action_data, cuda, eps, max_steps, render,
+                             env_seed=None):
+    """
+    Lockstep version of the episodes of generate_bottleneck_data: one forward pass per step for all the copies.
+
+    :return: rewards of the episodes
+    """
+    hx = net.init_hidden(len(envs))
+    if cuda:
+        hx = hx.cuda()
+    ep_rewards = [0] * len(episode_ids)
+    slot_episode, act_count, exploration_start_step = [None] * len(envs), [0] * len(envs), [0] * len(envs)
+    slot_random = [random] * len(envs)
+    step_data = {}
+
+    def seed_fn(slot, i):
+        slot_random[slot] = seed_episode(envs[slot], env_seed, episode_ids[i])
+
+    def reset_fn(slot, i):
+        hx[slot] = net.init_hidden()[0]
+        slot_episode[slot] = episode_ids[i]
+        act_count[slot] = 0
+        exploration_start_step[slot] = slot_random[slot].choice(range(0, max_steps, int(0.02 * max_steps)))
+
+    def act_fn(slots, obs):
+        index = torch.LongTensor(slots)
+        obs = torch.Tensor(obs)
+        if cuda:
+            index, obs = index.cuda(), obs.cuda()
+        critic, logit, next_hx, (_, _, obs_c, _) = net((obs, hx[index]), inspect=True)
+        hx[index] = next_hx
+        greedy_actions = F.softmax(logit, dim=1).max(1)[1].data.cpu().numpy()
+        next_hx, obs_c = next_hx.data.cpu().numpy(), obs_c.data.cpu().numpy()
+        actions = []
+        for row, slot in enumerate(slots):
+            ep = slot_episode[slot]
+            if exploration_start_step[slot] >= act_count[slot] and slot_random[slot].random() < eps[ep % len(eps)]:
+                actions.append(envs[slot].action_space.sample())
+            else:
+                actions.append(int(greedy_actions[row]))
+            step_data[slot] = (next_hx[row], obs_c[row])
+        return actions
+
+    def step_fn(slot, i, obs, action, reward, done, info):
+        action_data.append(action)
+        act_count[slot] += 1
+        done = done if act_count[slot] <= max_steps else True
+        if action not in bottleneck_data:
+            bottleneck_data[action] = {'hx_data': [], 'obs_data': []}
+        bottleneck_data[action]['hx_data'].append(step_data[slot][0].tolist())
+        bottleneck_data[action]['obs_data'].append(step_data[slot][1].tolist())
+        ep_rewards[i] += reward
+        if done:
+            logging.info('episode:{} reward:{}'.format(episode_ids[i], ep_rewards[i]))
+        return done
+
+    lockstep_episodes(envs, len(episode_ids), reset_fn, act_fn, step_fn, render=render,
+                      seed_fn=seed_fn if env_seed is not None else None)
+    return ep_rewards
+
+
+def _bottleneck_episodes(net, env, episode_ids, cuda, eps, max_steps, render, num_envs, make_env, env_seed):
+    """
+    Plays the given episodes of generate_bottleneck_data.
+
+    :return: bottleneck data of each action, actions taken and rewards of the episodes, in order
+    """
+    bottleneck_data, action_data = {}, []
+    with torch.no_grad():
+        if num_envs > 1:
+            envs = env_copies(env, min(num_envs, len(episode_ids)), make_env)
+            ep_rewards = _batched_bottleneck_data(net, envs, episode_ids, bottleneck_data, action_data, cuda, eps,
+                                                  max_steps, render, env_seed)
+            return bottleneck_data, action_data, ep_rewards
+
+        ep_rewards = []
+        for ep in episode_ids:
+            ep_random = seed_episode(env, env_seed, ep)
+            done = False
+            obs = env.reset()
+            hx = Variable(net.init_hidden())
+            ep_reward = 0
+            act_count = 0
+            exploration_start_step = ep_random.choice(range(0, max_steps, int(0.02 * max_steps)))
+            while not done:
+                if render:
+                    env.render()
+                obs = Variable(torch.Tensor(obs)).unsqueeze(0)
+                if cuda:
+                    hx = hx.cuda()
+                    obs = obs.cuda()
+                critic, logit, hx, (_, _, obs_c, _) = net((obs, hx), inspect=True)
+                if exploration_start_step >= act_count and ep_random.random() < eps[ep % len(eps)]:
+                    action = env.action_space.sample()
+                else:
+                    prob = F.softmax(logit, dim=1)
+                    action = int(prob.max(1)[1].data.cpu().numpy())
+                obs, reward, done, info = env.step(action)
+                action_data.append(action)
+                act_count += 1
+                done = done if act_count <= max_steps else True
+                if action not in bottleneck_data:
+                    bottleneck_data[action] = {'hx_data': [], 'obs_data': []}
+                bottleneck_data[action]['hx_data'].append(hx.data.cpu().numpy()[0].tolist())
+                bottleneck_data[action]['obs_data'].append(obs_c.data.cpu().numpy()[0].tolist())
+
+                ep_reward += reward
+            logging.info('episode:{} reward:{}'.format(ep, ep_reward))
+            ep_rewards.append(ep_reward)
+    return bottleneck_data, action_data, ep_rewards
+
+
+def generate_bottleneck_data(net, env, episodes, save_path, cuda=False, eps=(0, 0), max_steps=None, render=True,
+                             num_envs=1, make_env=None, workers=1, env_seed=None):
     """
     Generating bottleneck data for the given network.
 
@@ -169,6 +425,14 @@ def generate_bottleneck_data(net, env, episodes, save_path, cuda=False, eps=(0,
     :param save_path: path to save data in
     :param cuda: check if cuda is available
     :param max_steps: maximum number of steps to take. used for exploration.
+    :param num_envs: number of copies of the environment played in lockstep, with one batched forward pass of the
+                     network per step (see lockstep_episodes); only the first copy is rendered
+    :param make_env: function creating a fresh copy of the environment (see env_copies)
+    :param workers: no. of processes the episodes are sharded across (see _play_shards)
+    :param env_seed: if given, episode i is played with the environment and the exploration seeded by env_seed + i
+                     (see seed_episode), which makes the data independent of how the episodes are sharded (serial and
+                     sharded runs give the same data); if None, episodes are not seeded, unless workers > 1 in which
+                     case a random base seed is drawn
     :return: observation and hidden state bottleneck data
     """
     if os.path.exists(save_path):
@@ -177,42 +441,23 @@ def generate_bottleneck_data(net, env, episodes, save_path, cuda=False, eps=(0,
     else:
         logging.info('No Data Found @ path : {}'.format(save_path))
         logging.info('Generating BottleNeck Data..')
+        if workers > 1 and env_seed is None:
+            # forked workers would all replay the random state of this process
+            env_seed = random.randrange(2 ** 31)
         bottleneck_data = {}
         hx_data, obs_data, action_data = [], [], []
         all_ep_rewards = []
-        with torch.no_grad():
-            for ep in range(episodes):
-                done = False
-                obs = env.reset()
-                hx = Variable(net.init_hidden())
-                ep_reward = 0
-                act_count = 0
-                exploration_start_step = random.choice(range(0, max_steps, int(0.02 * max_steps)))
-                while not done:
-                    if render:
-                        env.render()
-                    obs = Variable(torch.Tensor(obs)).unsqueeze(0)
-                    if cuda:
-                        hx = hx.cuda()
-                        obs = obs.cuda()
-                    critic, logit, hx, (_, _, obs_c, _) = net((obs, hx), inspect=True)
-                    if exploration_start_step >= act_count and random.random() < eps[ep % len(eps)]:
-                        action = env.action_space.sample()
-                    else:
-                        prob = F.softmax(logit, dim=1)
-                        action = int(prob.max(1)[1].data.cpu().numpy())
-                    obs, reward, done, info = env.step(action)
-                    action_data.append(action)
-                    act_count += 1
-                    done = done if act_count <= max_steps else True
-                    if action not in bottleneck_data:
-                        bottleneck_data[action] = {'hx_data': [], 'obs_data': []}
-                    bottleneck_data[action]['hx_data'].append(hx.data.cpu().numpy()[0].tolist())
-                    bottleneck_data[action]['obs_data'].append(obs_c.data.cpu().numpy()[0].tolist())
-
-                    ep_reward += reward
-                logging.info('episode:{} reward:{}'.format(ep, ep_reward))
-                all_ep_rewards.append(ep_reward)
+        shards = _play_shards(_bottleneck_episodes, episodes, workers, _shard_size(episodes, workers), 'net', net=net,
+                              env=env, cuda=cuda, eps=eps, max_steps=max_steps, render=render, num_envs=num_envs,
+                              make_env=make_env, env_seed=env_seed)
+        for shard_data, shard_actions, shard_rewards in shards:
+            for action, data in shard_data.items():
+                if action not in bottleneck_data:
+                    bottleneck_data[action] = {'hx_data': [], 'obs_data': []}
+                bottleneck_data[action]['hx_data'] += data['hx_data']
+                bottleneck_data[action]['obs_data'] += data['obs_data']
+            action_data += shard_actions
+            all_ep_rewards += shard_rewards
         logging.info('Average Performance:{}'.format(sum(all_ep_rewards) / len(all_ep_rewards)))
 
         hx_train_data, hx_test_data, obs_train_data, obs_test_data = [], [], [], []
@@ -227,10 +472,11 @@ def generate_bottleneck_data(net, env, episodes, save_path, cuda=False, eps=(0,
         obs_test_data = np.unique(obs_test_data, axis=0).tolist()
         hx_test_data = np.unique(hx_test_data, axis=0).tolist()
 
-        random.shuffle(hx_train_data)
-        random.shuffle(obs_train_data)
-        random.shuffle(hx_test_data)
-        random.shuffle(obs_test_data)
+        shuffle = random.shuffle if env_seed is None else random.Random(env_seed).shuffle
+        shuffle(hx_train_data)
+        shuffle(obs_train_data)
+        shuffle(hx_test_data)
+        shuffle(obs_test_data)
 
         pickle.dump((hx_train_data, hx_test_data, obs_train_data, obs_test_data), open(save_path, "wb"))
 
@@ -272,6 +518,17 @@ def get_args():
     parser.add_argument('--bx_scratch', action='store_true', default=False, help='use scratch bx network for BGRU')
     parser.add_argument('--generate_fsm', action='store_true', default=False, help='extract fsm from fmm net')
     parser.add_argument('--evaluate_fsm', action='store_true', default=False, help='evaluate fsm')
+    parser.add_argument('--fsm_workers', type=int, default=1, help='No. of processes playing episodes for fsm extraction')
+    parser.add_argument('--rollout_envs', type=int, default=1,
+                        help='No. of environment copies played in lockstep while generating data')
+    parser.add_argument('--data_workers', type=int, default=1,
+                        help='No. of processes generating training/bottleneck data')
+    parser.add_argument('--columnar_data', action='store_true', default=False,
+                        help='Keep trajectories as memory-mapped columnar datasets instead of pickles')
+    parser.add_argument('--frames_per_code', type=int, default=None,
+                        help='No. of sample frames kept per observation code for analysis (all of them by default)')
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='Profile the phases of fsm extraction/evaluation and write a summary to the log directory')
 
     parser.add_argument('--bn_episodes', type=int, default=20,
                         help="No. of episodes for generating data for Bottleneck Network")
@@ -289,7 +546,117 @@ def get_args():
     return args
 
 
-def generate_trajectories(env, batches, batch_size, save_path, guide=None, cuda=False, render=False):
+def _batched_trajectories(envs, episode_ids, batch_size, guide, cuda, render, env_seed=None):
+    """
+    Lockstep version of the episodes of generate_trajectories: one forward pass of the guide per step for all the
+    copies.
+
+    :return: observations, actions, action probabilities and reward of each of the episodes, in order
+    """
+    total_episodes = len(episode_ids)
+    ep_obs, ep_actions, ep_action_probs = [None] * total_episodes, [None] * total_episodes, [None] * total_episodes
+    ep_rewards = [0] * total_episodes
+    slot_episode = [None] * len(envs)
+    hx = None if guide is None else guide.init_hidden(len(envs))
+    if hx is not None and cuda:
+        hx = hx.cuda()
+
+    def seed_fn(slot, i):
+        seed_episode(envs[slot], env_seed, episode_ids[i])
+
+    def reset_fn(slot, i):
+        slot_episode[slot] = i
+        ep_obs[i], ep_actions[i], ep_action_probs[i] = [], [], []
+        if hx is not None:
+            hx[slot] = guide.init_hidden()[0]
+
+    def act_fn(slots, obs):
+        if guide is None:
+            return [envs[slot].env.get_desired_action() for slot in slots]
+        index = torch.LongTensor(slots)
+        obs = torch.Tensor(obs)
+        if cuda:
+            index, obs = index.cuda(), obs.cuda()
+        critic, logit, next_hx, (_, _, obs_c, _) = guide((obs, hx[index]), inspect=True)
+        hx[index] = next_hx
+        prob = F.softmax(logit, dim=1)
+        actions = prob.max(1)[1].data.cpu().numpy()
+        prob = prob.data.cpu().numpy()
+        for row, slot in enumerate(slots):
+            ep_action_probs[slot_episode[slot]].append(prob[row].tolist())
+        return [int(action) for action in actions]
+
+    def step_fn(slot, i, obs, action, reward, done, info):
+        ep_obs[i].append(obs)
+        ep_actions[i].append(action)
+        ep_rewards[i] += reward
+        if done:
+            ep = episode_ids[i]
+            logging.info('Ep:{} Batch: {} Reward:{}'.format(ep // batch_size, ep % batch_size, ep_rewards[i]))
+        return done
+
+    lockstep_episodes(envs, total_episodes, reset_fn, act_fn, step_fn, render=render,
+                      seed_fn=seed_fn if env_seed is not None else None)
+    return list(zip(ep_obs, ep_actions, ep_action_probs, ep_rewards))
+
+
+def _trajectory_episodes(env, episode_ids, batch_size, guide, cuda, render, num_envs, make_env, env_seed):
+    """
+    Plays the given episodes of generate_trajectories; episode ep is the (ep % batch_size)th of batch ep // batch_size.
+
+    :return: observations, actions, action probabilities and reward of each of the episodes, in order
+    """
+    with torch.no_grad():
+        if num_envs > 1:
+            envs = env_copies(env, min(num_envs, len(episode_ids)), make_env)
+            return _batched_trajectories(envs, episode_ids, batch_size, guide, cuda, render, env_seed)
+
+        played = []
+        for ep in episode_ids:
+            seed_episode(env, env_seed, ep)
+            _actions, _action_probs, _obs = [], [], []
+            done = False
+            obs = env.reset()
+            hx = None if guide is None else Variable(guide.init_hidden())
+            if hx is not None and cuda:
+                hx = hx.cuda()
+            ep_reward = 0
+
+            while not done:
+                if render:
+                    env.render()
+                _obs.append(obs)
+                if guide is None:
+                    action = env.env.get_desired_action()
+                    _actions.append(action)
+                else:
+                    obs = Variable(torch.Tensor(obs).unsqueeze(0))
+                    if cuda:
+                        obs = obs.cuda()
+                    critic, logit, hx, (_, _, obs_c, _) = guide((obs, hx), inspect=True)
+                    prob = F.softmax(logit, dim=1)
+                    action = int(prob.max(1)[1].data.cpu().numpy())
+                    _action_probs.append(prob.data.cpu().numpy()[0].tolist())
+                    _actions.append(action)
+                obs, reward, done, info = env.step(action)
+                ep_reward += reward
+
+            played.append((_obs, _actions, _action_probs, ep_reward))
+            logging.info('Ep:{} Batch: {} Reward:{}'.format(ep // batch_size, ep % batch_size, ep_reward))
+    return played
+
+
+def _builtin_dtypes(observations):
+    """
+    Views of the observations with numpy's shared builtin dtypes. Arrays unpickled from a worker each carry a dtype
+    instance of their own, which would pickle differently from the arrays of a serial run.
+    """
+    return [obs.view(np.dtype(obs.dtype.str))
+            if isinstance(obs, np.ndarray) and obs.dtype.fields is None else obs for obs in observations]
+
+
+def generate_trajectories(env, batches, batch_size, save_path, guide=None, cuda=False, render=False, num_envs=1,
+                          make_env=None, workers=1, env_seed=None, columnar=False):
     """
     Generate trajectories used as training data.
 
@@ -299,58 +666,53 @@ def generate_trajectories(env, batches, batch_size, save_path, guide=None, cuda=
     :param save_path: path to save generated data
     :param cuda: check if cuda is available
     :param render: check to render environment
+    :param num_envs: number of copies of the environment played in lockstep, with one batched forward pass of the
+                     guide per step (see lockstep_episodes); only the first copy is rendered
+    :param make_env: function creating a fresh copy of the environment (see env_copies)
+    :param workers: no. of processes the batches are sharded across (see _play_shards)
+    :param env_seed: if given, episode i (the (i % batch_size)th of batch i // batch_size) is played with the
+                     environment seeded by env_seed + i (see seed_episode), which makes the data independent of how
+                     the batches are sharded (serial and sharded runs give the same data); if None, episodes are not
+                     seeded, unless workers > 1 in which case a random base seed is drawn
+    :param columnar: check to keep the data as a memory-mapped trajectory_data.TrajectoryDataset in the directory
+                     standing for save_path (see trajectory_data.dataset_path) instead of a pickle; data already
+                     pickled at save_path is converted
     :return: generated trajectory data
     """
-    if os.path.exists(save_path):
+    if columnar and TrajectoryDataset.exists(dataset_path(save_path)):
+        logging.info('Loading Saved data .. ')
+        _train_data = TrajectoryDataset.load(dataset_path(save_path))
+    elif columnar and os.path.exists(save_path):
+        logging.info('Converting Saved data .. ')
+        _train_data = convert_pickle(save_path)
+    elif os.path.exists(save_path):
         logging.info('Loading Saved data .. ')
         # unpickling after reading the file is efficient
         _train_data = pickle.loads(open(save_path, "rb").read())
     else:
         logging.info('Generating data .. ')
+        if workers > 1 and env_seed is None:
+            # forked workers would all replay the random state of this process
+            env_seed = random.randrange(2 ** 31)
         _train_data = {}
-        all_ep_rewards = []
         if guide is not None:
             guide.eval()
 
-        with torch.no_grad():
-            for seed in range(batches):
-                data_obs, data_actions, data_actions_prob, data_len = [], [], [], []
-                for ep in range(batch_size):
-                    _actions, _action_probs, _obs = [], [], []
-                    done = False
-                    obs = env.reset()
-                    hx = None if guide is None else Variable(guide.init_hidden())
-                    if hx is not None and cuda:
-                        hx = hx.cuda()
-                    ep_reward = 0
-
-                    while not done:
-                        if render:
-                            env.render()
-                        _obs.append(obs)
-                        if guide is None:
-                            action = env.env.get_desired_action()
-                            _actions.append(action)
-                        else:
-                            obs = Variable(torch.Tensor(obs).unsqueeze(0))
-                            if cuda:
-                                obs = obs.cuda()
-                            critic, logit, hx, (_, _, obs_c, _) = guide((obs, hx), inspect=True)
-                            prob = F.softmax(logit, dim=1)
-                            action = int(prob.max(1)[1].data.cpu().numpy())
-                            _action_probs.append(prob.data.cpu().numpy()[0].tolist())
-                            _actions.append(action)
-                        obs, reward, done, info = env.step(action)
-                        ep_reward += reward
-
-                    data_obs.append(_obs)
-                    data_actions.append(_actions)
-                    data_actions_prob.append(_action_probs)
-                    data_len.append(len(_obs))
-                    all_ep_rewards.append(ep_reward)
-                    logging.info('Ep:{} Batch: {} Reward:{}'.format(seed, ep, ep_reward))
-
-                _train_data[seed] = (data_obs, data_actions, data_actions_prob, data_len)
+        episodes = batches * batch_size
+        played = []
+        for shard in _play_shards(_trajectory_episodes, episodes, workers, _shard_size(episodes, workers, batch_size),
+                                  'guide', env=env, batch_size=batch_size, guide=guide, cuda=cuda, render=render,
+                                  num_envs=num_envs, make_env=make_env, env_seed=env_seed):
+            played += shard if workers <= 1 else [(_builtin_dtypes(ep[0]),) + ep[1:] for ep in shard]
+        for seed in range(batches):
+            batch = played[seed * batch_size:(seed + 1) * batch_size]
+            _train_data[seed] = ([ep[0] for ep in batch], [ep[1] for ep in batch], [ep[2] for ep in batch],
+                                 [len(ep[0]) for ep in batch])
+        all_ep_rewards = [ep[3] for ep in played]
         logging.info('Average Performance: {}'.format(sum(all_ep_rewards) / len(all_ep_rewards)))
-        pickle.dump(_train_data, open(save_path, "wb"))
+        if columnar:
+            TrajectoryDataset.from_batches(_train_data).save(dataset_path(save_path))
+            _train_data = TrajectoryDataset.load(dataset_path(save_path))
+        else:
+            pickle.dump(_train_data, open(save_path, "wb"))
     return _train_data
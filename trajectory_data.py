@@ -0,0 +1,220 @@
+"""
+Columnar storage of the trajectories used as training data, memory-mapped so that training reads batches from disk
+as it goes instead of holding every trajectory in memory.
+
+The converter from the pickles written by tools.generate_trajectories can be run as a script::
+
+    python trajectory_data.py results/.../trajectories_data.p [dataset_dir]
+"""
+
+import os
+import json
+import pickle
+import logging
+import argparse
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class TrajectoryDataset():
+    """
+    Batches of trajectories, with the steps of all the episodes concatenated into flat arrays:
+
+    - obs: (steps, *obs_shape) observations
+    - actions: (steps,) int64 actions
+    - action_probs: (steps, total_actions) float32 action probabilities of the guide; None for data without a guide
+    - offsets: (episodes + 1,) int64 index of the first step of every episode, followed by the total no. of steps
+    - batch_offsets: (batches + 1,) int64 index of the first episode of every batch, followed by the no. of episodes
+    - batch_seeds: (batches,) int64 seed of every batch
+
+    It reads like the dict of batches built by tools.generate_trajectories: dataset[seed] is the tuple (data_obs,
+    data_actions, data_action_probs, data_len) of the batch, whose episodes are views into the arrays.
+
+    A dataset is saved as a directory of .npy arrays along with a JSON manifest (see save); loading memory-maps the
+    arrays, so that only the batches being trained on are read into memory.
+    """
+
+    FORMAT_VERSION = 1
+    MANIFEST = 'manifest.json'
+    ARRAYS = ('obs', 'actions', 'action_probs', 'offsets', 'batch_offsets', 'batch_seeds')
+
+    def __init__(self, obs, actions, action_probs, offsets, batch_offsets, batch_seeds):
+        self.obs = obs
+        self.actions = actions
+        self.action_probs = action_probs
+        self.offsets = offsets
+        self.batch_offsets = batch_offsets
+        self.batch_seeds = batch_seeds
+        self._batch_index = {int(seed): i for i, seed in enumerate(batch_seeds)}
+
+    @classmethod
+    def from_batches(cls, batches):
+        """
+        Builds a dataset from a dict of batches (as built by tools.generate_trajectories).
+
+        :param batches: dict of seed -> (data_obs, data_actions, data_action_probs, data_len)
+        :return: TrajectoryDataset
+        """
+        batch_seeds = np.array(list(batches.keys()), dtype=np.int64)
+        episode_lengths, batch_sizes = [], []
+        for seed in batch_seeds:
+            data_obs = batches[int(seed)][0]
+            batch_sizes.append(len(data_obs))
+            episode_lengths += [len(ep_obs) for ep_obs in data_obs]
+        offsets = np.zeros(len(episode_lengths) + 1, dtype=np.int64)
+        np.cumsum(episode_lengths, out=offsets[1:])
+        batch_offsets = np.zeros(len(batch_sizes) + 1, dtype=np.int64)
+        np.cumsum(batch_sizes, out=batch_offsets[1:])
+
+        episodes = [ep for seed in batch_seeds for ep in zip(*batches[int(seed)][:3])]
+        first_obs = next((np.asarray(ep_obs[0]) for ep_obs, _, _ in episodes if len(ep_obs) > 0), np.zeros(0))
+        obs = np.empty((offsets[-1],) + first_obs.shape, dtype=first_obs.dtype)
+        actions = np.empty(offsets[-1], dtype=np.int64)
+        with_probs = any(len(ep_probs) > 0 for _, _, ep_probs in episodes)
+        action_probs = None
+        for ep, (ep_obs, ep_actions, ep_probs) in enumerate(episodes):
+            start, end = offsets[ep], offsets[ep + 1]
+            if end > start:
+                obs[start:end] = np.asarray(ep_obs)
+                actions[start:end] = np.asarray(ep_actions)
+                if with_probs:
+                    ep_probs = np.asarray(ep_probs, dtype=np.float32)
+                    if action_probs is None:
+                        action_probs = np.empty((offsets[-1],) + ep_probs.shape[1:], dtype=np.float32)
+                    action_probs[start:end] = ep_probs
+        return cls(obs, actions, action_probs, offsets, batch_offsets, batch_seeds)
+
+    def __len__(self):
+        return len(self.batch_seeds)
+
+    def __contains__(self, seed):
+        return seed in self._batch_index
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [int(seed) for seed in self.batch_seeds]
+
+    @property
+    def total_episodes(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, seed):
+        batch = self._batch_index[seed]
+        data_obs, data_actions, data_action_probs, data_len = [], [], [], []
+        for ep in range(self.batch_offsets[batch], self.batch_offsets[batch + 1]):
+            start, end = self.offsets[ep], self.offsets[ep + 1]
+            data_obs.append(self.obs[start:end])
+            data_actions.append(self.actions[start:end])
+            data_action_probs.append(self.action_probs[start:end] if self.action_probs is not None else [])
+            data_len.append(int(end - start))
+        return data_obs, data_actions, data_action_probs, data_len
+
+    def save(self, path):
+        """
+        Saves the dataset into a directory holding one .npy file per array and a JSON manifest.
+
+        :param path: directory to write into (created if needed)
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        arrays = {}
+        for name in self.ARRAYS:
+            if getattr(self, name) is not None:
+                arrays[name] = name + '.npy'
+                np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(getattr(self, name)))
+        manifest = {'format_version': self.FORMAT_VERSION,
+                    'total_batches': len(self),
+                    'total_episodes': self.total_episodes,
+                    'total_steps': int(self.offsets[-1]),
+                    'arrays': arrays}
+        # the manifest is written last: a directory without one is an incomplete dataset
+        with open(os.path.join(path, self.MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+    @classmethod
+    def exists(cls, path):
+        return os.path.exists(os.path.join(path, cls.MANIFEST))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads a dataset saved by save.
+
+        :param path: directory of the saved dataset
+        :param mmap: check to memory-map the arrays (read-only) instead of reading them into memory
+        :return: TrajectoryDataset
+        """
+        with open(os.path.join(path, cls.MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest.get('format_version') != cls.FORMAT_VERSION:
+            raise ValueError('Unsupported trajectory dataset format version: {}'.format(manifest.get('format_version')))
+        arrays = {name: np.load(os.path.join(path, file_name), mmap_mode='r' if mmap else None)
+                  for name, file_name in manifest['arrays'].items()}
+        # the index arrays are small and read on every access
+        return cls(arrays['obs'], arrays['actions'], arrays.get('action_probs'), np.array(arrays['offsets']),
+                   np.array(arrays['batch_offsets']), np.array(arrays['batch_seeds']))
+
+
+def dataset_path(pickle_path):
+    """
+    Directory of the columnar dataset standing for the pickled trajectories at the given path.
+    """
+    return os.path.splitext(pickle_path)[0]
+
+
+def convert_pickle(pickle_path, path=None, mmap=True):
+    """
+    Converts trajectories pickled by tools.generate_trajectories into a columnar dataset.
+
+    :param pickle_path: path of the pickled trajectories
+    :param path: directory of the dataset; next to the pickle by default (see dataset_path)
+    :param mmap: check to memory-map the returned dataset
+    :return: the saved TrajectoryDataset
+    """
+    path = path if path is not None else dataset_path(pickle_path)
+    with open(pickle_path, 'rb') as f:
+        batches = pickle.load(f)
+    TrajectoryDataset.from_batches(batches).save(path)
+    logger.info('Converted {} into {}'.format(pickle_path, path))
+    return TrajectoryDataset.load(path, mmap=mmap)
+
+
+def pad_batch(batch_data, action_pad=-1):
+    """
+    Pads the episodes of a batch to the length of the longest one, into contiguous arrays.
+
+    :param batch_data: (data_obs, data_actions, data_action_probs, data_len) of the batch
+    :param action_pad: action filling the padded steps
+    :return: float32 (episodes, steps, *obs_shape) observations, int64 (episodes, steps) actions, float32 (episodes,
+             steps, total_actions) action probabilities (None without them) and the lengths of the episodes; padded
+             observations and action probabilities are zeros
+    """
+    data_obs, data_actions, data_action_probs, data_len = batch_data
+    _max = max(data_len)
+    obs_shape = np.shape(data_obs[0][0])
+    obs = np.zeros((len(data_obs), _max) + obs_shape, dtype=np.float32)
+    actions = np.full((len(data_obs), _max), action_pad, dtype=np.int64)
+    with_probs = any(len(ep_probs) > 0 for ep_probs in data_action_probs)
+    action_probs = None
+    if with_probs:
+        prob_shape = np.shape(data_action_probs[0][0])
+        action_probs = np.zeros((len(data_obs), _max) + prob_shape, dtype=np.float32)
+    for i, length in enumerate(data_len):
+        obs[i, :length] = np.asarray(data_obs[i][:length])
+        actions[i, :length] = np.asarray(data_actions[i][:length]).reshape(length)
+        if with_probs:
+            action_probs[i, :length] = np.asarray(data_action_probs[i][:length])
+    return obs, actions, action_probs, list(data_len)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert pickled trajectories into a columnar dataset')
+    parser.add_argument('pickle_path', help='Path of the pickled trajectories')
+    parser.add_argument('path', nargs='?', default=None,
+                        help='Directory of the dataset (next to the pickle by default)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    convert_pickle(args.pickle_path, args.path)
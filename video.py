@@ -0,0 +1,145 @@
+"""
+Media of inspected episodes: streaming video encoding, text labels and observation montages.
+"""
+
+import logging
+import subprocess
+import numpy as np
+from functools import lru_cache
+from PIL import Image, ImageFont, ImageDraw
+
+logger = logging.getLogger(__name__)
+
+
+class VideoWriter():
+    """
+    Pipes raw RGB frames straight into a single ffmpeg process, so that no frame ever touches the disk.
+
+    The encoder is started on the first frame (which fixes the frame size) and finalized by close(). Frames must be
+    (height, width, 3) arrays; non uint8 frames are clipped to [0, 255].
+
+    Usage::
+
+        with VideoWriter('video_0.mp4', framerate=1) as video:
+            for frame in frames:
+                video.write(frame)
+    """
+
+    def __init__(self, path, framerate=1, ffmpeg='ffmpeg'):
+        self.path = path
+        self.framerate = framerate
+        self.ffmpeg = ffmpeg
+        self.total_frames = 0
+        self._process = None
+        self._shape = None
+        self._failed = False
+
+    def _open(self, shape):
+        height, width = shape[:2]
+        command = [self.ffmpeg, '-loglevel', 'error', '-y',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(width, height),
+                   '-framerate', str(self.framerate), '-i', '-',
+                   # yuv420p (playable everywhere) needs even dimensions
+                   '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', self.path]
+        try:
+            self._process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        except OSError as e:
+            logger.error('Video encoder could not be started ({}); {} will not be written'.format(e, self.path))
+            self._failed = True
+        self._shape = shape
+
+    def write(self, frame):
+        if self._failed:
+            return
+        if frame.dtype != np.uint8:
+            frame = np.clip(frame, 0, 255).astype(np.uint8)
+        if self._process is None:
+            self._open(frame.shape)
+            if self._failed:
+                return
+        if frame.shape != self._shape:
+            raise ValueError('Frame of shape {} in a video of shape {}'.format(frame.shape, self._shape))
+        try:
+            self._process.stdin.write(np.ascontiguousarray(frame).tobytes())
+            self.total_frames += 1
+        except BrokenPipeError:
+            logger.error('Video encoder exited early; {} is incomplete'.format(self.path))
+            self._failed = True
+
+    def close(self):
+        """
+        Finishes the encoding and waits for the encoder to exit.
+
+        :return: path of the video; None if no video was written
+        """
+        if self._process is None:
+            return None
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        return_code = self._process.wait()
+        self._process = None
+        if return_code != 0:
+            logger.error('Video encoder exited with code {} for {}'.format(return_code, self.path))
+            return None
+        return None if self._failed else self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+@lru_cache(maxsize=None)
+def _font(font_size):
+    return ImageFont.truetype("arial.ttf", font_size)
+
+
+# labels of inspected frames (state, obs and next state ids) rarely repeat, so only the last few full-size images are
+# kept, for the labels repeated back to back
+@lru_cache(maxsize=8)
+def _text_image(shape, text, position, font_size):
+    img = Image.new("RGB", shape, (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    draw.text(position, text, (0, 0, 0), font=_font(font_size))
+    img = np.array(img)
+    img.flags.writeable = False
+    return img
+
+
+def text_image(shape, text, position=(0, 0), font_size=25):
+    """
+    Image of the text (black on white); fonts are cached, along with the last few rendered labels.
+
+    :param shape: (width, height) of the image
+    :return: read-only (height, width, 3) uint8 array
+    """
+    return _text_image(tuple(shape), text, tuple(position), font_size)
+
+
+class Montage():
+    """
+    Grid of rows x cols tiles, each of the given (width, height), allocated once up front; tiles are written in place,
+    so building a sheet of any size copies every image exactly once.
+
+    A tile larger than its cell spills into the following cells (e.g. a label spanning a whole column) and is clipped at
+    the border of the canvas; grayscale tiles are broadcast to RGB.
+    """
+
+    def __init__(self, rows, cols, tile_shape, fill=255):
+        self.rows = rows
+        self.cols = cols
+        self.tile_width, self.tile_height = tile_shape
+        self.image = np.full((rows * self.tile_height, cols * self.tile_width, 3), fill, dtype=np.uint8)
+
+    def put(self, row, col, tile):
+        top, left = row * self.tile_height, col * self.tile_width
+        tile = np.asarray(tile)
+        if tile.ndim == 2:
+            tile = tile[:, :, None]
+        height = min(tile.shape[0], self.image.shape[0] - top)
+        width = min(tile.shape[1], self.image.shape[1] - left)
+        self.image[top:top + height, left:left + width] = tile[:height, :width, :3]